@@ -1,8 +1,30 @@
 from typing import Literal, Optional, Union
 
 import abc
+import time
+import datetime
 import requests
 import urllib.parse
+import email.utils
+
+# Note: Busy service is retried at most this many times and for this long in total,
+#   each delay it asks for is capped, so a misconfigured server can't stall the client
+MAX_BUSY_RETRIES = 10
+MAX_BUSY_RETRY_SECONDS = 30 * 60
+MAX_RETRY_AFTER_SECONDS = 5 * 60
+
+
+def _parse_retry_after(value: str) -> float:
+    try:
+        seconds = float(value)
+    except ValueError:
+        # Note: Retry-After may also be an HTTP date
+        try:
+            seconds = (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            seconds = MAX_RETRY_AFTER_SECONDS
+
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER_SECONDS)
 
 
 class BaseCommand(abc.ABC):
@@ -24,18 +46,38 @@ class BaseCommand(abc.ABC):
         self.files = files
         self.params = params
 
+    def rewind_files(self):
+        files = self.files.values() if isinstance(self.files, dict) else [file for _, file in self.files or []]
+
+        for file in files:
+            file.seek(0)
+
     def run(self):
-        response = requests.request(
-            method=self.method,
-            url=urllib.parse.urljoin(self.base_url, self.path),
-            data=self.data,
-            files=self.files,
-            params=self.params,
-        )
+        deadline = time.monotonic() + MAX_BUSY_RETRY_SECONDS
+
+        for attempt in range(MAX_BUSY_RETRIES + 1):
+            response = requests.request(
+                method=self.method,
+                url=urllib.parse.urljoin(self.base_url, self.path),
+                data=self.data,
+                files=self.files,
+                params=self.params,
+            )
+
+            # Note: Service is busy, request is repeated after the delay it asks for until retries run out
+            if response.status_code == 429 and "Retry-After" in response.headers and attempt < MAX_BUSY_RETRIES:
+                retry_after = _parse_retry_after(response.headers["Retry-After"])
 
-        response.raise_for_status()
+                if time.monotonic() + retry_after <= deadline:
+                    print(f"Service is busy, retrying in {retry_after:.0f} seconds")
 
-        return response.json()
+                    time.sleep(retry_after)
+                    self.rewind_files()
+                    continue
+
+            response.raise_for_status()
+
+            return response.json()
 
 
 class ServiceScheduleJobCommand(BaseCommand):
@@ -54,6 +96,22 @@ class ServiceScheduleJobCommand(BaseCommand):
         )
 
 
+class ServiceEstimateJobCommand(BaseCommand):
+    def __init__(
+            self,
+            base_url: str,
+            data: dict,
+            files: Union[dict | list],
+    ):
+        super().__init__(
+            base_url=base_url,
+            path="/estimate_job",
+            method="POST",
+            data=data,
+            files=files,
+        )
+
+
 class ServiceGetDownloadUrlCommand(BaseCommand):
     def __init__(
             self,
@@ -31,6 +31,18 @@ def add_subparser(subparsers):
     parser.set_defaults(command_func=check_status)
 
 
+# Note: Services that predate estimates don't report them
+def format_eta(check_result: dict) -> str:
+    lines = []
+
+    if check_result.get("eta_seconds") is not None:
+        lines.append(f"Estimated time left: {check_result['eta_seconds'] / 60:.1f} min")
+    if check_result.get("queue_position") is not None:
+        lines.append(f"Queue position: {check_result['queue_position']}")
+
+    return "".join(f"{line}\n" for line in lines)
+
+
 def check_status(
         backend_base: str,
 
@@ -51,7 +63,7 @@ def check_status(
         progress = check_result["progress"]
         logs = check_result["logs"]
 
-        print(f"Job ID: {job_id}\nStatus: {status}\nProgress: {progress[0]}/{progress[1]}\n")
+        print(f"Job ID: {job_id}\nStatus: {status}\nProgress: {progress[0]}/{progress[1]}\n{format_eta(check_result)}")
 
         if status in {"FAILED", "CANCELLED"}:
             if logs is not None:
@@ -33,6 +33,14 @@ def add_subparser(subparsers):
              'otherwise folder with that name will be created, and output will be extracted into it.',
     )
 
+    parser.add_argument(
+        '-p', '--parallelism',
+        action='store',
+        type=int,
+        default=8,
+        help='Amount of concurrent connections used to download output. Use 1 to download in a single stream.',
+    )
+
     parser.set_defaults(command_func=download)
 
 
@@ -41,6 +49,7 @@ def download(
 
         job_id: str,
         output: Path,
+        parallelism: int,
 
         **kwargs: dict,
 ):
@@ -57,4 +66,4 @@ def download(
     elif status != "SUCCEEDED":
         raise UsageError("Job is still pending, wait until job is completed")
 
-    download_result(backend_base, job_id, output)
+    download_result(backend_base, job_id, output, parallelism)
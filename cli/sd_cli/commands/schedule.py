@@ -8,7 +8,8 @@ from pathlib import Path
 
 from sd_cli.error import UsageError
 from sd_cli.utils.download_result import download_result
-from sd_cli.api.service import ServiceScheduleJobCommand, ServiceCheckStatusCommand
+from sd_cli.commands.check_status import format_eta
+from sd_cli.api.service import ServiceScheduleJobCommand, ServiceEstimateJobCommand, ServiceCheckStatusCommand
 
 SUPPORTED_LORAS = {
     'japanese_shop_v0.1',
@@ -51,6 +52,27 @@ def add_subparser(subparsers):
              "Enables --follow flag"
     )
 
+    parser.add_argument(
+        "--priority",
+        choices=['interactive', 'normal', 'batch'],
+        default='normal',
+        help="Interactive previews run ahead of normal jobs, batch renders and sweeps run when nothing else waits."
+    )
+
+    parser.add_argument(
+        "--submitter",
+        type=str,
+        default=None,
+        help="Name jobs are accounted to for fair share between users. Defaults to client address."
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action='store_true',
+        default=False,
+        help="Only print estimated runtime of the job, without scheduling it."
+    )
+
     # -------- BEGIN Copy from sd_experiments --------
     def existing_file_type(path: str):
         path = Path(path)
@@ -204,6 +226,7 @@ def schedule(
 
         follow: bool,
         output: Optional[Path],
+        dry_run: bool,
 
         input_meshes: str,
         style_images_paths: List[str],
@@ -234,6 +257,19 @@ def schedule(
     if kwargs['depth_algorithm'] not in depth_options:
         raise ValueError(f'{kwargs["depth_algorithm"]=} not in {depth_options}')
 
+    if dry_run:
+        estimate_result = ServiceEstimateJobCommand(
+            base_url=backend_base,
+            data={**kwargs},
+            files=[
+                *[("style_images", open(sip, "rb")) for sip in style_images_paths],
+                *[("input_meshes", open(imp, "rb")) for imp in input_meshes],
+            ],
+        ).run()
+
+        print(f"Estimated runtime: {estimate_result['seconds'] / 60:.1f} min\nQueue position: {estimate_result['queue_position']}")
+        return
+
     if output is not None:
         follow = True
 
@@ -250,6 +286,9 @@ def schedule(
     job_id = schedule_result["job_id"]
     print(f"Job ID: {job_id}")
 
+    if any(schedule_result.get("coalesced", [])):
+        print("Identical job is already in progress, attached to it")
+
     if follow:
         check_command = ServiceCheckStatusCommand(
             base_url=backend_base,
@@ -265,7 +304,7 @@ def schedule(
             progress = check_result["progress"]
             logs = check_result["logs"]
 
-            print(f"Job ID: {job_id}\nStatus: {status}\nProgress: {progress[0]}/{progress[1]}\n")
+            print(f"Job ID: {job_id}\nStatus: {status}\nProgress: {progress[0]}/{progress[1]}\n{format_eta(check_result)}")
 
             if status in {"FAILED", "CANCELLED"}:
                 if logs is not None:
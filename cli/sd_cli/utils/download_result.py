@@ -1,18 +1,67 @@
 import os
 import zipfile
 import tempfile
+import concurrent.futures
 
 from pathlib import Path
 from urllib.request import urlretrieve
 
+import requests
+
 from sd_cli.api.service import ServiceGetDownloadUrlCommand
 
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+# Note: Server or proxy may ignore the range and send the whole file with 200, such response is dropped unread
+def _download_range(url: str, path: Path, start: int, end: int) -> bool:
+    with requests.get(url, headers={"Range": f"bytes={start}-{end - 1}"}, stream=True) as response:
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            return False
+
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+    return True
+
+
+def download_file(url: str, path: Path, parallelism: int):
+    # Note: Ranged reads are used only when server supports them and file is big enough to benefit from them
+    if parallelism > 1 and url.startswith("http"):
+        head = requests.head(url, allow_redirects=True)
+        head.raise_for_status()
+
+        size = int(head.headers.get("Content-Length", 0))
+
+        if head.headers.get("Accept-Ranges") == "bytes" and size > CHUNK_SIZE:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+            with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+                futures = [
+                    executor.submit(_download_range, url, path, start, min(start + CHUNK_SIZE, size))
+                    for start in range(0, size, CHUNK_SIZE)
+                ]
+                ranged = all([future.result() for future in futures])
+
+            # Note: File is downloaded again in a single stream when any of its ranges wasn't served
+            if ranged:
+                return
+
+    urlretrieve(url, path)
+
 
 def download_result(
         backend_base: str,
 
         job_id: str,
         output: Path,
+
+        parallelism: int = 8,
 ):
 
     get_url_command = ServiceGetDownloadUrlCommand(
@@ -23,12 +72,12 @@ def download_result(
     get_url_result = get_url_command.run()
 
     if output.suffix == ".zip":
-        urlretrieve(get_url_result["download_url"], output)
+        download_file(get_url_result["download_url"], output, parallelism)
     else:
         with tempfile.TemporaryDirectory() as tmpdir:
             path = os.path.join(tmpdir, 'data.zip')
 
-            urlretrieve(get_url_result["download_url"], path)
+            download_file(get_url_result["download_url"], path, parallelism)
 
             with zipfile.ZipFile(path, 'r') as zf:
                 os.makedirs(output, exist_ok=True)
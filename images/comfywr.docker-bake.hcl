@@ -24,7 +24,8 @@ target "cloud" {
     contexts = {
         local = "target:local",
         root = "${SD_EXPERIMENTS_HOME}/",
-        comfywr-root = "${SD_EXPERIMENTS_HOME}/comfywr"
+        comfywr-root = "${SD_EXPERIMENTS_HOME}/comfywr",
+        images = "."
     }
 
     tags = ["${REPOSITORY}/sd_comfywr:${STAGE}"]
@@ -0,0 +1,249 @@
+# Resident runner of sd_comfywr stage scripts, used by `service/src/queues/resident.py`.
+#
+# Listens on a unix socket, each connection sends one JSON request line:
+#   {"cmd": "run", "argv": [script, *args], "links": {link: target}} - runs script in this process, streams its output
+#   {"cmd": "load", "path": path}                                    - loads weights into cache ahead of time
+#   {"cmd": "unload", "path": path | null}                           - drops weights from cache, all when path is null
+#   {"cmd": "metrics"}                                               - returns cache and run counters
+#
+# Scripts run in-process, so weights loaded through `comfy.utils.load_torch_file` are kept in LRU cache between runs,
+# and modules scripts import are imported once
+
+import os
+import gc
+import sys
+import json
+import time
+import runpy
+import socket
+import argparse
+import threading
+import traceback
+import collections
+
+
+class WeightCache:
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+        self.metrics = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0, "evictions": 0, "evicted_bytes": 0}
+
+    @staticmethod
+    def get_size(state_dict) -> int:
+        if not isinstance(state_dict, dict):
+            return 0
+
+        return sum(value.numel() * value.element_size() for value in state_dict.values() if hasattr(value, 'numel'))
+
+    def get(self, loader, path: str, *args, **kwargs):
+        key = (os.path.realpath(path), os.path.getmtime(path), args, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+                self.metrics["hits"] += 1
+                self.metrics["hit_bytes"] += self.sizes[key]
+
+                # Note: Loaders pop keys from state dicts, so each caller gets its own dict with shared tensors
+                return dict(self.entries[key])
+
+        state_dict = loader(path, *args, **kwargs)
+        size = self.get_size(state_dict)
+
+        with self.lock:
+            self.metrics["misses"] += 1
+            self.metrics["miss_bytes"] += size
+
+            if isinstance(state_dict, dict) and size <= self.budget_bytes:
+                self.entries[key] = dict(state_dict)
+                self.sizes[key] = size
+
+                self.evict(self.budget_bytes)
+
+        return state_dict
+
+    # Note: Least recently used weights are dropped first, only weights of `path` when it's given
+    def evict(self, budget_bytes: int, path: str = None):
+        for key in list(self.entries):
+            if path is not None:
+                if key[0] != os.path.realpath(path):
+                    continue
+            elif sum(self.sizes.values()) <= budget_bytes:
+                break
+
+            del self.entries[key]
+
+            self.metrics["evictions"] += 1
+            self.metrics["evicted_bytes"] += self.sizes.pop(key)
+
+    def unload(self, path: str = None):
+        with self.lock:
+            self.evict(0, path)
+
+        free_device_memory()
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {**self.metrics, "entries": len(self.entries), "cached_bytes": sum(self.sizes.values())}
+
+
+# Note: Worker packs stages onto the device by VRAM they declare, so models and cached allocations of a finished run
+#   are released instead of staying on the device until the next one. Weights stay cached in CPU memory
+def free_device_memory():
+    try:
+        import comfy.model_management
+        comfy.model_management.unload_all_models()
+    except ImportError:
+        pass
+
+    gc.collect()
+
+    try:
+        import torch
+        torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def install_cache(cache: WeightCache) -> bool:
+    try:
+        import comfy.utils
+    except ImportError:
+        traceback.print_exc()
+        return False
+
+    load_torch_file = comfy.utils.load_torch_file
+    comfy.utils.load_torch_file = lambda path, *args, **kwargs: cache.get(load_torch_file, path, *args, **kwargs)
+
+    return True
+
+
+class SocketWriter:
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+
+    def write(self, data: str) -> int:
+        try:
+            self.connection.sendall(data.encode())
+        except OSError:
+            pass
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+def link_workdir(links: dict):
+    for link, target in links.items():
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+
+        if os.path.islink(link) or os.path.isfile(link):
+            os.remove(link)
+        elif os.path.isdir(link):
+            os.rmdir(link)
+
+        os.symlink(target, link)
+
+
+class Server:
+    def __init__(self, cache: WeightCache):
+        self.cache = cache
+
+        self.run_lock = threading.Lock()
+        self.runs = 0
+        self.run_seconds = 0.0
+
+    # Note: Output is marked the same way as cold container logs, so worker detects failures the same way
+    def run(self, connection: socket.socket, argv: list, links: dict):
+        with self.run_lock:
+            writer = SocketWriter(connection)
+            stdout, stderr, sys_argv, sys_path, cwd = sys.stdout, sys.stderr, sys.argv, list(sys.path), os.getcwd()
+
+            start = time.monotonic()
+            try:
+                link_workdir(links)
+
+                sys.stdout = sys.stderr = writer
+                sys.argv = list(argv)
+
+                # Note: Same as for `python script.py`, script directory is the first import location
+                sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+
+                runpy.run_path(argv[0], run_name='__main__')
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    writer.write(f"Script exited with {e.code}\nExitCodeError\n")
+            except BaseException:
+                writer.write(traceback.format_exc())
+            finally:
+                sys.stdout, sys.stderr, sys.argv, sys.path[:] = stdout, stderr, sys_argv, sys_path
+                os.chdir(cwd)
+
+                free_device_memory()
+
+                self.runs += 1
+                self.run_seconds += time.monotonic() - start
+
+    def handle(self, connection: socket.socket):
+        with connection, connection.makefile('r') as reader:
+            try:
+                request = json.loads(reader.readline())
+
+                if request["cmd"] == "run":
+                    self.run(connection, request["argv"], request.get("links", {}))
+                    return
+
+                if request["cmd"] == "load":
+                    import comfy.utils
+                    comfy.utils.load_torch_file(request["path"])
+                elif request["cmd"] == "unload":
+                    self.cache.unload(request.get("path"))
+
+                response = {**self.cache.get_metrics(), "runs": self.runs, "run_seconds": self.run_seconds}
+            except Exception as e:
+                response = {"error": repr(e)}
+
+            connection.sendall((json.dumps(response) + "\n").encode())
+
+    def serve(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(socket_path)
+            server.listen()
+
+            print(f"Listening on {socket_path}", flush=True)
+
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--cache_gb', type=float, default=24)
+    parser.add_argument('--comfyui_path', default='/workdir/ComfyUI')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.comfyui_path)
+
+    cache = WeightCache(int(args.cache_gb * 1024 ** 3))
+    if not install_cache(cache):
+        print("ComfyUI isn't importable, weights won't be cached", flush=True)
+
+    Server(cache).serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# Measures throughput and latency of concurrent database access by server workers and scheduler:
+#   reader processes poll `/check_status` of random jobs, submitter processes create jobs,
+#   and a scheduler process updates step states of all in-flight jobs every tick.
+#   Legacy setup, with rollback journal, default timeout and a commit per write, is compared with WAL and ticks
+#   in phases of the scheduler: reads without a write lock, one short transaction for task states of all jobs,
+#   then dispatches outside of transactions, each written in its own short transaction.
+#   `tick write` reports each write transaction of the scheduler, which is what submitters wait for.
+#
+# Legacy scheduler ticks mostly fail with `database is locked`, counted in `errors`, so legacy submitters barely
+#   compete with the scheduler and their throughput isn't comparable. All jobs advance every tick and submitted jobs
+#   stay in flight, so tuned ticks grow over the run, and so does their task state transaction.
+#
+# Database is a temporary SQLite file, set DATABASE_BACKEND=postgres to measure PostgreSQL from `inventory.compose.yaml`
+#   instead, legacy setup is SQLite only. Run from `service` directory:
+#   PYTHONPATH=src pipenv run python benchmarks/database_concurrency.py
+
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import tempfile
+import contextlib
+import statistics
+import multiprocessing
+
+from peewee import SqliteDatabase, OperationalError
+
+from database import db, Job, JobStatus, StageRun, connection, write_transaction, prefetch_stage_runs
+from routes.check_status import check_status, CheckStatusConfig
+from settings import settings
+
+STEPS = ["cpu.prestage_0", "cpu.stage_0", "cpu.stage_1", "gpu.stage_2", "cpu.cleanup"]
+
+
+def configure(mode: str, path: str):
+    if not isinstance(db, SqliteDatabase):
+        return
+
+    if mode == "legacy":
+        db.init(path, pragmas={'journal_mode': 'delete'})
+    else:
+        db.init(path, timeout=settings.DATABASE_BUSY_TIMEOUT_SECONDS)
+
+
+def transaction(mode: str):
+    return contextlib.nullcontext() if mode == "legacy" else write_transaction()
+
+
+def create_job(mode: str) -> str:
+    with transaction(mode):
+        job = Job.create(
+            id=str(uuid.uuid4()),
+            status=JobStatus.SCHEDULED,
+            total=len(STEPS),
+            steps=json.dumps(STEPS),
+            payload=json.dumps({"texture_processing_resolution": [2560, 2560]}),
+        )
+        job.set_step_states({STEPS[0]: {"status": JobStatus.QUEUED, "queued_at": time.time()}})
+
+    return job.id
+
+
+def read(mode: str, job_ids: list):
+    # Note: Legacy server kept connection of each thread open
+    func = check_status.__wrapped__ if mode == "legacy" else check_status
+    func(CheckStatusConfig(job_id=random.choice(job_ids)))
+
+
+def advance(step_states: dict, job: Job):
+    step = STEPS[len(step_states) - 1]
+
+    if step_states[step]["status"] == JobStatus.SCHEDULED:
+        step_states[step].update({"status": JobStatus.RUNNING, "started_at": time.time()})
+    elif len(step_states) < len(STEPS):
+        step_states[step].update({"status": JobStatus.SUCCEEDED, "finished_at": time.time(), "seconds": 1.0})
+        step_states[STEPS[len(step_states)]] = {"status": JobStatus.QUEUED, "queued_at": time.time()}
+    else:
+        step_states[step].update({"status": JobStatus.SUCCEEDED, "finished_at": time.time()})
+        job.status = JobStatus.SUCCEEDED
+
+    job.progress = sum(step_state["status"] == JobStatus.SUCCEEDED for step_state in step_states.values())
+
+
+def dispatch(step_states: dict, dispatch_seconds: float):
+    # Note: Stands for `apply_async`, which publishes the task to the broker
+    time.sleep(dispatch_seconds)
+
+    step = STEPS[len(step_states) - 1]
+    step_states[step].update({"status": JobStatus.SCHEDULED, "task_id": str(uuid.uuid4()), "scheduled_at": time.time()})
+
+
+@contextlib.contextmanager
+def timed(writes: list):
+    start = time.perf_counter()
+    yield
+    writes.append(time.perf_counter() - start)
+
+
+# Note: Legacy scheduler updated each job in turn, dispatching tasks in the middle of its writes
+def legacy_tick(dispatch_seconds: float, writes: list):
+    for job in Job.select().where(Job.status.in_([JobStatus.SCHEDULED, JobStatus.RUNNING])):
+        step_states = job.get_step_states()
+
+        if step_states[STEPS[len(step_states) - 1]]["status"] == JobStatus.QUEUED:
+            dispatch(step_states, dispatch_seconds)
+        else:
+            advance(step_states, job)
+
+        with timed(writes):
+            job.set_step_states(step_states)
+            job.save()
+
+
+# Note: Mirrors phases of scheduler tick: jobs are read without a write lock, task states of all jobs are applied
+#   in one short transaction, then tasks are dispatched outside of any transaction and each dispatch is written
+#   in its own short transaction
+def tuned_tick(dispatch_seconds: float, writes: list):
+    jobs = list(Job.select().where(Job.status.in_([JobStatus.SCHEDULED, JobStatus.RUNNING])))
+    prefetch_stage_runs(jobs)
+
+    queued = []
+    with timed(writes), write_transaction():
+        for job in jobs:
+            step_states = job.get_step_states()
+
+            if step_states[STEPS[len(step_states) - 1]]["status"] == JobStatus.QUEUED:
+                queued.append((job, step_states))
+                continue
+
+            advance(step_states, job)
+
+            job.set_step_states(step_states)
+            job.save()
+
+    for job, step_states in queued:
+        dispatch(step_states, dispatch_seconds)
+
+        with timed(writes), write_transaction():
+            job.set_step_states(step_states)
+
+
+def tick(mode: str, dispatch_seconds: float, writes: list):
+    if mode == "legacy":
+        legacy_tick(dispatch_seconds, writes)
+    else:
+        tuned_tick(dispatch_seconds, writes)
+
+
+def run_role(role: str, mode: str, path: str, job_ids: list, args, results: multiprocessing.Queue):
+    configure(mode, path)
+
+    latencies = []
+    writes = []
+    errors = 0
+
+    deadline = time.monotonic() + args.seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+
+        try:
+            if role == "reader":
+                read(mode, job_ids)
+            else:
+                # Note: Like scheduler jobs, writers use connection only while they run, legacy ones kept it open
+                with connection() if mode != "legacy" else contextlib.nullcontext():
+                    if role == "submitter":
+                        create_job(mode)
+                    else:
+                        tick(mode, args.dispatch_ms / 1000, writes)
+
+            latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            errors += 1
+
+        if role == "scheduler":
+            time.sleep(0.1)
+
+    # Note: Write transactions of scheduler ticks are reported on their own, these are what other writers wait for
+    results.put([(role, latencies, errors)] + ([("tick write", writes, 0)] if role == "scheduler" else []))
+
+
+def prepare(mode: str, path: str, n_jobs: int) -> list:
+    configure(mode, path)
+
+    with connection():
+        db.drop_tables([Job, StageRun])
+        db.create_tables([Job, StageRun])
+
+        return [create_job(mode) for _ in range(n_jobs)]
+
+
+def measure(mode: str, path: str, args) -> dict:
+    job_ids = prepare(mode, path, args.jobs)
+
+    results = multiprocessing.Queue()
+    roles = ["reader"] * args.readers + ["submitter"] * args.submitters + ["scheduler"]
+
+    processes = [
+        multiprocessing.Process(target=run_role, args=(role, mode, path, job_ids, args, results))
+        for role in roles
+    ]
+    for process in processes:
+        process.start()
+
+    stats = {}
+    for _ in processes:
+        for role, latencies, errors in results.get():
+            role_stats = stats.setdefault(role, {"latencies": [], "errors": 0})
+            role_stats["latencies"] += latencies
+            role_stats["errors"] += errors
+
+    for process in processes:
+        process.join()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', choices=['legacy', 'tuned'], default=['legacy', 'tuned'])
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--submitters', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--dispatch_ms', type=float, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print(f"{'mode':>8} {'role':>10} {'ops/s':>8} {'p50, ms':>8} {'p99, ms':>8} {'errors':>7}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in args.modes:
+            if mode == "legacy" and not isinstance(db, SqliteDatabase):
+                continue
+
+            stats = measure(mode, os.path.join(tmpdir, f"{mode}.db"), args)
+
+            for role, role_stats in stats.items():
+                latencies = sorted(role_stats["latencies"]) or [0.0]
+
+                print(
+                    f"{mode:>8} {role:>10} {len(role_stats['latencies']) / args.seconds:>8.1f} "
+                    f"{statistics.median(latencies) * 1000:>8.1f} {latencies[int(len(latencies) * 0.99)] * 1000:>8.1f} "
+                    f"{role_stats['errors']:>7}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Measures latency of a single scheduler polling tick over active jobs whose tasks are all STARTED,
+#   comparing per-job `AsyncResult.state` reads and saves with the batched status collector.
+#
+# Requires Redis from `inventory.compose.yaml`, database is kept in memory. Run from `service` directory:
+#   PYTHONPATH=src pipenv run python benchmarks/scheduler_tick.py
+
+import json
+import time
+import uuid
+import logging
+import argparse
+import statistics
+
+import celery.result
+
+import queues.cpu
+from cmd import scheduler
+from database import db, Job, JobStatus, StageRun
+
+
+def legacy_tick():
+    for job in Job.select().where(Job.status.in_([JobStatus.SCHEDULED, JobStatus.RUNNING])):
+        job_result = celery.result.AsyncResult(job.get_step_states()["cpu.stage_0"]["task_id"], app=queues.cpu.queue)
+
+        if job_result.state == "STARTED":
+            job.status = JobStatus.RUNNING
+
+        job.save()
+
+
+def batched_tick():
+    scheduler.check_status_of_running_jobs()
+
+
+def prepare(n_jobs: int) -> list:
+    db.drop_tables([Job, StageRun])
+    db.create_tables([Job, StageRun])
+
+    backend = queues.cpu.queue.backend
+
+    task_ids = []
+    with db.atomic():
+        for _ in range(n_jobs):
+            task_id = str(uuid.uuid4())
+            backend.store_result(task_id, None, "STARTED")
+            task_ids.append(task_id)
+
+            job = Job.create(
+                id=str(uuid.uuid4()),
+                status=JobStatus.RUNNING,
+                current_step="cpu.stage_0",
+                total=1,
+                steps=json.dumps(["cpu.stage_0"]),
+                payload="{}",
+            )
+            job.set_step_states({"cpu.stage_0": {"status": JobStatus.RUNNING, "task_id": task_id, "queue": "cpu"}})
+
+    return task_ids
+
+
+def measure(tick, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        tick()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    # Note: Scheduler jobs reuse connection that is already open instead of opening their own,
+    #   so in-memory database stays the same for the whole run
+    db.init(':memory:')
+    db.connect()
+
+    print(f"{'jobs':>6} {'per-job tick, ms':>18} {'batched tick, ms':>18} {'speedup':>8}")
+
+    for n_jobs in args.jobs:
+        task_ids = prepare(n_jobs)
+
+        legacy = measure(legacy_tick, args.repeats)
+        batched = measure(batched_tick, args.repeats)
+
+        print(f"{n_jobs:>6} {legacy:>18.1f} {batched:>18.1f} {legacy / batched:>7.1f}x")
+
+        for task_id in task_ids:
+            queues.cpu.queue.backend.forget(task_id)
+
+
+if __name__ == "__main__":
+    main()
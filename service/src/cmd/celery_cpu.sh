@@ -1,3 +1,5 @@
 #!/usr/bin/env bash
 
-celery -A queues.cpu worker -c 2 --loglevel=INFO
\ No newline at end of file
+# Note: Besides shared queue, worker consumes its node queue, which scheduler uses to route stages
+#   of a job to the node that already holds its data
+celery -A queues.cpu worker -c 2 -Q cpu,cpu.${NODE_NAME:-$(hostname)} --loglevel=INFO
\ No newline at end of file
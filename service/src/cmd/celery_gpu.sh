@@ -1,3 +1,6 @@
 #!/usr/bin/env bash
 
-celery -A queues.gpu worker -c 1 --loglevel=INFO
\ No newline at end of file
+# Note: Besides shared queue, worker consumes its node queue, which scheduler uses to route stages
+#   of a job to the node that already holds its data.
+#   Worker runs a process per GPU slot of the node, see `queues/devices.py`
+celery -A queues.gpu worker -c "$(python -m queues.devices slots)" -Q gpu,gpu.${NODE_NAME:-$(hostname)} --loglevel=INFO
\ No newline at end of file
@@ -1,18 +1,29 @@
+from typing import Dict, List, Optional
+
 import json
+import time
 import logging
+import collections
 import datetime
+import threading
 
 import celery.result
 
 import queues.cpu
 import queues.gpu
 import queues.base
+import memo
+import estimates
 
-from database import db, Job, JobStatus
+import peewee
+from peewee import fn
 
-from apscheduler.schedulers.blocking import BlockingScheduler
+from database import Job, JobStatus, JobPriority, StageRun, prefetch_stage_runs, connection, write_transaction
+from events import JobEventKind, listen_job_events
+from queues.stages import STAGES
+from settings import settings
 
-db.connect()
+from apscheduler.schedulers.blocking import BlockingScheduler
 
 scheduler = BlockingScheduler()
 
@@ -22,14 +33,140 @@ logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
 logger = logging.getLogger("sd_cloud.scheduler")
 
 
-def _start_next_step(job: Job):
-    steps = json.loads(job.steps)
-    step_to_run = steps[job.progress]
+IN_FLIGHT_STATUSES = (JobStatus.SCHEDULED, JobStatus.RUNNING)
+
+PRIORITY_CLASSES = {
+    JobPriority.INTERACTIVE: 8,
+    JobPriority.NORMAL: 5,
+    JobPriority.BATCH: 2,
+}
+
+
+def _get_in_flight_jobs_by_submitter() -> Dict[Optional[str], int]:
+    rows = Job.select(Job.submitter, fn.COUNT(Job.id).alias('count')).where(
+        Job.status.in_(IN_FLIGHT_STATUSES)
+    ).group_by(Job.submitter)
+
+    return {row.submitter: row.count for row in rows}
+
+
+# Note: Broker queues are priority queues, so waiting tasks are served by priority of their job class,
+#   cheap jobs are preferred within a class and submitters with many unfinished jobs yield to the others
+def _get_task_priority(job: Job, in_flight_jobs: Optional[Dict[Optional[str], int]] = None) -> int:
+    if in_flight_jobs is None:
+        in_flight_jobs = _get_in_flight_jobs_by_submitter()
+
+    priority = PRIORITY_CLASSES.get(job.priority, PRIORITY_CLASSES[JobPriority.NORMAL])
+
+    if job.cost <= settings.SHORT_JOB_COST:
+        priority += 1
+
+    priority -= in_flight_jobs.get(job.submitter, 0) // settings.FAIR_SHARE_JOBS
+
+    return min(max(priority, 0), 9)
+
+
+def _select_in_flight_runs(*fields) -> peewee.ModelSelect:
+    return StageRun.select(*fields).join(Job, on=(StageRun.job_id == Job.id)).where(
+        StageRun.status.in_(IN_FLIGHT_STATUSES),
+        Job.status.in_(IN_FLIGHT_STATUSES),
+    )
+
+
+def _get_node_slots(type: str, node: str) -> Optional[int]:
+    worker_slots = _get_worker_slots(type)
+
+    if worker_slots is None:
+        return None
+
+    return worker_slots.get(queues.base.get_node_queue_name(type, node), 0)
+
+
+# Note: Node takes as many routed tasks as live workers consuming its queue have slots, for CPU and GPU nodes alike.
+#   Node that no live worker consumes the queue of, e.g. one that died or was scaled away, is always saturated.
+#   While worker slots are unknown, GPU node is assumed to have one device and CPU node `NODE_AFFINITY_CPU_SLOTS`
+def _is_node_saturated(job: Job, type: str, node: str) -> bool:
+    slots = _get_node_slots(type, node)
+
+    if slots == 0:
+        return True
+
+    if slots is None:
+        slots = settings.GPU_SLOTS_PER_DEVICE if type == "gpu" else settings.NODE_AFFINITY_CPU_SLOTS
+
+    node_queue = queues.base.get_node_queue_name(type, node)
+
+    # Note: Batch task is referenced by each of its jobs, but takes a single slot
+    in_flight = _select_in_flight_runs(StageRun.task_id).where(StageRun.queue == node_queue).distinct().count()
+
+    return in_flight >= slots
+
+
+# Note: Adapter set each GPU node ran last. It's kept in memory only, so after restart it's rebuilt as stages finish
+warm_adapters: Dict[str, str] = {}
+
+
+def _get_adapter_key(job: Job, step: str) -> Optional[str]:
+    if STAGES[step].adapter_fields is None:
+        return None
 
-    job.current_step = step_to_run
     payload = json.loads(job.payload)
 
-    logger.debug(f"Running step {step_to_run}")
+    return json.dumps({name: payload.get(name) for name in STAGES[step].adapter_fields}, sort_keys=True)
+
+
+# Note: Starvation guard, as steps routed to warm nodes would otherwise keep overtaking steps waiting in shared queue.
+#   Oldest step sent to shared queue and not started yet is found by status index of stage runs
+def _is_shared_queue_starving(type: str) -> bool:
+    oldest = StageRun.select(fn.MIN(StageRun.scheduled_at)).join(Job, on=(StageRun.job_id == Job.id)).where(
+        StageRun.status == JobStatus.SCHEDULED,
+        StageRun.queue == type,
+        Job.status.in_(IN_FLIGHT_STATUSES),
+    ).scalar()
+
+    return oldest is not None and oldest < time.time() - settings.LORA_AFFINITY_MAX_WAIT_SECONDS
+
+
+# Note: Node holding job data is preferred among the ones that have the adapter set loaded
+def _select_warm_node(job: Job, step: str) -> Optional[str]:
+    type = step.split('.')[0]
+    adapter_key = _get_adapter_key(job, step)
+
+    nodes = sorted((node for node, key in warm_adapters.items() if key == adapter_key), key=lambda node: node != job.node)
+
+    for node in nodes:
+        if not _is_node_saturated(job, type, node):
+            return node
+
+    return None
+
+
+# Note: Step that loads adapters is routed to the node that has them loaded. Other steps are routed to the node
+#   that already holds job data, so it's reused from local cache.
+#   When that node is busy, step falls back to shared queue and data is moved through storage
+def _select_queue(job: Job, step: str) -> str:
+    type = step.split('.')[0]
+
+    if settings.LORA_AFFINITY and STAGES[step].adapter_fields is not None and not _is_shared_queue_starving(type):
+        node = _select_warm_node(job, step)
+
+        if node is not None:
+            logger.debug(f"Node {node} has adapters of {step} of {job.id} loaded")
+            return queues.base.get_node_queue_name(type, node)
+
+    if not settings.NODE_AFFINITY or job.node is None:
+        return type
+
+    if _is_node_saturated(job, type, job.node):
+        logger.debug(f"Node {job.node} is saturated, falling back to {type} queue")
+        return type
+
+    return queues.base.get_node_queue_name(type, job.node)
+
+
+def _start_step(job: Job, step_to_run: str):
+    job.current_step = step_to_run
+    payload = json.loads(job.payload)
 
     type, cmd = step_to_run.split('.')
 
@@ -38,74 +175,621 @@ def _start_next_step(job: Job):
     except AttributeError:
         raise Exception(f"Unknown step: {step_to_run}")
 
-    job_result: celery.result.AsyncResult = func.delay(payload)
+    queue = _select_queue(job, step_to_run)
 
-    job.celery_job_ids = json.dumps(json.loads(job.celery_job_ids) + [job_result.id])
+    logger.debug(f"Running step {step_to_run} of {job.id} on {queue}")
 
+    job_result: celery.result.AsyncResult = func.apply_async(args=[payload], queue=queue, priority=_get_task_priority(job))
 
-def check_status_of_running_jobs():
-    jobs = Job.select().where(
-        Job.status.in_([JobStatus.SCHEDULED, JobStatus.RUNNING])
+    step_states = job.get_step_states()
+    step_states[step_to_run].update({
+        "status": JobStatus.SCHEDULED,
+        "task_id": job_result.id,
+        "queue": queue,
+        "scheduled_at": time.time(),
+    })
+
+    with write_transaction():
+        job.set_step_states(step_states)
+        job.save()
+
+
+def _get_fingerprint(job: Job, step: str, step_states: Dict[str, dict]) -> Optional[str]:
+    if not settings.STAGE_MEMO:
+        return None
+
+    try:
+        return memo.get_fingerprint(step, json.loads(job.steps), json.loads(job.payload), step_states)
+    except Exception as e:
+        logger.exception(e)
+
+        return None
+
+
+# Note: Memoized step is completed right away by linking outputs of an earlier job with the same fingerprint
+def _link_memoized_step(job: Job, step: str, fingerprint: Optional[str]) -> bool:
+    if fingerprint is None:
+        return False
+
+    try:
+        return memo.link_memo(job.id, step, fingerprint)
+    except Exception as e:
+        logger.exception(e)
+
+        return False
+
+
+# Note: Identical step that is already running for another job, e.g. shared stage of a sibling variant,
+#   is waited for and linked once it's memoized, instead of being run twice
+def _is_running_elsewhere(job: Job, fingerprint: Optional[str]) -> bool:
+    if fingerprint is None:
+        return False
+
+    return StageRun.select().join(Job, on=(StageRun.job_id == Job.id)).where(
+        StageRun.fingerprint == fingerprint,
+        StageRun.status.in_([JobStatus.QUEUED, *IN_FLIGHT_STATUSES]),
+        StageRun.job_id != job.id,
+        Job.status.in_(IN_FLIGHT_STATUSES),
+    ).exists()
+
+
+def _record_memoized_step(job: Job, step: str, step_state: dict):
+    if "fingerprint" not in step_state or step_state.get("memoized"):
+        return
+
+    try:
+        memo.record_memo(job.id, step, step_state["fingerprint"])
+    except Exception as e:
+        logger.exception(e)
+
+
+# Note: Every step whose dependencies have all succeeded is ready at once, so independent stages run in parallel
+#   on different workers. Ready steps are held until their queue has capacity, see `_start_held_steps`.
+#   Linking memoized step may make next steps ready. Fingerprints and memos are read from storage,
+#   so new step states are returned to be written by the caller
+def _get_ready_step_states(job: Job) -> Dict[str, dict]:
+    dependencies = job.get_dependencies()
+    step_states = job.get_step_states()
+
+    progressed = True
+    while progressed:
+        progressed = False
+
+        for step in json.loads(job.steps):
+            if step in step_states:
+                continue
+
+            if not all(step_states.get(parent, {}).get("status") == JobStatus.SUCCEEDED for parent in dependencies[step]):
+                continue
+
+            fingerprint = _get_fingerprint(job, step, step_states)
+
+            if _link_memoized_step(job, step, fingerprint):
+                step_states[step] = {"status": JobStatus.SUCCEEDED, "fingerprint": fingerprint, "memoized": True}
+                progressed = True
+            elif not _is_running_elsewhere(job, fingerprint):
+                step_states[step] = _get_held_step_state(fingerprint)
+
+    return step_states
+
+
+def _is_batched(step: str) -> bool:
+    return settings.STAGE_BATCH_SIZE > 1 and STAGES[step].batch_fields is not None
+
+
+def _get_held_step_state(fingerprint: Optional[str]) -> dict:
+    step_state = {"status": JobStatus.QUEUED, "queued_at": time.time()}
+
+    if fingerprint is not None:
+        step_state["fingerprint"] = fingerprint
+
+    return step_state
+
+
+def _get_batch_key(job: Job, step: str) -> str:
+    payload = json.loads(job.payload)
+
+    return json.dumps({name: payload.get(name) for name in STAGES[step].batch_fields}, sort_keys=True)
+
+
+# Note: Batch is routed by its first job, data of the others is moved through storage if it's on another node
+def _start_batch(step: str, jobs: List[Job]):
+    type, cmd = step.split('.')
+
+    try:
+        func = getattr(getattr(queues, type), f"{cmd}_batch")
+    except AttributeError:
+        raise Exception(f"Unknown batched step: {step}")
+
+    queue = _select_queue(jobs[0], step)
+
+    logger.debug(f"Running step {step} of {len(jobs)} jobs on {queue}")
+
+    in_flight_jobs = _get_in_flight_jobs_by_submitter()
+
+    job_result: celery.result.AsyncResult = func.apply_async(
+        args=[[json.loads(job.payload) for job in jobs]],
+        queue=queue,
+        priority=max(_get_task_priority(job, in_flight_jobs) for job in jobs),
     )
 
+    with write_transaction():
+        for i, job in enumerate(jobs):
+            job.current_step = step
+
+            step_states = job.get_step_states()
+            step_states[step].update({
+                "status": JobStatus.SCHEDULED,
+                "task_id": job_result.id,
+                "queue": queue,
+                "scheduled_at": time.time(),
+                "batch_size": len(jobs),
+                "batch_index": i,
+            })
+            job.set_step_states(step_states)
+            job.save()
+
+
+# Note: Slots of a queue are total concurrency of live workers consuming it, slots of shared and node queues of a type
+#   are inspected together at most every `ADMISSION_CAPACITY_TTL_SECONDS`. Capacity is unlimited while it's unknown,
+#   so failed inspection doesn't stall jobs
+worker_slots: Dict[str, tuple] = {}
+
+
+def _inspect_worker_slots(type: str) -> Dict[str, int]:
+    inspect = _get_step_app(type).control.inspect(timeout=1)
+
+    active_queues = inspect.active_queues() or {}
+    stats = inspect.stats() or {}
+
+    slots = collections.Counter()
+    for worker, worker_queues in active_queues.items():
+        if worker not in stats:
+            continue
+
+        for worker_queue in worker_queues:
+            slots[worker_queue["name"]] += stats[worker]["pool"]["max-concurrency"]
+
+    return dict(slots)
+
+
+def _get_worker_slots(type: str) -> Optional[Dict[str, int]]:
+    checked_at, slots = worker_slots.get(type, (None, None))
+
+    if checked_at is None or time.monotonic() - checked_at >= settings.ADMISSION_CAPACITY_TTL_SECONDS:
+        try:
+            slots = _inspect_worker_slots(type)
+        except Exception as e:
+            logger.exception(e)
+
+        worker_slots[type] = (time.monotonic(), slots)
+
+    return slots
+
+
+def _get_queue_capacity(type: str) -> Optional[int]:
+    if settings.ADMISSION_TASKS_PER_SLOT <= 0:
+        return None
+
+    slots = _get_worker_slots(type)
+
+    return slots.get(type, 0) * settings.ADMISSION_TASKS_PER_SLOT if slots is not None else None
+
+
+# Note: Batch is only worth waiting for while workers are busy, partial batch is dispatched right away
+#   when its queue has a free worker slot, or when slots are unknown
+def _has_free_slot(type: str, in_flight: Dict[str, int]) -> bool:
+    slots = _get_worker_slots(type)
+
+    return slots is None or in_flight.get(type, 0) < slots.get(type, 0)
+
+
+def _get_held_units(in_flight: Dict[str, int]) -> List[tuple]:
+    in_flight_jobs = _get_in_flight_jobs_by_submitter()
+
+    units = []
+    groups = collections.defaultdict(list)
+    jobs = list(Job.select().where(
+        Job.status.in_(IN_FLIGHT_STATUSES),
+        Job.id.in_(StageRun.select(StageRun.job_id).where(StageRun.status == JobStatus.QUEUED)),
+    ))
+    prefetch_stage_runs(jobs)
+
     for job in jobs:
+        for step, step_state in job.get_step_states().items():
+            if step_state["status"] != JobStatus.QUEUED:
+                continue
+
+            if _is_batched(step):
+                groups[(step, _get_batch_key(job, step))].append((step_state["queued_at"], job))
+            else:
+                units.append((_get_task_priority(job, in_flight_jobs), step_state["queued_at"], step, [job]))
+
+    now = time.time()
+    for (step, _), held in groups.items():
+        held.sort(key=lambda item: item[0])
+
+        for i in range(0, len(held), settings.STAGE_BATCH_SIZE):
+            batch = held[i:i + settings.STAGE_BATCH_SIZE]
+
+            if (
+                len(batch) < settings.STAGE_BATCH_SIZE
+                and now - batch[0][0] < settings.STAGE_BATCH_WAIT_SECONDS
+                and not _has_free_slot(step.split('.')[0], in_flight)
+            ):
+                break
+
+            units.append((max(_get_task_priority(job, in_flight_jobs) for _, job in batch), batch[0][0], step, [job for _, job in batch]))
+
+    return units
+
+
+def _count_in_flight_tasks() -> Dict[str, int]:
+    task_ids = collections.defaultdict(set)
+    for step, task_id in _select_in_flight_runs(StageRun.step, StageRun.task_id).tuples():
+        task_ids[step.split('.')[0]].add(task_id)
+
+    return {type: len(ids) for type, ids in task_ids.items()}
+
+
+# Note: Held steps are dispatched by task priority while their queue has fewer in-flight tasks than its capacity allows,
+#   the rest wait in database, so broker queues stay short and priority of waiting steps is applied as soon as
+#   capacity frees up. Batched steps are grouped by step and payload fields they must share, a group is dispatched
+#   once it fills a batch, its queue has a free worker slot or its oldest step waited for `STAGE_BATCH_WAIT_SECONDS`.
+#   Tasks are sent outside of transactions, rows of each dispatched unit are written in a transaction of their own
+def _start_held_steps():
+    in_flight = _count_in_flight_tasks()
+    units = _get_held_units(in_flight)
+
+    if len(units) == 0:
+        return
+
+    units.sort(key=lambda unit: (-unit[0], unit[1]))
+
+    for _, _, step, jobs in units:
+        type = step.split('.')[0]
+
+        capacity = _get_queue_capacity(type)
+        if capacity is not None and in_flight.get(type, 0) >= capacity:
+            continue
+
         try:
-            id = json.loads(job.celery_job_ids)[-1]
-            if job.current_step.startswith("gpu"):
-                queue = queues.gpu.queue
+            if _is_batched(step):
+                _start_batch(step, jobs)
+            else:
+                _start_step(jobs[0], step)
+
+            in_flight[type] = in_flight.get(type, 0) + 1
+        except Exception as e:
+            logger.exception(e)
+
+            with write_transaction():
+                for job in jobs:
+                    job.status = JobStatus.FAILED
+                    job.save()
+
+
+def _update_progress(job: Job, step_states: Dict[str, dict]):
+    statuses = [step_state["status"] for step_state in step_states.values()]
+
+    job.progress = statuses.count(JobStatus.SUCCEEDED)
+
+    if JobStatus.FAILED in statuses:
+        job.status = JobStatus.FAILED
+    elif job.progress >= job.total:
+        job.status = JobStatus.SUCCEEDED
+    elif JobStatus.RUNNING in statuses:
+        job.status = JobStatus.RUNNING
+    else:
+        job.status = JobStatus.SCHEDULED
+
+
+def _get_step_app(step: str) -> celery.Celery:
+    if step.startswith("gpu"):
+        return queues.gpu.queue
+    else:
+        return queues.cpu.queue
+
+
+def _get_in_flight_steps(job: Job) -> Dict[str, dict]:
+    return {
+        step: step_state
+        for step, step_state in job.get_step_states().items()
+        if step_state["status"] in IN_FLIGHT_STATUSES
+    }
+
+
+# Note: States of all tasks are read from result backend with a single multi-get per queue,
+#   instead of a separate round trip per job
+def _get_task_states(jobs: List[Job]) -> Dict[str, dict]:
+    task_ids_by_app = collections.defaultdict(list)
+    for job in jobs:
+        for step, step_state in _get_in_flight_steps(job).items():
+            task_ids_by_app[_get_step_app(step)].append(step_state["task_id"])
+
+    states = {}
+    for app, task_ids in task_ids_by_app.items():
+        values = app.backend.mget([app.backend.get_key_for_task(task_id) for task_id in task_ids])
+
+        for task_id, value in zip(task_ids, values):
+            if value is None:
+                states[task_id] = {"status": "PENDING", "result": None, "traceback": None}
             else:
-                queue = queues.cpu.queue
+                states[task_id] = app.backend.decode_result(value)
+
+    return states
+
+
+def _is_stranded(step_state: dict) -> bool:
+    return (
+        step_state["status"] == JobStatus.SCHEDULED
+        and '.' in step_state.get("queue", "")
+        and time.time() - step_state.get("scheduled_at", time.time()) >= settings.NODE_AFFINITY_MAX_WAIT_SECONDS
+    )
 
-            job_result = celery.result.AsyncResult(id, app=queue)
 
-            job_state = job_result.state
+# Note: Task routed to a node that didn't start it in time is revoked, in case the node comes back, and its step
+#   is held again. The node isn't preferred anymore, so the step is sent to shared queue
+def _requeue_stranded_step(job: Job, step: str, step_state: dict) -> dict:
+    node = step_state["queue"].split('.', 1)[1]
 
-            if job_state == "STARTED":
-                job.status = JobStatus.RUNNING
-            elif job_state == "FAILURE":
-                job.status = JobStatus.FAILED
+    logger.warning(f"Node {node} didn't start {step} of {job.id}, sending it to shared queue")
 
-                if isinstance(job_result.info, queues.base.LogException):
-                    job.logs = job_result.info.logs
+    if job.node == node:
+        job.node = None
+    warm_adapters.pop(node, None)
 
-                logger.error(job_result.traceback)
-            elif job_state == "SUCCESS":
-                job_result.forget()
+    requeued = {"status": JobStatus.QUEUED, "queued_at": step_state.get("queued_at", time.time())}
 
-                job.progress += 1
-                job.status = JobStatus.SCHEDULED
+    if "fingerprint" in step_state:
+        requeued["fingerprint"] = step_state["fingerprint"]
 
-                if job.progress >= job.total:
-                    job.status = JobStatus.SUCCEEDED
+    return requeued
+
+
+def _save_if_changed(job: Job, before: dict):
+    if job.__data__ != before:
+        job.save()
+
+
+# Note: Steps of the job are moved to states of their tasks. Only rows are changed, finished and stranded tasks
+#   are returned, so storage, result backend and broker are called for them once the transaction is committed
+def _apply_task_states(job: Job, states: Dict[str, dict]) -> List[tuple]:
+    before = dict(job.__data__)
+    transitions = []
+
+    try:
+        step_states = job.get_step_states()
+
+        for step, step_state in _get_in_flight_steps(job).items():
+            task_id = step_state["task_id"]
+            state = states[task_id]
+            task_state = state["status"]
+
+            if task_state == "PENDING" and _is_stranded(step_state):
+                step_state = _requeue_stranded_step(job, step, step_state)
+                transitions.append((step, task_id, task_state, step_state))
+            elif task_state == "STARTED":
+                step_state["status"] = JobStatus.RUNNING
+                step_state.setdefault("started_at", time.time())
+            elif task_state == "FAILURE":
+                step_state["status"] = JobStatus.FAILED
+                step_state["finished_at"] = time.time()
+
+                if isinstance(state["result"], queues.base.LogException):
+                    job.logs = state["result"].logs
+
+                logger.error(state["traceback"])
+            elif task_state == "SUCCESS":
+                result = state["result"] if isinstance(state["result"], dict) else {}
+                job.node = result.get("node")
+
+                step_state["node"] = job.node
+                step_state["finished_at"] = time.time()
+
+                job_result = result.get("results", {}).get(job.id, {"status": "SUCCESS"})
+
+                if job_result["status"] == "FAILURE":
+                    step_state["status"] = JobStatus.FAILED
+                    job.logs = job_result.get("logs")
+
+                    logger.error(job_result.get("logs"))
                 else:
-                    _start_next_step(job)
+                    step_state["status"] = JobStatus.SUCCEEDED
+                    step_state.update(estimates.get_run_fields(job, job_result if "results" in result else result))
+
+                if job.node is not None and (adapter_key := _get_adapter_key(job, step)) is not None:
+                    warm_adapters[job.node] = adapter_key
 
+                if "serial_seconds" in result and step_state.get("batch_index") == 0:
+                    logger.info(
+                        f"Batch {step_state['task_id']} of {step_state['batch_size']} jobs took {result['seconds']:.1f}s, "
+                        f"{result['serial_seconds'] / result['seconds']:.2f}x throughput of serial runs"
+                    )
+
+                transitions.append((step, task_id, task_state, step_state))
+
+            step_states[step] = step_state
+
+        job.set_step_states(step_states)
+
+    except Exception as e:
+        logger.exception(e)
+
+        job.status = JobStatus.FAILED
+    finally:
+        _save_if_changed(job, before)
+
+    return transitions
+
+
+def _finish_transitions(job: Job, transitions: List[tuple]):
+    for step, task_id, task_state, step_state in transitions:
+        try:
+            if task_state == "PENDING":
+                celery.result.AsyncResult(task_id, app=_get_step_app(step)).revoke()
+                continue
+
+            # Note: Batch task result is shared by all jobs of the batch, so it's left to expire instead
+            if "batch_size" not in step_state:
+                _get_step_app(step).backend.forget(task_id)
+
+            if step_state["status"] == JobStatus.SUCCEEDED:
+                _record_memoized_step(job, step, step_state)
         except Exception as e:
             logger.exception(e)
 
-            job.status = JobStatus.FAILED
-        finally:
+
+# Note: Ready steps are found outside of transactions, as fingerprints and memos are read from storage,
+#   then the job and its new step runs are written together. Job that didn't change doesn't take the write lock
+def _advance_job(job: Job):
+    before = dict(job.__data__)
+
+    try:
+        step_states = job.get_step_states()
+
+        if JobStatus.FAILED not in [step_state["status"] for step_state in step_states.values()]:
+            step_states = _get_ready_step_states(job)
+
+        _update_progress(job, step_states)
+
+        if step_states == job.get_step_states() and job.__data__ == before:
+            return
+
+        with write_transaction():
+            job.set_step_states(step_states)
             job.save()
 
+    except Exception as e:
+        logger.exception(e)
 
-def check_for_new_jobs():
-    jobs = Job.select().where(
-        Job.status == JobStatus.QUEUED
-    )
+        job.status = JobStatus.FAILED
+        job.save()
+
+
+# Note: Transitions of all jobs are written in a single transaction, memos of finished steps are recorded
+#   before any job is advanced, so jobs waiting for an identical step link its outputs instead of running it again
+def _update_running_jobs(jobs: List[Job], states: Dict[str, dict]):
+    with write_transaction():
+        transitions = {job.id: _apply_task_states(job, states) for job in jobs}
 
     for job in jobs:
-        try:
-            job.status = JobStatus.SCHEDULED
+        _finish_transitions(job, transitions[job.id])
+
+    for job in jobs:
+        if job.status != JobStatus.FAILED:
+            _advance_job(job)
+
 
-            _start_next_step(job)
+# Note: Jobs are updated both by event listener and by polling, which run in different threads
+jobs_lock = threading.Lock()
+
+
+# Note: Only rows whose state actually changed are written. Write lock is only taken for row updates,
+#   never while task states are read, tasks are sent or storage is accessed.
+#   Each scheduler job uses connection of its thread only while it runs
+@connection()
+def check_status_of_running_jobs():
+    with jobs_lock:
+        jobs = list(Job.select().where(
+            Job.status.in_(IN_FLIGHT_STATUSES)
+        ))
+        prefetch_stage_runs(jobs)
+
+        try:
+            states = _get_task_states(jobs)
         except Exception as e:
             logger.exception(e)
+            return
 
-            job.status = JobStatus.FAILED
-        finally:
-            job.save()
+        _update_running_jobs(jobs, states)
+        _start_held_steps()
+
+
+@connection()
+def check_held_steps():
+    with jobs_lock:
+        _start_held_steps()
+
+
+# Note: New jobs are admitted by priority class, then round-robin across submitters by their unfinished jobs,
+#   then cheapest first, instead of table order
+def _get_admission_order(jobs: List[Job]) -> List[Job]:
+    in_flight_jobs = _get_in_flight_jobs_by_submitter()
+    ranks = {priority: rank for rank, priority in enumerate(PRIORITY_CLASSES)}
+
+    ordered = []
+    waiting = list(jobs)
+    while waiting:
+        job = min(waiting, key=lambda job: (
+            ranks.get(job.priority, ranks[JobPriority.NORMAL]),
+            in_flight_jobs.get(job.submitter, 0),
+            job.cost,
+            job.created_at,
+        ))
+
+        waiting.remove(job)
+        ordered.append(job)
+
+        in_flight_jobs[job.submitter] = in_flight_jobs.get(job.submitter, 0) + 1
+
+    return ordered
+
+
+@connection()
+def check_for_new_jobs():
+    with jobs_lock:
+        jobs = list(Job.select().where(
+            Job.status == JobStatus.QUEUED
+        ))
+
+        for job in _get_admission_order(jobs):
+            _advance_job(job)
 
+        _start_held_steps()
 
+
+def _get_event_task_states(job: Job, kind: str, task_id: Optional[str]) -> Dict[str, dict]:
+    states = _get_task_states([job])
+
+    # Note: Task sends started event before its state is stored, so state of the task is taken from the event instead
+    if kind == JobEventKind.STARTED and states.get(task_id, {}).get("status") == "PENDING":
+        states[task_id] = {**states[task_id], "status": "STARTED"}
+
+    return states
+
+
+# Note: Only the job event refers to is updated, so stage transitions don't wait for the next poll
+@connection()
+def on_job_event(job_id: str, kind: str, task_id: Optional[str] = None):
+    logger.debug(f"Got {kind} event of {job_id}")
+
+    with jobs_lock:
+        job = Job.get_or_none(Job.id == job_id)
+
+        if job is None:
+            return
+
+        if job.status == JobStatus.QUEUED:
+            _advance_job(job)
+        elif job.status in IN_FLIGHT_STATUSES:
+            _update_running_jobs([job], _get_event_task_states(job, kind, task_id))
+
+        # Note: Sibling variants may wait for a shared step of this job, so they continue right away instead of on next poll
+        if job.group_id is not None:
+            siblings = list(Job.select().where(
+                Job.group_id == job.group_id,
+                Job.id != job.id,
+                Job.status.in_(IN_FLIGHT_STATUSES),
+            ))
+
+            prefetch_stage_runs(siblings)
+            _update_running_jobs(siblings, _get_task_states(siblings))
+
+        _start_held_steps()
+
+
+@connection()
 def delete_old_jobs():
     jobs = Job.select().where(
         Job.status != JobStatus.SCHEDULED,
@@ -119,10 +803,16 @@ def delete_old_jobs():
             logger.exception(e)
 
 
-scheduler.add_job(check_status_of_running_jobs, 'interval', seconds=2, max_instances=1, coalesce=True)
-scheduler.add_job(check_for_new_jobs, 'interval', seconds=2, max_instances=1, coalesce=True)
+scheduler.add_job(check_status_of_running_jobs, 'interval', seconds=settings.SCHEDULER_POLL_INTERVAL_SECONDS,
+                  max_instances=1, coalesce=True)
+scheduler.add_job(check_for_new_jobs, 'interval', seconds=settings.SCHEDULER_POLL_INTERVAL_SECONDS,
+                  max_instances=1, coalesce=True)
+if settings.STAGE_BATCH_SIZE > 1:
+    scheduler.add_job(check_held_steps, 'interval', seconds=1, max_instances=1, coalesce=True)
 scheduler.add_job(delete_old_jobs, 'interval', hours=2, max_instances=1, coalesce=True,
                   next_run_time=datetime.datetime.now())
 
 if __name__ == "__main__":
+    threading.Thread(target=listen_job_events, args=(on_job_event,), name="job-events", daemon=True).start()
+
     scheduler.start()
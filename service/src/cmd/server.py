@@ -7,7 +7,7 @@ from starlette import status
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
 
-from database import db, Job
+from database import connection
 from database import run_migrations
 from settings import settings, Environment
 
@@ -15,14 +15,14 @@ from routes.schedule_job import router as schedule_job_router
 from routes.download_result import router as download_result_router
 from routes.check_status import router as check_status_router
 from routes.cancel_job import router as cancel_job_router
+from routes.estimate_job import router as estimate_job_router
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    db.connect()
-    run_migrations()
+    with connection():
+        run_migrations()
 
     yield
-    db.close()
 
 
 app = FastAPI(
@@ -34,6 +34,7 @@ app.include_router(schedule_job_router)
 app.include_router(download_result_router)
 app.include_router(check_status_router)
 app.include_router(cancel_job_router)
+app.include_router(estimate_job_router)
 
 logger = logging.getLogger("sd_cloud.server")
 
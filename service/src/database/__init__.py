@@ -1,3 +1,5 @@
-from .db import db
-from .job import Job, JobStatus
+from .db import db, connection, write_transaction, lock_keys
+from .job import Job, JobStatus, JobPriority, prefetch_stage_runs
+from .stage_memo import StageMemo
+from .stage_run import StageRun
 from .migrator import run_migrations
\ No newline at end of file
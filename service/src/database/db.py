@@ -1,10 +1,87 @@
-from peewee import SqliteDatabase, Model
+from typing import List
 
-from settings import settings
+import contextlib
 
-db = SqliteDatabase(settings.DATABASE_URL)
+from peewee import Database, SqliteDatabase, Model
+from playhouse.db_url import parse
+
+from settings import settings, DatabaseBackend
+
+
+# Note: Server workers and scheduler are separate processes writing the same database. SQLite runs in WAL mode,
+#   so reads don't wait for writes, and writers wait for the lock instead of failing right away.
+#   Each thread uses its own connection, PostgreSQL connections are taken from a pool of each process
+def _make_database() -> Database:
+    if settings.DATABASE_BACKEND == DatabaseBackend.POSTGRES:
+        from playhouse.pool import PooledPostgresqlDatabase
+
+        return PooledPostgresqlDatabase(
+            **parse(settings.DATABASE_POSTGRES_URL),
+            max_connections=settings.DATABASE_POOL_SIZE,
+            stale_timeout=settings.DATABASE_POOL_STALE_SECONDS,
+            timeout=settings.DATABASE_POOL_TIMEOUT_SECONDS,
+        )
+
+    return SqliteDatabase(
+        settings.DATABASE_URL,
+        timeout=settings.DATABASE_BUSY_TIMEOUT_SECONDS,
+        pragmas={
+            'journal_mode': 'wal',
+            'busy_timeout': int(settings.DATABASE_BUSY_TIMEOUT_SECONDS * 1000),
+            'synchronous': 'normal',
+        },
+    )
+
+
+db = _make_database()
 
 
 class BaseModel(Model):
     class Meta:
         database = db
+        only_save_dirty = True
+
+
+# Note: Connection of the current thread is opened for the duration of a request or scheduler job and then closed,
+#   which returns it to the pool. Connection that was already open, e.g. by the caller, is kept
+@contextlib.contextmanager
+def connection():
+    opened = db.connect(reuse_if_open=True)
+
+    try:
+        yield
+    finally:
+        if opened:
+            db.close()
+
+
+# Note: SQLite transaction that reads before it writes can't wait for the lock once another process has written
+#   since its read, so write lock is taken upfront. PostgreSQL locks rows as they are written
+def write_transaction():
+    if isinstance(db, SqliteDatabase):
+        return db.atomic('IMMEDIATE')
+
+    return db.atomic()
+
+
+# Note: Write transactions that look a key up before inserting it are serialized by the key. SQLite write transaction
+#   already holds the database lock, on PostgreSQL the key is locked until the transaction ends.
+#   Keys are locked in order, so transactions locking several of them don't deadlock
+def lock_keys(keys: List[str]):
+    if isinstance(db, SqliteDatabase):
+        return
+
+    for key in sorted(set(keys)):
+        db.execute_sql("SELECT pg_advisory_xact_lock(hashtext(%s))", (key,))
+
+
+# Note: Only one process at a time applies migrations
+@contextlib.contextmanager
+def migration_lock():
+    if isinstance(db, SqliteDatabase):
+        with db.atomic('EXCLUSIVE'):
+            yield
+    else:
+        with db.atomic():
+            db.execute_sql("SELECT pg_advisory_xact_lock(hashtext('sd_cloud.migrations'))")
+            yield
@@ -1,9 +1,13 @@
+from typing import Dict, List
+
 import enum
+import json
 import datetime
 
-from peewee import CharField, IntegerField, TextField, DateTimeField
+from peewee import CharField, IntegerField, FloatField, TextField, DateTimeField
 
 from .db import BaseModel
+from .stage_run import StageRun, REVOKED
 
 
 class JobStatus(str, enum.Enum):
@@ -15,6 +19,13 @@ class JobStatus(str, enum.Enum):
     FAILED = "FAILED"
 
 
+# Note: Interactive previews go ahead of regular jobs, batch renders and sweeps run when nothing else waits
+class JobPriority(str, enum.Enum):
+    INTERACTIVE = "interactive"
+    NORMAL = "normal"
+    BATCH = "batch"
+
+
 class Job(BaseModel):
     id = CharField(primary_key=True, unique=True)
 
@@ -22,8 +33,6 @@ class Job(BaseModel):
 
     status = CharField(default=JobStatus.QUEUED, index=True)
 
-    celery_job_ids = TextField(default="[]", null=False)
-
     progress = IntegerField(default=0)
     total = IntegerField()
 
@@ -34,3 +43,85 @@ class Job(BaseModel):
 
     logs = TextField(default=None, null=True)
 
+    # Note: Node that holds data of the job after last finished stage
+    node = TextField(default=None, null=True)
+
+    # Note: Variants submitted together share the group, which is the id of the first of them
+    group_id = TextField(default=None, null=True, index=True)
+
+    # Note: Fingerprint of inputs and parameters, identical submissions attach to the unfinished job with the same one
+    fingerprint = TextField(default=None, null=True, index=True)
+
+    # Note: Number of submissions attached to the job, it's cancelled once each of them cancelled it
+    attachments = IntegerField(default=1)
+
+    priority = CharField(default=JobPriority.NORMAL)
+
+    # Note: Jobs of a submitter with many unfinished jobs yield to jobs of other submitters
+    submitter = TextField(default=None, null=True, index=True)
+
+    # Note: Relative cost of the job estimated from its parameters, cheaper jobs go first within a priority class
+    cost = FloatField(default=1.0)
+
+    # Note: Total size of uploaded meshes in bytes, one of cost parameters stage durations are estimated from
+    input_size = IntegerField(default=0)
+
+    # Note: Maps step to steps it depends on, steps whose dependencies succeeded are run in parallel
+    dependencies = TextField(default="{}", null=False)
+
+    def get_dependencies(self) -> Dict[str, List[str]]:
+        dependencies = json.loads(self.dependencies)
+
+        # Note: Jobs created before dependencies were introduced run their steps in sequence
+        if len(dependencies) == 0:
+            steps = json.loads(self.steps)
+            dependencies = {step: steps[i - 1:i] for i, step in enumerate(steps)}
+
+        return dependencies
+
+    def _get_stage_runs(self) -> Dict[str, StageRun]:
+        if self.__dict__.get("_stage_runs") is None:
+            prefetch_stage_runs([self])
+
+        return self._stage_runs
+
+    # Note: Maps dispatched step to state of its latest run, see `StageRun`
+    def get_step_states(self) -> Dict[str, dict]:
+        return {step: stage_run.get_state() for step, stage_run in self._get_stage_runs().items()}
+
+    # Note: Runs of changed steps are written right away, in transaction of the caller if there is one.
+    #   Step that was dispatched and is held or dispatched again, e.g. after its node didn't start it, gets a new attempt,
+    #   so earlier attempts stay in history. Unfinished earlier attempt is marked revoked
+    def set_step_states(self, step_states: Dict[str, dict]):
+        stage_runs = self._get_stage_runs()
+
+        for step, step_state in step_states.items():
+            stage_run = stage_runs.get(step)
+
+            if stage_run is not None and stage_run.get_state() == step_state:
+                continue
+
+            if stage_run is None:
+                stage_run = StageRun(job_id=self.id, step=step)
+            elif stage_run.task_id is not None and step_state.get("task_id") != stage_run.task_id:
+                if stage_run.status in (JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.RUNNING):
+                    stage_run.status = REVOKED
+                    stage_run.save()
+
+                stage_run = StageRun(job_id=self.id, step=step, attempt=stage_run.attempt + 1)
+
+            stage_run.set_state(step_state)
+            stage_run.save()
+
+            stage_runs[step] = stage_run
+
+
+# Note: Runs of many jobs are read with a single query, instead of one per job
+def prefetch_stage_runs(jobs: List[Job]):
+    stage_runs = {job.id: {} for job in jobs}
+
+    for stage_run in StageRun.select().where(StageRun.job_id.in_(list(stage_runs))).order_by(StageRun.attempt):
+        stage_runs[stage_run.job_id][stage_run.step] = stage_run
+
+    for job in jobs:
+        job._stage_runs = stage_runs[job.id]
@@ -1,21 +1,168 @@
-from playhouse.migrate import SqliteMigrator, migrate
+from typing import Dict, List
 
-from database.db import db
-from database.job import Job
+import json
+import logging
+import datetime
 
-migrator = SqliteMigrator(db)
+from peewee import IntegerField, DateTimeField, Field, fn
+from playhouse.migrate import SchemaMigrator, migrate, make_index_name
 
+from database.db import db, BaseModel, migration_lock
+from database.job import Job, JobStatus
+from database.stage_memo import StageMemo
+from database.stage_run import StageRun
 
-def run_migrations():
-    try:
+logger = logging.getLogger("sd_cloud.database")
+
+migrator = SchemaMigrator.from_database(db)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    applied_at = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        table_name = 'schema_version'
+
+
+def _get_columns(table: str) -> List[str]:
+    return [column.name for column in db.get_columns(table)]
+
+
+def _without_index(field: Field) -> Field:
+    field = field.clone()
+    field.index = False
+
+    return field
+
+
+# Note: Columns are added before their indexes. SQLite takes unknown column of an index for a string literal,
+#   so index that earlier versions created before its column existed is broken, it's dropped and created again
+def _add_missing_columns(table: str, fields: List[Field], indexed: List[str]):
+    columns = _get_columns(table)
+    indexes = [index.name for index in db.get_indexes(table)]
+
+    added = [field for field in fields if field.column_name not in columns]
+
+    operations = [migrator.add_column(table, field.column_name, _without_index(field)) for field in added]
+
+    for field in added:
+        if field.column_name not in indexed:
+            continue
+
+        if (name := make_index_name(table, [field.column_name])) in indexes:
+            operations.append(migrator.drop_index(table, name))
+
+        operations.append(migrator.add_index(table, (field.column_name,)))
+
+    migrate(*operations)
+
+
+# Note: Schema as it was before migrations were versioned, columns were added to existing databases
+#   as features were introduced, so only missing ones are added. Existing table isn't created again,
+#   which would create indexes of the current model before their columns exist
+def _create_initial_schema():
+    if db.table_exists(Job._meta.table_name):
+        _add_missing_columns(Job._meta.table_name, [
+            Job.logs, Job.node, Job.dependencies, Job.group_id, Job.fingerprint,
+            Job.priority, Job.submitter, Job.cost, Job.input_size,
+        ], indexed=[Job.group_id.column_name, Job.fingerprint.column_name, Job.submitter.column_name])
+    else:
         db.create_tables([Job])
-        with db.atomic():
-            migrate(
-                migrator.add_column(
-                    Job._meta.table_name,
-                    Job.logs.column_name,
-                    Job.logs
-                )
-            )
-    except:
-        pass
\ No newline at end of file
+
+    db.create_tables([StageMemo])
+
+
+def _get_legacy_step_states(row: dict) -> Dict[str, dict]:
+    step_states = json.loads(row.get("step_states") or "{}")
+
+    # Note: Jobs dispatched before step states were introduced only track their current step
+    celery_job_ids = json.loads(row.get("celery_job_ids") or "[]")
+    if len(step_states) == 0 and len(celery_job_ids) > 0:
+        steps = json.loads(row["steps"])
+
+        step_states = {step: {"status": JobStatus.SUCCEEDED} for step in steps[:row["progress"]]}
+        if row["progress"] < len(steps):
+            step_states[steps[row["progress"]]] = {
+                "status": row["status"],
+                "task_id": celery_job_ids[-1],
+                "queue": steps[row["progress"]].split('.')[0],
+            }
+
+    for step_state in step_states.values():
+        if "batch" in step_state:
+            batch = step_state.pop("batch")
+
+            step_state["batch_size"] = len(batch)
+            step_state["batch_index"] = batch.index(row["id"]) if row["id"] in batch else None
+
+    return step_states
+
+
+# Note: Step states and celery task ids of jobs, and stage timings, are moved from JSON columns and their own table
+#   to stage runs
+def _create_stage_runs():
+    db.create_tables([StageRun])
+
+    table = Job._meta.table_name
+    columns = [column for column in ("id", "steps", "status", "progress", "celery_job_ids", "step_states") if column in _get_columns(table)]
+
+    cursor = db.execute_sql(f"SELECT {', '.join(columns)} FROM {table}")
+    for values in cursor.fetchall():
+        row = dict(zip(columns, values))
+
+        for step, step_state in _get_legacy_step_states(row).items():
+            stage_run = StageRun(job_id=row["id"], step=step)
+            stage_run.set_state(step_state)
+            stage_run.save()
+
+    if db.table_exists('stagetiming'):
+        cursor = db.execute_sql(
+            "SELECT job_id, step, node, seconds, download_seconds, container_seconds, upload_seconds, features, created_at "
+            "FROM stagetiming"
+        )
+        for job_id, step, node, *timings, features, created_at in cursor.fetchall():
+            stage_run = StageRun.get_or_none(StageRun.job_id == job_id, StageRun.step == step)
+
+            if stage_run is None:
+                stage_run = StageRun(job_id=job_id, step=step, status=JobStatus.SUCCEEDED)
+
+            stage_run.node = node
+            stage_run.seconds, stage_run.download_seconds, stage_run.container_seconds, stage_run.upload_seconds = timings
+            stage_run.features = features
+            stage_run.finished_at = datetime.datetime.fromisoformat(str(created_at)).replace(tzinfo=datetime.timezone.utc).timestamp()
+            stage_run.save()
+
+        db.execute_sql("DROP TABLE stagetiming")
+
+    migrate(*[
+        migrator.drop_column(table, column)
+        for column in ("celery_job_ids", "step_states")
+        if column in columns
+    ])
+
+
+def _add_job_attachments():
+    _add_missing_columns(Job._meta.table_name, [Job.attachments], indexed=[])
+
+
+MIGRATIONS = [
+    _create_initial_schema,
+    _create_stage_runs,
+    _add_job_attachments,
+]
+
+
+# Note: Each migration is applied once and in order, version of the schema is stored in the database.
+#   Migrations run in a single locked transaction, so servers starting at the same time don't apply them twice
+def run_migrations():
+    with migration_lock():
+        db.create_tables([SchemaVersion])
+
+        version = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info(f"Applying migration {i}: {migration.__name__}")
+
+            migration()
+            SchemaVersion.create(version=i)
@@ -0,0 +1,19 @@
+import datetime
+
+from peewee import CharField, IntegerField, TextField, DateTimeField
+
+from .db import BaseModel
+
+
+class StageMemo(BaseModel):
+    fingerprint = CharField(primary_key=True, unique=True)
+
+    step = CharField()
+
+    # Note: Maps output layer to its manifest, with paths relative to the layer directory
+    layers = TextField()
+
+    size = IntegerField()
+
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    last_used_at = DateTimeField(default=datetime.datetime.utcnow, index=True)
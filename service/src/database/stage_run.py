@@ -0,0 +1,66 @@
+from peewee import CharField, IntegerField, FloatField, TextField, BooleanField
+
+from .db import BaseModel
+
+
+# Note: Run of a job's step, the latest attempt is the state of the step. Rows outlive their jobs,
+#   so throughput and latency of stages can be queried over history. Times are unix timestamps
+class StageRun(BaseModel):
+    job_id = CharField()
+    step = CharField()
+    attempt = IntegerField(default=1)
+
+    status = CharField(index=True)
+
+    task_id = CharField(default=None, null=True, index=True)
+    queue = CharField(default=None, null=True)
+    node = TextField(default=None, null=True)
+
+    # Note: Fingerprint of the step's inputs, memoized step was completed by linking outputs of an earlier run
+    fingerprint = CharField(default=None, null=True, index=True)
+    memoized = BooleanField(default=False)
+
+    # Note: Steps of a batch share the task, index of the first job is 0
+    batch_size = IntegerField(default=None, null=True)
+    batch_index = IntegerField(default=None, null=True)
+
+    queued_at = FloatField(default=None, null=True)
+    scheduled_at = FloatField(default=None, null=True)
+    started_at = FloatField(default=None, null=True)
+    finished_at = FloatField(default=None, null=True)
+
+    # Note: Wall time of the stage on its worker and of its phases, see `queues.base.timed_phase`
+    seconds = FloatField(default=None, null=True)
+    download_seconds = FloatField(default=None, null=True)
+    container_seconds = FloatField(default=None, null=True)
+    upload_seconds = FloatField(default=None, null=True)
+
+    download_bytes = IntegerField(default=None, null=True)
+    output_bytes = IntegerField(default=None, null=True)
+
+    # Note: Maps cost parameter of the job to its value, see `estimates.get_cost_features`
+    features = TextField(default=None, null=True)
+
+    class Meta:
+        table_name = 'stage_runs'
+        indexes = (
+            (('job_id', 'step', 'attempt'), True),
+            (('step', 'finished_at'), False),
+        )
+
+    def get_state(self) -> dict:
+        return {
+            name: getattr(self, name)
+            for name in STATE_FIELDS
+            if getattr(self, name) != StageRun._meta.fields[name].default
+        }
+
+    def set_state(self, state: dict):
+        for name in STATE_FIELDS:
+            setattr(self, name, state.get(name, StageRun._meta.fields[name].default))
+
+
+# Note: Status of an unfinished attempt whose task was revoked, as its step was dispatched again by the next attempt
+REVOKED = "REVOKED"
+
+STATE_FIELDS = [name for name in StageRun._meta.sorted_field_names if name not in ('id', 'job_id', 'step', 'attempt')]
@@ -0,0 +1,247 @@
+from typing import Dict, List, Optional
+
+import json
+import math
+import time
+import datetime
+
+from database import Job, JobStatus, JobPriority, StageRun
+from settings import settings
+
+
+# Note: Parameters of a job that durations of its stages grow with
+def get_cost_features(payload: dict, input_size: int) -> Dict[str, float]:
+    return {
+        "processing_mpixels": math.prod(payload.get("texture_processing_resolution", [0])) / 1e6,
+        "final_mpixels": max(payload.get("texture_final_resolution", [0])) ** 2 / 1e6,
+        "upscale": math.prod(payload.get("stages_upscale", [1])),
+        "displacement_quality": payload.get("displacement_quality", 0),
+        "n_cameras": payload.get("n_cameras", 0),
+        "mesh_mb": input_size / 1024 ** 2,
+    }
+
+
+def get_job_features(job: Job) -> Dict[str, float]:
+    return get_cost_features(json.loads(job.payload), job.input_size or 0)
+
+
+# Note: Fields of the stage run taken from its result, which is the stage result or entry of its job in the batch result.
+#   Workers that don't report timings only report the node
+def get_run_fields(job: Job, result: dict) -> dict:
+    if "seconds" not in result:
+        return {}
+
+    timings = result.get("timings", {})
+    transferred = result.get("bytes", {})
+
+    return {
+        "seconds": result["seconds"],
+        "download_seconds": timings.get("download"),
+        "container_seconds": timings.get("container"),
+        "upload_seconds": timings.get("upload"),
+        "download_bytes": transferred.get("download"),
+        "output_bytes": transferred.get("output"),
+        "features": json.dumps(get_job_features(job)),
+    }
+
+
+def _solve(a: List[List[float]], b: List[float]) -> List[float]:
+    n = len(b)
+    m = [row[:] + [value] for row, value in zip(a, b)]
+
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda k: abs(m[k][i]))
+        m[i], m[pivot] = m[pivot], m[i]
+
+        for k in range(i + 1, n):
+            factor = m[k][i] / m[i][i]
+            for j in range(i, n + 1):
+                m[k][j] -= factor * m[i][j]
+
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+
+    return x
+
+
+# Note: Model is a linear function of standardized features, fitted by ridge regression, so features that barely vary
+#   in history don't get huge weights. Features that don't vary at all are left out
+def _fit(samples: List[tuple]) -> dict:
+    seconds = [duration for _, duration in samples]
+    mean_seconds = sum(seconds) / len(seconds)
+
+    if len(samples) < settings.ESTIMATE_MIN_SAMPLES:
+        return {"intercept": mean_seconds, "features": {}}
+
+    scales = {}
+    for name in samples[0][0]:
+        values = [features.get(name, 0) for features, _ in samples]
+        mean = sum(values) / len(values)
+        std = math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+
+        if std > 0:
+            scales[name] = (mean, std)
+
+    names = list(scales)
+    rows = [[(features.get(name, 0) - scales[name][0]) / scales[name][1] for name in names] for features, _ in samples]
+
+    a = [
+        [sum(row[i] * row[j] for row in rows) + (1.0 if i == j else 0.0) for j in range(len(names))]
+        for i in range(len(names))
+    ]
+    b = [sum(row[i] * (duration - mean_seconds) for row, duration in zip(rows, seconds)) for i in range(len(names))]
+
+    coefficients = _solve(a, b) if len(names) > 0 else []
+
+    return {
+        "intercept": mean_seconds,
+        "features": {name: (*scales[name], coefficient) for name, coefficient in zip(names, coefficients)},
+    }
+
+
+# Note: Models are fitted in the server process and reused until they expire, see `ESTIMATE_MODEL_TTL_SECONDS`
+stage_models: Dict[str, tuple] = {}
+
+
+def _get_stage_model(step: str) -> Optional[dict]:
+    fitted_at, model = stage_models.get(step, (None, None))
+
+    if fitted_at is None or time.monotonic() - fitted_at >= settings.ESTIMATE_MODEL_TTL_SECONDS:
+        stage_runs = StageRun.select(StageRun.features, StageRun.seconds).where(
+            StageRun.step == step,
+            StageRun.seconds.is_null(False),
+        ).order_by(StageRun.finished_at.desc()).limit(settings.ESTIMATE_HISTORY_SIZE)
+
+        samples = [(json.loads(stage_run.features), stage_run.seconds) for stage_run in stage_runs]
+        model = _fit(samples) if len(samples) > 0 else None
+
+        stage_models[step] = (time.monotonic(), model)
+
+    return model
+
+
+def estimate_stage_seconds(step: str, features: Dict[str, float]) -> float:
+    model = _get_stage_model(step)
+
+    if model is None:
+        return settings.ESTIMATE_DEFAULT_STAGE_SECONDS
+
+    seconds = model["intercept"] + sum(
+        coefficient * (features.get(name, 0) - mean) / std
+        for name, (mean, std, coefficient) in model["features"].items()
+    )
+
+    return max(seconds, 0.0)
+
+
+# Note: Steps run in parallel once their dependencies succeed, so remaining time of a job is its critical path.
+#   `remaining` maps step to its remaining time
+def _get_critical_path(steps: List[str], dependencies: Dict[str, List[str]], remaining: Dict[str, float]) -> float:
+    finished_at = {}
+    for step in steps:
+        finished_at[step] = max((finished_at.get(parent, 0.0) for parent in dependencies.get(step, [])), default=0.0) + remaining[step]
+
+    return max(finished_at.values(), default=0.0)
+
+
+def estimate_steps(steps: List[str], dependencies: Dict[str, List[str]], features: Dict[str, float]) -> dict:
+    remaining = {step: estimate_stage_seconds(step, features) for step in steps}
+
+    return {
+        "seconds": _get_critical_path(steps, dependencies, remaining),
+        "steps": remaining,
+    }
+
+
+# Note: Time running step has spent is subtracted from its estimate, steps that are waiting are estimated in full.
+#   Time of waiting for workers isn't included, see `get_queue_position`
+def estimate_remaining_seconds(job: Job) -> Optional[float]:
+    if job.status == JobStatus.SUCCEEDED:
+        return 0.0
+
+    # Note: Failed and cancelled jobs won't finish
+    if job.status not in (JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.RUNNING):
+        return None
+
+    features = get_job_features(job)
+    step_states = job.get_step_states()
+
+    remaining = {}
+    for step in json.loads(job.steps):
+        step_state = step_states.get(step, {})
+
+        if step_state.get("status") == JobStatus.SUCCEEDED:
+            remaining[step] = 0.0
+        elif step_state.get("status") == JobStatus.RUNNING and "started_at" in step_state:
+            remaining[step] = max(estimate_stage_seconds(step, features) - (time.time() - step_state["started_at"]), 0.0)
+        else:
+            remaining[step] = estimate_stage_seconds(step, features)
+
+    return _get_critical_path(json.loads(job.steps), job.get_dependencies(), remaining)
+
+
+def _get_waiting_steps(job: Job) -> Dict[str, dict]:
+    # Note: Job that wasn't admitted yet waits with its first steps
+    if job.status == JobStatus.QUEUED:
+        dependencies = job.get_dependencies()
+        queued_at = job.created_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+        return {step: {"status": JobStatus.QUEUED, "queued_at": queued_at} for step in dependencies if len(dependencies[step]) == 0}
+
+    return {
+        step: step_state
+        for step, step_state in job.get_step_states().items()
+        if step_state["status"] in (JobStatus.QUEUED, JobStatus.SCHEDULED)
+    }
+
+
+def _count_steps_ahead(type: str, priority: str, queued_at: float, job_id: Optional[str] = None) -> int:
+    ranks = {value: rank for rank, value in enumerate(JobPriority)}
+    rank = ranks.get(priority, ranks[JobPriority.NORMAL])
+
+    stage_runs = StageRun.select(
+        StageRun.job_id, StageRun.step, StageRun.status, StageRun.task_id, StageRun.queued_at, Job.priority
+    ).join(Job, on=(StageRun.job_id == Job.id)).where(
+        StageRun.status.in_([JobStatus.QUEUED, JobStatus.SCHEDULED]),
+        StageRun.step.startswith(f"{type}."),
+        StageRun.job_id != job_id,
+        Job.status.in_([JobStatus.SCHEDULED, JobStatus.RUNNING]),
+    ).tuples()
+
+    ahead = set()
+    for other_job_id, step, status, task_id, other_queued_at, other_priority in stage_runs:
+        # Note: Jobs of a batch share a task, so it's counted once
+        if status == JobStatus.SCHEDULED:
+            ahead.add(task_id)
+        elif (ranks.get(other_priority, ranks[JobPriority.NORMAL]), other_queued_at or 0) < (rank, queued_at):
+            ahead.add((other_job_id, step))
+
+    for other_job in Job.select().where(Job.status == JobStatus.QUEUED, Job.id != job_id):
+        other_rank = ranks.get(other_job.priority, ranks[JobPriority.NORMAL])
+
+        for step, step_state in _get_waiting_steps(other_job).items():
+            if step.split('.')[0] == type and (other_rank, step_state["queued_at"]) < (rank, queued_at):
+                ahead.add((other_job.id, step))
+
+    return len(ahead)
+
+
+# Note: Position of the job's first waiting step among steps waiting in the same queue: steps sent to workers
+#   and not started yet are ahead of it, so are held steps of higher priority class or held for longer.
+#   `None` when no step of the job is waiting
+def get_queue_position(job: Job) -> Optional[int]:
+    waiting = _get_waiting_steps(job)
+
+    if len(waiting) == 0:
+        return None
+
+    return min(
+        _count_steps_ahead(step.split('.')[0], job.priority, step_state.get("queued_at", time.time()), job.id)
+        for step, step_state in waiting.items()
+    )
+
+
+# Note: Position the first step of a new job of given priority would take
+def get_new_job_queue_position(step: str, priority: str) -> int:
+    return _count_steps_ahead(step.split('.')[0], priority, time.time())
@@ -0,0 +1,52 @@
+from typing import Callable, Optional
+
+import json
+import time
+import logging
+import functools
+
+import redis
+
+from settings import settings
+
+logger = logging.getLogger("sd_cloud.events")
+
+JOB_EVENTS_CHANNEL = "sd:job-events"
+
+
+class JobEventKind:
+    SUBMITTED = "submitted"
+    STARTED = "started"
+    FINISHED = "finished"
+
+
+@functools.cache
+def get_redis() -> redis.Redis:
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+# Note: Events only speed up reactions of the scheduler, which still polls as a safety net,
+#   so failing to publish an event must never fail the caller. Task events refer to the task of the job's step
+def publish_job_event(job_id: str, kind: str, task_id: Optional[str] = None) -> None:
+    try:
+        get_redis().publish(JOB_EVENTS_CHANNEL, json.dumps({"job_id": job_id, "kind": kind, "task_id": task_id}))
+    except Exception as e:
+        logger.warning(f"Failed to publish {kind} event of {job_id}: {e}")
+
+
+def listen_job_events(callback: Callable[[str, str, Optional[str]], None]) -> None:
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(JOB_EVENTS_CHANNEL)
+
+            for message in pubsub.listen():
+                event = json.loads(message["data"])
+
+                try:
+                    callback(event["job_id"], event["kind"], event.get("task_id"))
+                except Exception as e:
+                    logger.exception(e)
+        except redis.exceptions.ConnectionError as e:
+            logger.warning(f"Lost connection to job events, reconnecting: {e}")
+            time.sleep(1)
@@ -0,0 +1,150 @@
+from typing import Dict, List, Optional
+
+import os
+import json
+import hashlib
+import logging
+import datetime
+
+from peewee import fn
+
+from database import StageMemo
+from queues.stages import STAGES, INPUT_LAYER, CONFIG_LAYER, get_layer_paths, get_layer_producers
+from settings import settings
+from storage import LayerManifest, get_backend, get_layer_manifest_key, load_layer_manifests, read_file
+
+logger = logging.getLogger("sd_cloud.memo")
+
+
+def _get_input_fingerprint(job_id: str) -> Optional[str]:
+    manifests = load_layer_manifests(get_backend(), job_id, [INPUT_LAYER])
+
+    if INPUT_LAYER not in manifests:
+        return None
+
+    digests = {path: entry["digest"] for path, entry in manifests[INPUT_LAYER]["files"].items()}
+
+    return hashlib.sha256(json.dumps(digests, sort_keys=True).encode()).hexdigest()
+
+
+# Note: Fingerprint covers everything output of a stage depends on: the stage, worker image, payload fields it reads
+#   and fingerprints of its input layers. Uploaded input is fingerprinted by digests of its files, stage outputs by
+#   fingerprint of the stage that produced them. Config layer is covered by the payload fields instead,
+#   since it also holds values the stage doesn't read, like prompts
+def get_fingerprint(step: str, steps: List[str], payload: dict, step_states: Dict[str, dict]) -> Optional[str]:
+    stage = STAGES[step]
+
+    if stage.memo_fields is None or stage.inputs is None:
+        return None
+
+    producers = get_layer_producers(steps[:steps.index(step)])
+
+    layers = {}
+    for layer in stage.inputs:
+        if layer == CONFIG_LAYER:
+            continue
+
+        if layer == INPUT_LAYER:
+            layers[layer] = _get_input_fingerprint(payload["job_id"])
+        else:
+            layers[layer] = step_states.get(producers.get(layer), {}).get("fingerprint")
+
+        if layers[layer] is None:
+            return None
+
+    key = {
+        "step": step,
+        "image": settings.QUEUE_IMAGE_TAG.value,
+        "fields": {name: payload.get(name) for name in stage.memo_fields},
+        "layers": layers,
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _read_context(job_id: str) -> dict:
+    backend = get_backend()
+
+    manifest = load_layer_manifests(backend, job_id, [CONFIG_LAYER])[CONFIG_LAYER]
+
+    return json.loads(read_file(backend, manifest["files"][os.path.join('job', 'context')]))
+
+
+def _get_layer_root(layer: str, context: dict) -> str:
+    return get_layer_paths(layer, context)[0]
+
+
+def _rebase_manifest(manifest: LayerManifest, root: str, new_root: str) -> LayerManifest:
+    return LayerManifest(
+        files={
+            os.path.normpath(os.path.join(new_root, os.path.relpath(path, root))): entry
+            for path, entry in manifest["files"].items()
+        },
+        dirs=[os.path.normpath(os.path.join(new_root, os.path.relpath(path, root))) for path in manifest["dirs"]],
+    )
+
+
+# Note: Output paths of a stage may differ between jobs, so memoized manifests are kept relative to layer directories
+#   and rebased onto directories of the job they are linked into. Files themselves are shared content-addressed blobs
+def link_memo(job_id: str, step: str, fingerprint: str) -> bool:
+    memo = StageMemo.get_or_none(StageMemo.fingerprint == fingerprint)
+
+    if memo is None:
+        return False
+
+    backend = get_backend()
+    context = _read_context(job_id)
+
+    for layer, manifest in json.loads(memo.layers).items():
+        manifest = _rebase_manifest(manifest, '.', _get_layer_root(layer, context))
+        backend.write_bytes(get_layer_manifest_key(job_id, layer), json.dumps(manifest).encode())
+
+    memo.last_used_at = datetime.datetime.utcnow()
+    memo.save()
+
+    logger.info(f"Reused {step} outputs of size {memo.size} for {job_id}")
+
+    return True
+
+
+def record_memo(job_id: str, step: str, fingerprint: str):
+    backend = get_backend()
+    context = _read_context(job_id)
+
+    layers = {
+        layer: _rebase_manifest(manifest, _get_layer_root(layer, context), '.')
+        for layer, manifest in load_layer_manifests(backend, job_id, STAGES[step].outputs).items()
+    }
+
+    size = sum(entry["size"] for manifest in layers.values() for entry in manifest["files"].values())
+
+    StageMemo.insert(
+        fingerprint=fingerprint,
+        step=step,
+        layers=json.dumps(layers),
+        size=size,
+    ).on_conflict(
+        conflict_target=[StageMemo.fingerprint],
+        update={
+            StageMemo.step: step,
+            StageMemo.layers: json.dumps(layers),
+            StageMemo.size: size,
+            StageMemo.last_used_at: datetime.datetime.utcnow(),
+        },
+    ).execute()
+
+    enforce_memo_budget(int(settings.STAGE_MEMO_BUDGET_GB * 1024 ** 3))
+
+
+# Note: Blobs stay in storage after their memo entry is dropped, as they may be referenced by job manifests
+def enforce_memo_budget(budget_bytes: int):
+    total = StageMemo.select(fn.COALESCE(fn.SUM(StageMemo.size), 0)).scalar()
+
+    for memo in StageMemo.select().order_by(StageMemo.last_used_at):
+        if total <= budget_bytes:
+            break
+
+        memo.delete_instance()
+        total -= memo.size
+
+        logger.info(f"Evicted {memo.step} memo {memo.fingerprint} of size {memo.size}")
@@ -1,29 +1,46 @@
+from typing import Dict, Iterable, List, Optional
+
 from dataclasses import dataclass, asdict
 
 import os
 import json
-import shutil
-import zipfile
+import time
+import shlex
+import logging
+import threading
+import contextlib
 
 import celery
 import requests
 import docker
-import docker.types
+import docker.errors
 import docker.models.containers
 from celery import Task
+from celery.signals import task_prerun, task_postrun
 
 from pydantic import BaseModel
-from google.cloud import storage
 
+from events import JobEventKind, publish_job_event
+from queues.devices import get_task_device, get_device_requests
+from queues.pool import run_warm_command, kill_warm_command
+from queues.resident import run_resident_command, kill_resident_command
 from settings import settings
+from storage import get_backend, save_layer, load_layer_manifests, load_layers, save_result_archive, load_legacy_archives, \
+    job_lock, in_use, read_index, write_index, update_stats, enforce_budget
+
+logger = logging.getLogger("sd_cloud.queues")
 
 
 class AnyStageInput(BaseModel):
     job_id: str
 
 
+def get_cache_dir() -> str:
+    return os.path.join(settings.TMP_DIR, "sd")
+
+
 def get_tmp_dir(job_id: str) -> str:
-    path = os.path.join("/tmp", "sd", job_id)
+    path = os.path.join(get_cache_dir(), job_id)
     os.makedirs(path, exist_ok=True)
     return path
 
@@ -38,31 +55,144 @@ def load_context(tmp_dir: str) -> dict:
         return json.load(context_file)
 
 
-def save_data(tmp_dir: str, job_id: str) -> None:
-    client_storage = storage.Client()
+# Note: Wall time of the running task and of its phases, and bytes it transferred, reported with stage result so that
+#   scheduler can estimate durations of future stages. Phases of batch task are shared by all of its jobs,
+#   so it reports timings of each job
+task_started_at = time.monotonic()
+task_phases: Dict[str, float] = {}
+task_bytes: Dict[str, int] = {}
+task_phases_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed_phase(phase: str):
+    start = time.monotonic()
+
+    try:
+        yield
+    finally:
+        with task_phases_lock:
+            task_phases[phase] = task_phases.get(phase, 0.0) + time.monotonic() - start
+
+
+def _count_bytes(kind: str, size: int):
+    with task_phases_lock:
+        task_bytes[kind] = task_bytes.get(kind, 0) + size
+
+
+# Note: Each layer is stored as a manifest of content-addressed files, so stages only upload files they produced
+#   and identical files are stored once across all jobs. `layers` maps layer name to paths relative to `tmp_dir`.
+#   Returns total size of saved layers
+def save_data(tmp_dir: str, job_id: str, layers: Dict[str, List[str]]) -> int:
+    backend = get_backend()
+    size = 0
+
+    with timed_phase("upload"), job_lock(tmp_dir):
+        index = read_index(tmp_dir)
+
+        for layer, paths in layers.items():
+            manifest = save_layer(backend, tmp_dir, job_id, layer, paths, index)
+            size += sum(entry["size"] for entry in manifest["files"].values())
+
+        write_index(tmp_dir, index)
+
+    _count_bytes("output", size)
+
+    return size
+
+
+# Note: Job directory acts as a node-local cache, local files are validated against layer manifests
+#   and only changed or missing files are downloaded. Only given `layers` are loaded, all of them when `None`.
+#   Afterward, least recently used job directories are evicted to keep the cache within its disk budget,
+#   except for the job directory and directories in `keep`, e.g. of other jobs of a batch.
+#   Returns number of bytes downloaded
+def load_data(tmp_dir: str, job_id: str, layers: Optional[List[str]] = None, keep: Iterable[str] = ()) -> int:
+    backend = get_backend()
+    size = 0
+
+    with timed_phase("download"), job_lock(tmp_dir):
+        index = read_index(tmp_dir)
+
+        manifests = load_layer_manifests(backend, job_id, layers)
+
+        if len(manifests) > 0:
+            stats = load_layers(backend, tmp_dir, manifests, index)
+            size = stats["miss_bytes"]
+
+            totals = update_stats(get_cache_dir(), **stats)
+            logger.info(
+                f"Loaded {job_id}: {stats['hits']} hits ({stats['hit_bytes']} bytes), "
+                f"{stats['misses']} misses ({stats['miss_bytes']} bytes); node totals: {totals}"
+            )
+        elif not os.path.exists(os.path.join(tmp_dir, 'job')):
+            load_legacy_archives(backend, tmp_dir, job_id, settings.STORAGE_STREAMING)
+
+        write_index(tmp_dir, index)
+
+    enforce_budget(get_cache_dir(), int(settings.LOCAL_CACHE_BUDGET_GB * 1024 ** 3), keep={tmp_dir, *keep})
+
+    _count_bytes("download", size)
 
-    zip_filename = shutil.make_archive(os.path.join(tmp_dir, 'data'), 'zip', os.path.join(tmp_dir), 'job')
+    return size
 
-    data_bucket = client_storage.bucket(settings.SD_DATA_STORAGE_BUCKET_NAME)
 
-    data_blob = data_bucket.blob(f"{job_id}/data.zip")
-    data_blob.upload_from_filename(zip_filename)
+def save_result(tmp_dir: str, job_id: str) -> None:
+    save_result_archive(get_backend(), tmp_dir, job_id, settings.STORAGE_STREAMING)
 
 
-def load_data(tmp_dir: str, job_id: str) -> None:
-    # If directory not empty, assume data is already loaded
-    if len(os.listdir(tmp_dir)) > 0:
-        return
+# Note: Stage result tells scheduler which node holds job data now, so that next stage can be routed to it,
+#   and how long the stage took
+def make_stage_result() -> dict:
+    return {
+        "node": settings.NODE_NAME,
+        "seconds": time.monotonic() - task_started_at,
+        "timings": dict(task_phases),
+        "bytes": dict(task_bytes),
+    }
 
-    client_storage = storage.Client()
 
-    data_bucket = client_storage.bucket(settings.SD_DATA_STORAGE_BUCKET_NAME)
+def get_node_queue_name(queue_name: str, node: str) -> str:
+    return f"{queue_name}.{node}"
 
-    data_blob = data_bucket.blob(f"{job_id}/data.zip")
-    data_blob.download_to_filename(os.path.join(tmp_dir, 'data.zip'))
 
-    with zipfile.ZipFile(os.path.join(tmp_dir, 'data.zip')) as zf:
-        zf.extractall(os.path.join(tmp_dir))
+# Note: Batch tasks get a list of stage inputs, events are sent for each of their jobs
+def _get_job_ids(args: tuple) -> List[str]:
+    if len(args) == 0:
+        return []
+
+    raw_inputs = args[0] if isinstance(args[0], list) else [args[0]]
+
+    return [raw_input["job_id"] for raw_input in raw_inputs if isinstance(raw_input, dict) and "job_id" in raw_input]
+
+
+# Note: Directories of the running task's jobs are marked in use until it finishes, so cache eviction by other tasks
+#   on the node doesn't remove them while they are loaded, used by the stage container or saved
+task_dirs_in_use = contextlib.ExitStack()
+
+
+# Note: Scheduler reacts to these events immediately instead of waiting for its next poll.
+#   `task_prerun` is sent before STARTED state is stored in result backend, so the event itself tells the task started.
+#   `task_postrun` is sent after task state is stored
+@task_prerun.connect
+def on_task_prerun(task_id: str, args: tuple, **kwargs):
+    global task_started_at
+
+    task_started_at = time.monotonic()
+    task_phases.clear()
+    task_bytes.clear()
+
+    for job_id in _get_job_ids(args):
+        task_dirs_in_use.enter_context(in_use(os.path.join(get_cache_dir(), job_id)))
+
+        publish_job_event(job_id, JobEventKind.STARTED, task_id)
+
+
+@task_postrun.connect
+def on_task_postrun(task_id: str, args: tuple, **kwargs):
+    task_dirs_in_use.close()
+
+    for job_id in _get_job_ids(args):
+        publish_job_event(job_id, JobEventKind.FINISHED, task_id)
 
 
 class LogException(Exception):
@@ -77,8 +207,9 @@ def wait_docker_exit(container: docker.models.containers.Container) -> str:
     #   in those cases log streaming exits correctly, so use `logs()` instead of `wait()`
     try:
         logs = ''
-        for log in container.logs(timestamps=False, stream=True):
-            logs += log.decode()
+        with timed_phase("container"):
+            for log in container.logs(timestamps=False, stream=True):
+                logs += log.decode()
 
         if 'Traceback' in logs:
             raise LogException(kind='exception', logs=logs)
@@ -95,6 +226,19 @@ def generate_container_name(task_name: str, task_id: str) -> str:
     return f"{task_name}-{task_id}"
 
 
+def kill_docker_command(container_name: str) -> None:
+    client = docker.from_env()
+
+    try:
+        client.api.kill(container_name)
+    except docker.errors.NotFound:
+        if kill_warm_command(get_cache_dir(), container_name):
+            return
+
+        if not kill_resident_command(get_cache_dir(), container_name):
+            raise
+
+
 def run_docker_command(container_name: str, image: str, context: dict, command: str, with_gpu: bool) -> docker.models.containers.Container:
     client = docker.from_env()
 
@@ -125,29 +269,45 @@ def run_docker_command(container_name: str, image: str, context: dict, command:
         remove=True,
         detach=True,
 
-        device_requests=[
-            docker.types.DeviceRequest(
-                capabilities=[['gpu']]
-            )
-        ] if with_gpu else [],
+        # Note: Container only sees the device leased by its task, see `queues.devices`
+        device_requests=get_device_requests(get_task_device()) if with_gpu else [],
 
         mem_limit='48g',
     )
 
 
+def get_comfywr_image() -> str:
+    return f"europe-central2-docker.pkg.dev/unitydiffusion/sd-experiments/sd_comfywr:{settings.QUEUE_IMAGE_TAG.value}"
+
+
 def run_comfywr_docker_command(container_name: str, context: dict, command: str, with_gpu: bool = False) -> docker.models.containers.Container:
+    argv = shlex.split(command.format(**context))
+
+    # Note: GPU python scripts run in resident server when it's free, so weights loaded by earlier stages are reused
+    if with_gpu and argv[0] == 'python' and not {'>', '>>', '|', '&&', ';'} & set(argv):
+        execution = run_resident_command(get_cache_dir(), get_comfywr_image(), container_name, context, argv[1:], get_task_device())
+
+        if execution is not None:
+            return execution
+
     return run_docker_command(
         container_name,
-        f"europe-central2-docker.pkg.dev/unitydiffusion/sd-experiments/sd_comfywr:{settings.QUEUE_IMAGE_TAG.value}",
+        get_comfywr_image(),
         context, command,
         with_gpu,
     )
 
 
 def run_blender_docker_command(container_name: str, context: dict, command: str, with_gpu: bool = False) -> docker.models.containers.Container:
+    image = f"europe-central2-docker.pkg.dev/unitydiffusion/sd-experiments/sd_blender:{settings.QUEUE_IMAGE_TAG.value}"
+
+    # Note: CPU stages run in warm containers when one is free, GPU stages keep their own container with GPU attached
+    if not with_gpu and (execution := run_warm_command(get_cache_dir(), image, container_name, context, command)) is not None:
+        return execution
+
     return run_docker_command(
         container_name,
-        f"europe-central2-docker.pkg.dev/unitydiffusion/sd-experiments/sd_blender:{settings.QUEUE_IMAGE_TAG.value}",
+        image,
         context, command,
         with_gpu,
     )
@@ -3,13 +3,13 @@ from typing import List
 import os
 import shutil
 
-import docker
 from celery import Celery, Task
 from celery.signals import task_revoked
 
 from settings import settings
-from queues.base import AnyStageInput, get_tmp_dir, save_context, load_context, load_data, save_data, wait_docker_exit, \
-    run_blender_docker_command, generate_blender_command, generate_container_name
+from queues.base import AnyStageInput, get_tmp_dir, save_context, load_context, load_data, save_data, save_result, wait_docker_exit, \
+    run_blender_docker_command, generate_blender_command, generate_container_name, kill_docker_command, make_stage_result
+from queues.stages import STAGES
 
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
@@ -23,15 +23,17 @@ queue.conf.task_default_queue = 'cpu'
 queue.conf.broker_connection_retry = True
 queue.conf.broker_connection_retry_on_startup = False
 queue.conf.task_track_started = True
+queue.conf.task_queue_max_priority = 10
+queue.conf.task_default_priority = 5
+# Note: Each worker process reserves a single task, the rest stay in broker, where they are served by priority
+queue.conf.worker_prefetch_multiplier = 1
 
 
 @task_revoked.connect()
 def on_revoke(**kwargs):
     logger.info(f"Got revoke: {kwargs}")
 
-    container_name = f"{kwargs['sender'].__name__}-{kwargs['request'].id}"
-    client = docker.from_env()
-    client.api.kill(container_name)
+    kill_docker_command(generate_container_name(kwargs['sender'].__name__, kwargs['request'].id))
 
 
 class PreStage0Input(AnyStageInput):
@@ -154,7 +156,7 @@ def prestage_0(self: Task, raw_input: dict) -> dict:
         *multivalue_option('--texture_final_resolution', [str(value) for value in input.texture_final_resolution]),
     ]
 
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.prestage_0'].inputs)
 
     logs = wait_docker_exit(
         run_blender_docker_command(
@@ -198,10 +200,10 @@ def prestage_0(self: Task, raw_input: dict) -> dict:
     context["final_render"] = os.path.join(context["output_dir"], context["config_filename"], "99_final_render")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.prestage_0'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -211,7 +213,7 @@ def stage_0(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.stage_0'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -227,10 +229,10 @@ def stage_0(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.stage_0'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -238,7 +240,7 @@ def stage_1(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.stage_1'].inputs)
     context = load_context(tmp_dir)
 
 
@@ -255,10 +257,10 @@ def stage_1(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.stage_1'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -266,7 +268,7 @@ def stage_3(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.stage_3'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -283,10 +285,10 @@ def stage_3(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.stage_3'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 # @queueself: Task, .bind=True, ask(typing=True)
@@ -294,7 +296,7 @@ def stage_3(self: Task, raw_input: dict) -> dict:
 #     input = AnyStageInput.model_validate(raw_input)
 #
 #     tmp_dir = get_tmp_dir(input.job_id)
-#     load_data(tmp_dir, input.job_id)
+#     load_data(tmp_dir, input.job_id, STAGES['cpu.stage_5'].inputs)
 #     context = load_context(tmp_dir)
 #
 #
@@ -312,7 +314,7 @@ def stage_3(self: Task, raw_input: dict) -> dict:
 #     logger.info(f"{logs=}")
 #
 #     save_context(tmp_dir, context)
-#     save_data(tmp_dir, input.job_id)
+#     save_data(tmp_dir, input.job_id, STAGES['cpu.stage_5'].get_output_layers(context))
 #     shutil.rmtree(tmp_dir)
 #
 #     return {}
@@ -323,7 +325,7 @@ def stage_6(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.stage_6'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -340,10 +342,10 @@ def stage_6(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.stage_6'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -351,7 +353,7 @@ def stage_9(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.stage_9'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -369,10 +371,10 @@ def stage_9(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['cpu.stage_9'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -380,6 +382,9 @@ def cleanup(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['cpu.cleanup'].inputs)
+
+    save_result(tmp_dir, input.job_id)
     shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
@@ -0,0 +1,432 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import threading
+import subprocess
+import contextlib
+
+import docker
+import docker.types
+
+from queues.stages import STAGES
+from settings import settings
+from storage.cache import locked
+
+logger = logging.getLogger("sd_cloud.queues.devices")
+
+DEVICES_DIRNAME = '.gpu'
+DEVICES_FILENAME = 'devices.json'
+CAPACITY_FILENAME = 'capacity.json'
+FOOTPRINTS_FILENAME = 'footprints.json'
+STATS_FILENAME = 'stats.json'
+
+QUERY_DEVICES_COMMAND = ['nvidia-smi', '--query-gpu=index,memory.total', '--format=csv,noheader,nounits']
+QUERY_MEMORY_COMMAND = ['nvidia-smi', '--query-gpu=index,memory.used', '--format=csv,noheader,nounits']
+QUERY_UTILIZATION_COMMAND = ['nvidia-smi', '--query-gpu=index,utilization.gpu,memory.used,memory.total', '--format=csv,noheader,nounits']
+
+# Note: Measured footprint is the largest of recent runs with some headroom, used once there are enough of them
+FOOTPRINT_HISTORY_SIZE = 20
+FOOTPRINT_MIN_SAMPLES = 3
+FOOTPRINT_HEADROOM = 1.2
+FOOTPRINT_SAMPLE_INTERVAL_SECONDS = 5
+
+
+def _get_devices_dir(cache_dir: str) -> str:
+    devices_dir = os.path.join(cache_dir, DEVICES_DIRNAME)
+    os.makedirs(devices_dir, exist_ok=True)
+
+    return devices_dir
+
+
+def _read_json(path: str) -> dict:
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_json(path: str, value: dict):
+    with open(path + '.part', 'w') as json_file:
+        json.dump(value, json_file)
+
+    os.replace(path + '.part', path)
+
+
+# Note: Worker itself runs without GPUs attached, so when `nvidia-smi` isn't available locally,
+#   it's run in a container that sees all GPUs of the node
+def _query_nvidia_smi(command: List[str]) -> Optional[str]:
+    try:
+        return subprocess.run(command, capture_output=True, text=True, check=True, timeout=60).stdout
+    except (OSError, subprocess.SubprocessError):
+        pass
+
+    from queues.base import get_comfywr_image
+
+    try:
+        return docker.from_env().containers.run(
+            image=get_comfywr_image(),
+            command=command,
+            device_requests=[
+                docker.types.DeviceRequest(
+                    capabilities=[['gpu']]
+                )
+            ],
+            remove=True,
+        ).decode()
+    except Exception as e:
+        logger.exception(e)
+
+        return None
+
+
+def _parse_nvidia_smi(output: str) -> Dict[str, List[str]]:
+    rows = {}
+    for line in output.splitlines():
+        if line.strip():
+            index, *values = [value.strip() for value in line.split(',')]
+            rows[index] = values
+
+    return rows
+
+
+# Note: `GPU_DEVICES` overrides discovery, e.g. to test with a fake device list. No devices means they are unknown,
+#   then tasks run with all GPUs attached, as before. Devices are stored with their VRAM in GB
+def discover_devices(cache_dir: str) -> Dict[str, float]:
+    if settings.GPU_DEVICES is not None:
+        devices = {device: settings.GPU_DEVICE_VRAM_GB for device in settings.GPU_DEVICES}
+    elif (output := _query_nvidia_smi(QUERY_DEVICES_COMMAND)) is not None:
+        devices = {index: float(values[0]) / 1024 for index, values in _parse_nvidia_smi(output).items()}
+    else:
+        devices = {}
+
+    _write_json(os.path.join(_get_devices_dir(cache_dir), DEVICES_FILENAME), devices)
+
+    logger.info(f"Discovered GPU devices: {devices}")
+
+    return devices
+
+
+def _get_device_memory(cache_dir: str) -> Dict[str, float]:
+    devices_path = os.path.join(_get_devices_dir(cache_dir), DEVICES_FILENAME)
+
+    devices = _read_json(devices_path) if os.path.exists(devices_path) else None
+
+    # Note: Devices file of older workers is a list of devices without their memory
+    if not isinstance(devices, dict):
+        devices = discover_devices(cache_dir)
+
+    return devices
+
+
+def get_devices(cache_dir: str) -> List[str]:
+    return list(_get_device_memory(cache_dir))
+
+
+def get_slot_count(cache_dir: str) -> int:
+    return max(len(get_devices(cache_dir)), 1) * settings.GPU_SLOTS_PER_DEVICE
+
+
+def _get_node_ram_gb() -> float:
+    if settings.GPU_NODE_RAM_GB is not None:
+        return settings.GPU_NODE_RAM_GB
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+# Note: Footprints declared by stages are overridden by measured history, and both by values put into footprints file by hand
+def get_footprint(cache_dir: str, step: str) -> Dict[str, float]:
+    history = _read_json(os.path.join(_get_devices_dir(cache_dir), FOOTPRINTS_FILENAME)).get(step, {})
+
+    footprint = {"vram_gb": STAGES[step].vram_gb, "ram_gb": STAGES[step].ram_gb}
+
+    if len(samples := history.get("vram_gb_samples", [])) >= FOOTPRINT_MIN_SAMPLES:
+        footprint["vram_gb"] = max(samples) * FOOTPRINT_HEADROOM
+
+    for key in footprint:
+        if key in history:
+            footprint[key] = history[key]
+
+    return footprint
+
+
+def _record_footprint(cache_dir: str, step: str, vram_gb: float):
+    footprints_path = os.path.join(_get_devices_dir(cache_dir), FOOTPRINTS_FILENAME)
+
+    with locked(footprints_path + '.lock'):
+        footprints = _read_json(footprints_path)
+
+        samples = footprints.setdefault(step, {}).setdefault("vram_gb_samples", [])
+        samples.append(vram_gb)
+        del samples[:-FOOTPRINT_HISTORY_SIZE]
+
+        _write_json(footprints_path, footprints)
+
+
+def _record_lease(cache_dir: str, device: Optional[str], wait_seconds: float, busy_seconds: float):
+    stats_path = os.path.join(_get_devices_dir(cache_dir), STATS_FILENAME)
+
+    with locked(stats_path + '.lock'):
+        stats = _read_json(stats_path)
+
+        device_stats = stats.setdefault(str(device), {
+            "since": time.time() - wait_seconds - busy_seconds,
+            "tasks": 0,
+            "busy_seconds": 0,
+            "wait_seconds": 0,
+        })
+        device_stats["tasks"] += 1
+        device_stats["busy_seconds"] += busy_seconds
+        device_stats["wait_seconds"] += wait_seconds
+
+        _write_json(stats_path, stats)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+# Note: Live resident servers keep up to `COMFYWR_SERVER_CACHE_GB` of weights in memory between stages,
+#   so their caches are reserved next to leases of running stages
+def _get_resident_ram_gb(cache_dir: str) -> float:
+    if not settings.COMFYWR_SERVER:
+        return 0.0
+
+    from queues.resident import count_resident_servers
+
+    return count_resident_servers(cache_dir) * settings.COMFYWR_SERVER_CACHE_GB
+
+
+# Note: Stage is placed onto the device where it fits tightest, so large gaps are left for heavy stages.
+#   Stage that doesn't fit anywhere still runs on an empty device, as it wouldn't ever fit otherwise
+def _place(cache_dir: str, leases: Dict[str, dict], footprint: Dict[str, float]) -> Tuple[bool, Optional[str]]:
+    device_memory = list(_get_device_memory(cache_dir).items()) or [(None, settings.GPU_DEVICE_VRAM_GB)]
+
+    ram_used = sum(lease["ram_gb"] for lease in leases.values()) + _get_resident_ram_gb(cache_dir)
+    if leases and ram_used + footprint["ram_gb"] > _get_node_ram_gb():
+        return False, None
+
+    placed, best_device, best_gap = False, None, None
+    for device, vram_gb in device_memory:
+        device_leases = [lease for lease in leases.values() if lease["device"] == device]
+
+        if len(device_leases) >= settings.GPU_SLOTS_PER_DEVICE:
+            continue
+
+        gap = vram_gb - sum(lease["vram_gb"] for lease in device_leases) - footprint["vram_gb"]
+
+        if gap < 0 and device_leases:
+            continue
+
+        if not placed or gap < best_gap:
+            placed, best_device, best_gap = True, device, gap
+
+    return placed, best_device
+
+
+def _reserve(cache_dir: str, step: str, footprint: Dict[str, float]) -> Optional[Tuple[str, Optional[str]]]:
+    capacity_path = os.path.join(_get_devices_dir(cache_dir), CAPACITY_FILENAME)
+
+    with locked(capacity_path + '.lock'):
+        # Note: Leases of crashed worker processes are dropped
+        leases = {
+            lease_id: lease
+            for lease_id, lease in _read_json(capacity_path).items()
+            if _is_alive(lease["pid"])
+        }
+
+        placed, device = _place(cache_dir, leases, footprint)
+
+        if not placed:
+            return None
+
+        # Note: Only runs that had the device to themselves measure footprint of their stage
+        exclusive = True
+        for lease in leases.values():
+            if lease["device"] == device:
+                lease["exclusive"] = exclusive = False
+
+        lease_id = uuid.uuid4().hex
+        leases[lease_id] = {"pid": os.getpid(), "step": step, "device": device, "exclusive": exclusive, **footprint}
+
+        _write_json(capacity_path, leases)
+
+    return lease_id, device
+
+
+def _release(cache_dir: str, lease_id: str) -> dict:
+    capacity_path = os.path.join(_get_devices_dir(cache_dir), CAPACITY_FILENAME)
+
+    with locked(capacity_path + '.lock'):
+        leases = _read_json(capacity_path)
+        lease = leases.pop(lease_id, {})
+
+        _write_json(capacity_path, leases)
+
+    return lease
+
+
+def _get_memory_used_gb(device: str) -> Optional[float]:
+    try:
+        output = subprocess.run(QUERY_MEMORY_COMMAND, capture_output=True, text=True, check=True, timeout=60).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    values = _parse_nvidia_smi(output).get(device)
+
+    return float(values[0]) / 1024 if values else None
+
+
+# Note: Peak memory of the device is sampled while stage runs, only when `nvidia-smi` is available to the worker,
+#   as running it in a container every few seconds would cost more than it saves
+class FootprintSampler:
+    def __init__(self, device: Optional[str]):
+        self.device = device
+        self.baseline = None
+        self.peak = None
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+        if device is not None and shutil.which(QUERY_MEMORY_COMMAND[0]) is not None:
+            self.baseline = _get_memory_used_gb(device)
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(FOOTPRINT_SAMPLE_INTERVAL_SECONDS):
+            if (used := _get_memory_used_gb(self.device)) is not None:
+                self.peak = used if self.peak is None else max(self.peak, used)
+
+    def stop(self) -> Optional[float]:
+        if self.thread is None:
+            return None
+
+        self.stopped.set()
+        self.thread.join()
+
+        if self.baseline is None or self.peak is None:
+            return None
+
+        return max(self.peak - self.baseline, 0)
+
+
+# Note: Device is leased for the duration of a stage, waiting until its footprint fits next to stages already running
+@contextlib.contextmanager
+def lease_device(cache_dir: str, step: str) -> Iterator[Optional[str]]:
+    footprint = get_footprint(cache_dir, step)
+
+    start = time.monotonic()
+    while (reserved := _reserve(cache_dir, step, footprint)) is None:
+        time.sleep(1)
+
+    lease_id, device = reserved
+
+    wait_seconds = time.monotonic() - start
+    lease_start = time.monotonic()
+
+    sampler = FootprintSampler(device)
+
+    try:
+        yield device
+    finally:
+        measured = sampler.stop()
+        lease = _release(cache_dir, lease_id)
+
+        if measured is not None and lease.get("exclusive"):
+            _record_footprint(cache_dir, step, measured)
+
+        _record_lease(cache_dir, device, wait_seconds, time.monotonic() - lease_start)
+
+
+# Note: Device is leased for the task running in this worker process, tasks of a process run one at a time
+_task_lease = contextlib.ExitStack()
+_task_device: Optional[str] = None
+
+
+def acquire_task_device(cache_dir: str, step: str) -> Optional[str]:
+    global _task_device
+
+    _task_device = _task_lease.enter_context(lease_device(cache_dir, step))
+
+    return _task_device
+
+
+def release_task_device():
+    global _task_device
+
+    _task_lease.close()
+    _task_device = None
+
+
+def get_task_device() -> Optional[str]:
+    return _task_device
+
+
+def get_device_requests(device: Optional[str]) -> List[docker.types.DeviceRequest]:
+    if device is None:
+        return [docker.types.DeviceRequest(capabilities=[['gpu']])]
+
+    return [docker.types.DeviceRequest(device_ids=[device], capabilities=[['gpu']])]
+
+
+def get_stats(cache_dir: str) -> dict:
+    devices_dir = _get_devices_dir(cache_dir)
+
+    stats = _read_json(os.path.join(devices_dir, STATS_FILENAME))
+
+    now = time.time()
+    for device_stats in stats.values():
+        elapsed = max(now - device_stats["since"], 1e-9)
+
+        device_stats["utilization"] = device_stats["busy_seconds"] / elapsed / settings.GPU_SLOTS_PER_DEVICE
+        device_stats["average_wait_seconds"] = device_stats["wait_seconds"] / max(device_stats["tasks"], 1)
+
+    for lease in _read_json(os.path.join(devices_dir, CAPACITY_FILENAME)).values():
+        device_stats = stats.setdefault(str(lease["device"]), {})
+        device_stats.setdefault("running", []).append(lease["step"])
+        device_stats["reserved_vram_gb"] = device_stats.get("reserved_vram_gb", 0) + lease["vram_gb"]
+
+    if settings.GPU_DEVICES is None and (output := _query_nvidia_smi(QUERY_UTILIZATION_COMMAND)) is not None:
+        for index, (utilization, memory_used, memory_total) in _parse_nvidia_smi(output).items():
+            stats.setdefault(index, {}).update({
+                "gpu_utilization_percent": float(utilization),
+                "memory_used_mb": float(memory_used),
+                "memory_total_mb": float(memory_total),
+            })
+
+    return {
+        "devices": stats,
+        "footprints": {step: get_footprint(cache_dir, step) for step, stage in STAGES.items() if stage.vram_gb > 0},
+    }
+
+
+# Note: Worker start script discovers devices and sizes worker concurrency with:
+#   python -m queues.devices slots
+#   Per-device lease stats, stages running on them, current GPU utilization and stage footprints are printed with:
+#   python -m queues.devices stats
+if __name__ == "__main__":
+    from queues.base import get_cache_dir
+
+    cmd = sys.argv[1]
+
+    if cmd == "slots":
+        discover_devices(get_cache_dir())
+        print(get_slot_count(get_cache_dir()))
+    elif cmd == "stats":
+        print(json.dumps(get_stats(get_cache_dir()), indent=2))
+    else:
+        raise Exception(f"Unknown command: {cmd}")
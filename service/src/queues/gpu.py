@@ -1,11 +1,22 @@
-import docker
+from typing import List
+
+import time
+import traceback
+import contextlib
+import concurrent.futures
+
+import docker.errors
+
 from celery import Celery, Task
-from celery.signals import task_revoked
+from celery.signals import task_revoked, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
 
 from settings import settings
-from queues.base import AnyStageInput, get_tmp_dir, save_context, load_context, save_data, load_data, wait_docker_exit, \
-    run_comfywr_docker_command, run_blender_docker_command, generate_blender_command, generate_container_name
+from queues.base import AnyStageInput, get_cache_dir, get_tmp_dir, save_context, load_context, save_data, load_data, wait_docker_exit, \
+    run_comfywr_docker_command, run_blender_docker_command, generate_blender_command, generate_container_name, kill_docker_command, make_stage_result, \
+    LogException
+from queues.devices import acquire_task_device, release_task_device
+from queues.stages import STAGES
 
 logger = get_task_logger(__name__)
 
@@ -18,28 +29,49 @@ queue.conf.task_default_queue = 'gpu'
 queue.conf.broker_connection_retry = True
 queue.conf.broker_connection_retry_on_startup = False
 queue.conf.task_track_started = True
+queue.conf.task_queue_max_priority = 10
+queue.conf.task_default_priority = 5
+# Note: Each worker process reserves a single task, the rest stay in broker, where they are served by priority
+queue.conf.worker_prefetch_multiplier = 1
+
+
+# Note: Worker runs a process per GPU slot, each task leases a device its stage fits onto for its duration,
+#   and its containers are pinned to that device. Batch task has footprint of the stage it batches
+@task_prerun.connect
+def on_gpu_task_prerun(sender: Task, **kwargs):
+    if sender.app is queue:
+        step = f"gpu.{sender.__name__.removesuffix('_batch')}"
+
+        logger.info(f"Leased GPU device {acquire_task_device(get_cache_dir(), step)} for {step}")
+
+
+@task_postrun.connect
+def on_gpu_task_postrun(sender: Task, **kwargs):
+    if sender.app is queue:
+        release_task_device()
 
 
 @task_revoked.connect()
 def on_revoke(**kwargs):
     logger.info(f"Got revoke: {kwargs}")
 
-    container_name = f"{kwargs['sender'].__name__}-{kwargs['request'].id}"
-    client = docker.from_env()
-    client.api.kill(container_name)
+    container_name = generate_container_name(kwargs['sender'].__name__, kwargs['request'].id)
 
+    # Note: Batch task runs a container per job, only the one currently running exists
+    if kwargs['sender'].__name__.endswith('_batch'):
+        for i in range(len(kwargs['request'].args[0])):
+            with contextlib.suppress(docker.errors.NotFound):
+                kill_docker_command(f"{container_name}-{i}")
 
-@queue.task(bind=True, typing=True)
-def stage_2(self: Task, raw_input: dict) -> dict:
-    input = AnyStageInput.model_validate(raw_input)
+        return
 
-    tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
-    context = load_context(tmp_dir)
+    kill_docker_command(container_name)
 
-    logs = wait_docker_exit(
+
+def _generate_textures(container_name: str, context: dict) -> str:
+    return wait_docker_exit(
         run_comfywr_docker_command(
-            generate_container_name(self.__name__, self.request.id),
+            container_name,
             context,
             'python /workdir/sd_scripts/generate_textures.py '
             '/workdir/{prior_renders_path} '
@@ -49,13 +81,113 @@ def stage_2(self: Task, raw_input: dict) -> dict:
         ),
     )
 
+
+@queue.task(bind=True, typing=True)
+def stage_2(self: Task, raw_input: dict) -> dict:
+    input = AnyStageInput.model_validate(raw_input)
+
+    tmp_dir = get_tmp_dir(input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['gpu.stage_2'].inputs)
+    context = load_context(tmp_dir)
+
+    logs = _generate_textures(generate_container_name(self.__name__, self.request.id), context)
+
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['gpu.stage_2'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
+
+
+def _timed(func, *args) -> tuple:
+    start = time.monotonic()
+    result = func(*args)
+
+    return time.monotonic() - start, result
+
+
+def _make_failure(e: Exception) -> dict:
+    if isinstance(e, LogException):
+        return {"status": "FAILURE", "logs": e.logs}
+
+    return {"status": "FAILURE", "logs": traceback.format_exc()}
+
+
+# Note: Compatible stage_2 requests of several jobs are run back-to-back by one task, so GPU is leased once,
+#   weights stay loaded in resident server, and data of next jobs is loaded and saved while textures are generated.
+#   Failure of one job doesn't fail the others, result reports status and timings of each job and timings of the batch
+@queue.task(bind=True, typing=True)
+def stage_2_batch(self: Task, raw_inputs: List[dict]) -> dict:
+    inputs = [AnyStageInput.model_validate(raw_input) for raw_input in raw_inputs]
+
+    start = time.monotonic()
+    results = {}
+    timings = {input.job_id: {} for input in inputs}
+    transferred = {input.job_id: {} for input in inputs}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as saver:
+        # Note: Directories of every job of the batch are kept by eviction, as earlier jobs are still being generated
+        #   or saved while next ones are loaded
+        tmp_dirs = [get_tmp_dir(input.job_id) for input in inputs]
+
+        loads = {
+            input.job_id: loader.submit(_timed, load_data, get_tmp_dir(input.job_id), input.job_id, STAGES['gpu.stage_2'].inputs, tmp_dirs)
+            for input in inputs
+        }
+        saves = {}
+
+        for i, input in enumerate(inputs):
+            tmp_dir = get_tmp_dir(input.job_id)
+
+            try:
+                timings[input.job_id]["download"], transferred[input.job_id]["download"] = loads[input.job_id].result()
+                context = load_context(tmp_dir)
+
+                run_start = time.monotonic()
+                logs = _generate_textures(f"{generate_container_name(self.__name__, self.request.id)}-{i}", context)
+                timings[input.job_id]["container"] = time.monotonic() - run_start
+
+                logger.info(f"{input.job_id} {logs=}")
+
+                save_context(tmp_dir, context)
+                saves[input.job_id] = saver.submit(
+                    _timed, save_data, tmp_dir, input.job_id, STAGES['gpu.stage_2'].get_output_layers(context)
+                )
+            except Exception as e:
+                logger.exception(e)
+                results[input.job_id] = _make_failure(e)
+
+        for job_id, save in saves.items():
+            try:
+                timings[job_id]["upload"], transferred[job_id]["output"] = save.result()
+                results[job_id] = {
+                    "status": "SUCCESS",
+                    "seconds": sum(timings[job_id].values()),
+                    "timings": timings[job_id],
+                    "bytes": transferred[job_id],
+                }
+            except Exception as e:
+                logger.exception(e)
+                results[job_id] = _make_failure(e)
+
+    seconds = time.monotonic() - start
+    serial_seconds = sum(sum(job_timings.values()) for job_timings in timings.values())
+
+    # Note: Serial time is what the same stages take run one after another, its ratio to batch time is the throughput gain
+    logger.info(
+        f"Generated textures of {len(inputs)} jobs in {seconds:.1f}s, {seconds / len(inputs):.1f}s per job, "
+        f"{serial_seconds / seconds:.2f}x throughput of serial runs"
+    )
+
+    return {
+        **make_stage_result(),
+        "results": results,
+        "seconds": seconds,
+        "serial_seconds": serial_seconds,
+    }
 
 
 @queue.task(bind=True, typing=True)
@@ -63,7 +195,7 @@ def stage_4(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['gpu.stage_4'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -82,10 +214,10 @@ def stage_4(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['gpu.stage_4'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -93,7 +225,7 @@ def stage_7(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['gpu.stage_7'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -111,10 +243,10 @@ def stage_7(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['gpu.stage_7'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 
@@ -123,7 +255,7 @@ def stage_8(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['gpu.stage_8'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -142,10 +274,10 @@ def stage_8(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['gpu.stage_8'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
 
 
 @queue.task(bind=True, typing=True)
@@ -153,7 +285,7 @@ def poststage_0(self: Task, raw_input: dict) -> dict:
     input = AnyStageInput.model_validate(raw_input)
 
     tmp_dir = get_tmp_dir(input.job_id)
-    load_data(tmp_dir, input.job_id)
+    load_data(tmp_dir, input.job_id, STAGES['gpu.poststage_0'].inputs)
     context = load_context(tmp_dir)
 
     logs = wait_docker_exit(
@@ -172,7 +304,7 @@ def poststage_0(self: Task, raw_input: dict) -> dict:
     logger.info(f"{logs=}")
 
     save_context(tmp_dir, context)
-    save_data(tmp_dir, input.job_id)
+    save_data(tmp_dir, input.job_id, STAGES['gpu.poststage_0'].get_output_layers(context))
     # shutil.rmtree(tmp_dir)
 
-    return {}
+    return make_stage_result()
@@ -0,0 +1,222 @@
+from typing import Iterator, Optional, Tuple
+
+import os
+import json
+import logging
+import contextlib
+
+import docker
+import docker.errors
+import docker.models.containers
+
+from settings import settings
+from storage.cache import locked
+
+logger = logging.getLogger("sd_cloud.queues.pool")
+
+POOL_DIRNAME = '.pool'
+
+
+# Note: Warm containers are long-lived and shared by all workers of the node. Each of them is leased by holding
+#   a lock of its slot, so a container runs one stage at a time and dies with its lease holder's process
+class WarmSlot:
+    def __init__(self, cache_dir: str, image: str, index: int):
+        self.cache_dir = cache_dir
+        self.image = image
+        self.index = index
+
+        self.name = f"sd-blender-pool-{settings.QUEUE_IMAGE_TAG.value}-{index}"
+
+        pool_dir = os.path.join(cache_dir, POOL_DIRNAME)
+        os.makedirs(pool_dir, exist_ok=True)
+
+        self.lock_path = os.path.join(pool_dir, f"{self.name}.lock")
+        self.state_path = os.path.join(pool_dir, f"{self.name}.json")
+
+    def read_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r') as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def write_state(self, state: dict):
+        with open(self.state_path + '.part', 'w') as state_file:
+            json.dump(state, state_file)
+
+        os.replace(self.state_path + '.part', self.state_path)
+
+
+def _get_memory_usage(container: docker.models.containers.Container) -> int:
+    return container.stats(stream=False).get("memory_stats", {}).get("usage", 0)
+
+
+def _start_container(client: docker.DockerClient, slot: WarmSlot) -> docker.models.containers.Container:
+    with contextlib.suppress(docker.errors.NotFound):
+        client.containers.get(slot.name).remove(force=True)
+
+    # Note: Whole node cache is mounted under the same path, job directories are linked into `/workdir` per stage
+    container = client.containers.run(
+        name=slot.name,
+        image=slot.image,
+        command=['sleep', 'infinity'],
+        volumes=[f'{slot.cache_dir}:{slot.cache_dir}'],
+        environment={
+            "OPENCV_IO_ENABLE_OPENEXR": 1
+        },
+        detach=True,
+        mem_limit='48g',
+    )
+
+    slot.write_state({"tasks": 0, "baseline_memory": _get_memory_usage(container), "task_name": None})
+    logger.info(f"Started warm container {slot.name}")
+
+    return container
+
+
+def _get_container(client: docker.DockerClient, slot: WarmSlot) -> docker.models.containers.Container:
+    try:
+        container = client.containers.get(slot.name)
+    except docker.errors.NotFound:
+        return _start_container(client, slot)
+
+    if container.status != 'running' or slot.image not in container.image.tags:
+        return _start_container(client, slot)
+
+    return container
+
+
+# Note: Container is recycled after a number of stages, or once its memory grew too much, e.g. due to leaks.
+#   Reading container stats blocks for a second or two, so memory is only sampled every `BLENDER_POOL_MEMORY_CHECK_TASKS`
+def _recycle_if_needed(container: docker.models.containers.Container, slot: WarmSlot):
+    state = slot.read_state()
+    state["tasks"] = state.get("tasks", 0) + 1
+    state["task_name"] = None
+    slot.write_state(state)
+
+    try:
+        if state["tasks"] >= settings.BLENDER_POOL_MAX_TASKS:
+            logger.info(f"Recycling warm container {slot.name} after {state['tasks']} tasks")
+            container.remove(force=True)
+            return
+
+        if state["tasks"] % max(settings.BLENDER_POOL_MEMORY_CHECK_TASKS, 1) != 0:
+            return
+
+        growth = _get_memory_usage(container) - state.get("baseline_memory", 0)
+
+        if growth >= settings.BLENDER_POOL_MAX_MEMORY_GROWTH_MB * 1024 ** 2:
+            logger.info(f"Recycling warm container {slot.name} after {state['tasks']} tasks, memory grew by {growth} bytes")
+            container.remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+
+# Note: Mimics container returned by cold run, so `wait_docker_exit` handles both the same way
+class WarmExecution:
+    def __init__(self, client: docker.DockerClient, container: docker.models.containers.Container, slot: WarmSlot,
+                 lease: contextlib.ExitStack, exec_id: str):
+        self.client = client
+        self.container = container
+        self.slot = slot
+        self.lease = lease
+        self.exec_id = exec_id
+
+    def logs(self, timestamps: bool = False, stream: bool = True) -> Iterator[bytes]:
+        try:
+            yield from self.client.api.exec_start(self.exec_id, stream=True)
+
+            _recycle_if_needed(self.container, self.slot)
+        finally:
+            self.lease.close()
+
+    def remove(self, force: bool = False):
+        with contextlib.suppress(docker.errors.NotFound):
+            self.container.remove(force=force)
+
+        self.lease.close()
+
+
+def _lease_slot(cache_dir: str, image: str) -> Optional[Tuple[WarmSlot, contextlib.ExitStack]]:
+    for index in range(settings.BLENDER_POOL_SIZE):
+        slot = WarmSlot(cache_dir, image, index)
+
+        lease = contextlib.ExitStack()
+        if lease.enter_context(locked(slot.lock_path, blocking=False)):
+            return slot, lease
+
+        lease.close()
+
+    return None
+
+
+# Note: Stage is run with `docker exec` in a leased warm container, which saves container creation and start.
+#   Returns `None` when all containers are busy, then the stage falls back to a cold container
+def run_warm_command(cache_dir: str, image: str, container_name: str, context: dict, command: str) -> Optional[WarmExecution]:
+    if settings.BLENDER_POOL_SIZE <= 0:
+        return None
+
+    leased = _lease_slot(cache_dir, image)
+
+    if leased is None:
+        logger.info(f"Warm pool is exhausted, running {container_name} in cold container")
+        return None
+
+    slot, lease = leased
+
+    try:
+        client = docker.from_env()
+        container = _get_container(client, slot)
+
+        state = slot.read_state()
+        state["task_name"] = container_name
+        slot.write_state(state)
+
+        # Note: Job directories are linked to the same locations cold run mounts them to, links are replaced by each stage
+        link_workdir = "; ".join([
+            "mkdir -p /workdir/job /workdir/blender_workdir/job",
+            "rm -rf /workdir/job/input /workdir/job/output /workdir/blender_workdir/job/output",
+            f"ln -s {context['local_input_dir']} {context['docker_input_dir']}",
+            f"ln -s {context['local_output_dir']} {context['docker_output_dir']}",
+            f"ln -s {context['local_output_dir']} /workdir/blender_workdir/job/output",
+        ])
+
+        exec_id = client.api.exec_create(
+            container.id,
+            cmd=[
+                'bash', '-e', '-c',
+                "trap 'echo \\Exit\\Code\\Error' ERR INT" + "; " + link_workdir + "; " + command.format(**context),
+                container_name,
+            ],
+            stdout=True,
+            stderr=True,
+        )["Id"]
+
+        return WarmExecution(client, container, slot, lease, exec_id)
+    except Exception:
+        lease.close()
+        raise
+
+
+# Note: Revoked stage may run in a warm container, which is then removed altogether
+def kill_warm_command(cache_dir: str, container_name: str) -> bool:
+    pool_dir = os.path.join(cache_dir, POOL_DIRNAME)
+
+    if not os.path.exists(pool_dir):
+        return False
+
+    client = docker.from_env()
+    for filename in os.listdir(pool_dir):
+        if not filename.endswith('.json'):
+            continue
+
+        with open(os.path.join(pool_dir, filename), 'r') as state_file:
+            state = json.load(state_file)
+
+        if state.get("task_name") == container_name:
+            with contextlib.suppress(docker.errors.NotFound):
+                client.containers.get(filename.removesuffix('.json')).remove(force=True)
+
+            return True
+
+    return False
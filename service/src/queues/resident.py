@@ -0,0 +1,272 @@
+from typing import Iterator, List, Optional
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import contextlib
+
+import docker
+import docker.errors
+import docker.models.containers
+
+from queues.devices import get_device_requests
+from settings import settings
+from storage.cache import locked
+
+logger = logging.getLogger("sd_cloud.queues.resident")
+
+RESIDENT_DIRNAME = '.comfywr'
+SERVER_SCRIPT = '/workdir/server/comfywr_server.py'
+
+
+# Note: One resident server runs per GPU device of the node and image tag. It keeps diffusion weights loaded between
+#   stages, its socket and state live in node cache directory, which is mounted into the server under the same path
+class ResidentServer:
+    def __init__(self, cache_dir: str, image: str, device: Optional[str] = None):
+        self.cache_dir = cache_dir
+        self.image = image
+        self.device = device
+
+        self.name = f"sd-comfywr-server-{settings.QUEUE_IMAGE_TAG.value}"
+
+        if device is not None:
+            self.name += f"-{device}"
+
+        resident_dir = os.path.join(cache_dir, RESIDENT_DIRNAME)
+        os.makedirs(resident_dir, exist_ok=True)
+
+        self.socket_path = os.path.join(resident_dir, f"{self.name}.sock")
+        self.lock_path = os.path.join(resident_dir, f"{self.name}.lock")
+        self.state_path = os.path.join(resident_dir, f"{self.name}.json")
+
+    def write_state(self, state: dict):
+        with open(self.state_path + '.part', 'w') as state_file:
+            json.dump(state, state_file)
+
+        os.replace(self.state_path + '.part', self.state_path)
+
+    def read_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r') as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def connect(self, timeout: Optional[float] = None) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+
+        try:
+            connection.connect(self.socket_path)
+        except OSError:
+            connection.close()
+            raise
+
+        return connection
+
+    def request(self, request: dict) -> dict:
+        with self.connect(timeout=60) as connection, connection.makefile('r') as reader:
+            connection.sendall((json.dumps(request) + "\n").encode())
+
+            return json.loads(reader.readline())
+
+    def is_ready(self) -> bool:
+        try:
+            self.request({"cmd": "metrics"})
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+def _start_server(client: docker.DockerClient, server: ResidentServer) -> docker.models.containers.Container:
+    with contextlib.suppress(docker.errors.NotFound):
+        client.containers.get(server.name).remove(force=True)
+
+    container = client.containers.run(
+        name=server.name,
+        image=server.image,
+        command=[
+            'python', SERVER_SCRIPT,
+            '--socket', server.socket_path,
+            '--cache_gb', str(settings.COMFYWR_SERVER_CACHE_GB),
+        ],
+        volumes=[f'{server.cache_dir}:{server.cache_dir}'],
+        environment={
+            "OPENCV_IO_ENABLE_OPENEXR": 1
+        },
+        detach=True,
+        device_requests=get_device_requests(server.device),
+        mem_limit='48g',
+    )
+
+    logger.info(f"Started resident server {server.name}")
+
+    deadline = time.monotonic() + settings.COMFYWR_SERVER_START_TIMEOUT_SECONDS
+    while not server.is_ready():
+        container.reload()
+
+        if container.status != 'running' or time.monotonic() > deadline:
+            logs = container.logs().decode(errors='replace')
+            container.remove(force=True)
+
+            raise Exception(f"Resident server {server.name} didn't start: {logs}")
+
+        time.sleep(1)
+
+    return container
+
+
+def _get_server_container(client: docker.DockerClient, server: ResidentServer) -> docker.models.containers.Container:
+    try:
+        container = client.containers.get(server.name)
+    except docker.errors.NotFound:
+        return _start_server(client, server)
+
+    if container.status != 'running' or server.image not in container.image.tags or not server.is_ready():
+        return _start_server(client, server)
+
+    return container
+
+
+# Note: Mimics container returned by cold run, so `wait_docker_exit` handles both the same way
+class ResidentExecution:
+    def __init__(self, server: ResidentServer, container: docker.models.containers.Container,
+                 connection: socket.socket, lease: contextlib.ExitStack):
+        self.server = server
+        self.container = container
+        self.connection = connection
+        self.lease = lease
+
+    def logs(self, timestamps: bool = False, stream: bool = True) -> Iterator[bytes]:
+        try:
+            with self.connection:
+                while chunk := self.connection.recv(64 * 1024):
+                    yield chunk
+        finally:
+            self.server.write_state({"task_name": None})
+            self.lease.close()
+
+    def remove(self, force: bool = False):
+        with contextlib.suppress(docker.errors.NotFound):
+            self.container.remove(force=force)
+
+        self.connection.close()
+        self.lease.close()
+
+
+# Note: Python stage script is run by the resident server, which reuses weights loaded by earlier stages.
+#   Returns `None` when server is busy or can't be started, then stage falls back to a cold container
+def run_resident_command(cache_dir: str, image: str, container_name: str, context: dict, argv: List[str],
+                         device: Optional[str] = None) -> Optional[ResidentExecution]:
+    if not settings.COMFYWR_SERVER:
+        return None
+
+    server = ResidentServer(cache_dir, image, device)
+
+    lease = contextlib.ExitStack()
+    if not lease.enter_context(locked(server.lock_path, blocking=False)):
+        lease.close()
+
+        logger.info(f"Resident server is busy, running {container_name} in cold container")
+        return None
+
+    try:
+        container = _get_server_container(docker.from_env(), server)
+
+        server.write_state({"task_name": container_name})
+
+        connection = server.connect()
+        connection.sendall((json.dumps({
+            "cmd": "run",
+            "argv": argv,
+            # Note: Job directories are linked to the same locations cold run mounts them to
+            "links": {
+                context["docker_input_dir"]: context["local_input_dir"],
+                context["docker_output_dir"]: context["local_output_dir"],
+                "/workdir/blender_workdir/job/output": context["local_output_dir"],
+            },
+        }) + "\n").encode())
+
+        return ResidentExecution(server, container, connection, lease)
+    except Exception as e:
+        lease.close()
+
+        logger.exception(e)
+        logger.info(f"Resident server is unavailable, running {container_name} in cold container")
+        return None
+
+
+def _is_server_alive(socket_path: str) -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection, connection.makefile('r') as reader:
+            connection.settimeout(1)
+            connection.connect(socket_path)
+            connection.sendall((json.dumps({"cmd": "metrics"}) + "\n").encode())
+
+            return len(reader.readline()) > 0
+    except OSError:
+        return False
+
+
+# Note: Servers of any image tag that answer on their socket are counted. Sockets and state files of servers
+#   that exited or were removed are left behind, so they aren't counted
+def count_resident_servers(cache_dir: str) -> int:
+    resident_dir = os.path.join(cache_dir, RESIDENT_DIRNAME)
+
+    if not os.path.exists(resident_dir):
+        return 0
+
+    return sum(
+        _is_server_alive(os.path.join(resident_dir, filename))
+        for filename in os.listdir(resident_dir)
+        if filename.endswith('.sock')
+    )
+
+
+# Note: Revoked stage may run in a resident server, which is then restarted, as script can't be stopped otherwise
+def kill_resident_command(cache_dir: str, container_name: str) -> bool:
+    resident_dir = os.path.join(cache_dir, RESIDENT_DIRNAME)
+
+    if not os.path.exists(resident_dir):
+        return False
+
+    for filename in os.listdir(resident_dir):
+        if not filename.endswith('.json'):
+            continue
+
+        try:
+            with open(os.path.join(resident_dir, filename), 'r') as state_file:
+                state = json.load(state_file)
+        except json.JSONDecodeError:
+            continue
+
+        if state.get("task_name") == container_name:
+            with contextlib.suppress(docker.errors.NotFound):
+                docker.from_env().containers.get(filename.removesuffix('.json')).remove(force=True)
+
+            return True
+
+    return False
+
+
+# Note: Operators inspect and manage servers of the node's devices with e.g.:
+#   python -m queues.resident metrics
+#   python -m queues.resident load /workdir/ComfyUI/models/loras/style.safetensors
+#   python -m queues.resident unload [path]
+if __name__ == "__main__":
+    from queues.base import get_cache_dir, get_comfywr_image
+    from queues.devices import get_devices
+
+    cmd, *args = sys.argv[1:]
+
+    for device in get_devices(get_cache_dir()) or [None]:
+        print(json.dumps({
+            "device": device,
+            **ResidentServer(get_cache_dir(), get_comfywr_image(), device).request({
+                "cmd": cmd,
+                "path": args[0] if len(args) > 0 else None,
+            }),
+        }, indent=2))
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional
+
+from dataclasses import dataclass, field
+
+import os
+
+
+# Note: Layers are named after the context key that holds the stage output directory,
+#   except for the two layers that exist before stage directories are known
+INPUT_LAYER = 'input'
+CONFIG_LAYER = 'config'
+
+STATIC_LAYER_PATHS: Dict[str, List[str]] = {
+    INPUT_LAYER: [os.path.join('job', 'input')],
+    CONFIG_LAYER: [os.path.join('job', 'context'), os.path.join('job', 'output')],
+}
+
+
+def get_layer_paths(layer: str, context: dict) -> List[str]:
+    if layer in STATIC_LAYER_PATHS:
+        return STATIC_LAYER_PATHS[layer]
+
+    path = context[layer]
+
+    # Note: Context paths are relative to `/workdir` inside containers, which maps onto the local `tmp_dir`
+    if os.path.isabs(path):
+        path = os.path.relpath(path, '/workdir')
+
+    return [path]
+
+
+# Note: Stage inputs are layers its scripts read, `None` means stage reads whole job directory.
+#   Stages with `memo_fields` are deterministic given their inputs and those payload fields,
+#   so their outputs are reused across jobs. Stages with `batch_fields` are run for several jobs by one task,
+#   when those payload fields match. Stages with `adapter_fields` load models those payload fields select,
+#   so they are routed to the node that has them loaded already.
+#   GPU stages declare VRAM and RAM they take, so light stages are run next to heavy ones on the same device
+@dataclass(frozen=True)
+class Stage:
+    inputs: Optional[List[str]] = None
+    outputs: List[str] = field(default_factory=list)
+    memo_fields: Optional[List[str]] = None
+    batch_fields: Optional[List[str]] = None
+    adapter_fields: Optional[List[str]] = None
+    vram_gb: float = 0
+    ram_gb: float = 0
+
+    def get_output_layers(self, context: dict) -> Dict[str, List[str]]:
+        return {layer: get_layer_paths(layer, context) for layer in self.outputs}
+
+
+STAGES: Dict[str, Stage] = {
+    'cpu.prestage_0': Stage(
+        inputs=[INPUT_LAYER],
+        outputs=[CONFIG_LAYER],
+    ),
+    'cpu.stage_0': Stage(
+        inputs=[INPUT_LAYER, CONFIG_LAYER],
+        outputs=['preprocessed_massings_path'],
+        memo_fields=[
+            'input_meshes', 'random_seed', 'total_remesh_mode', 'texture_processing_resolution', 'disable_3d',
+            'direct_config_override',
+        ],
+    ),
+    'cpu.stage_1': Stage(
+        inputs=[CONFIG_LAYER, 'preprocessed_massings_path'],
+        outputs=['prior_renders_path'],
+        memo_fields=[
+            'random_seed', 'texture_processing_resolution', 'n_cameras', 'camera_pitches', 'camera_yaws',
+            'depth_algorithm', 'direct_config_override',
+        ],
+    ),
+    # Note: Style images are part of input layer
+    'gpu.stage_2': Stage(
+        inputs=[INPUT_LAYER, CONFIG_LAYER, 'prior_renders_path'],
+        outputs=['generated_textures_path'],
+        # Note: Jobs with the same models, step counts and resolution reuse weights loaded for each other
+        batch_fields=['loras', 'stages_steps', 'texture_processing_resolution', 'direct_config_override'],
+        adapter_fields=['loras', 'direct_config_override'],
+        vram_gb=20,
+        ram_gb=24,
+    ),
+    'cpu.stage_3': Stage(
+        inputs=[CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path'],
+        outputs=['projection_output'],
+    ),
+    'gpu.stage_4': Stage(
+        inputs=[CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path'],
+        outputs=['semantics_output_dir'],
+        vram_gb=6,
+        ram_gb=8,
+    ),
+    # 'cpu.stage_5': Stage(
+    #     inputs=[CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path'],
+    #     outputs=['refinement_output_dir'],
+    # ),
+    'cpu.stage_6': Stage(
+        inputs=[CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path'],
+        outputs=['total_grid_output_dir'],
+    ),
+    'gpu.stage_7': Stage(
+        inputs=[CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path'],
+        outputs=['displacement_output'],
+        vram_gb=4,
+        ram_gb=8,
+    ),
+    'gpu.stage_8': Stage(
+        inputs=[CONFIG_LAYER, 'projection_output', 'displacement_output'],
+        outputs=['upscaled_textures_path'],
+        adapter_fields=['loras', 'direct_config_override'],
+        vram_gb=20,
+        ram_gb=24,
+    ),
+    'cpu.stage_9': Stage(
+        inputs=[
+            CONFIG_LAYER, 'preprocessed_massings_path', 'prior_renders_path', 'generated_textures_path',
+            'projection_output', 'displacement_output', 'upscaled_textures_path',
+        ],
+        outputs=['final_path'],
+    ),
+    'gpu.poststage_0': Stage(
+        outputs=['final_render'],
+        vram_gb=6,
+        ram_gb=8,
+    ),
+    'cpu.cleanup': Stage(),
+}
+
+
+# Note: Maps each layer to the last of `steps` that produces it
+def get_layer_producers(steps: List[str]) -> Dict[str, str]:
+    producers = {}
+    for step in steps:
+        for layer in STAGES[step].outputs:
+            producers[layer] = step
+
+    return producers
+
+
+# Note: Step depends on the last preceding step that produces each of its input layers,
+#   steps that read whole job directory depend on all preceding steps
+def get_step_dependencies(steps: List[str]) -> Dict[str, List[str]]:
+    dependencies = {}
+    for i, step in enumerate(steps):
+        inputs = STAGES[step].inputs
+
+        if inputs is None:
+            dependencies[step] = steps[:i]
+            continue
+
+        producers = get_layer_producers(steps[:i])
+
+        dependencies[step] = sorted({producers[layer] for layer in inputs if layer in producers}, key=steps.index)
+
+    return dependencies
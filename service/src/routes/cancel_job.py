@@ -2,14 +2,11 @@ from dataclasses import dataclass
 
 from celery.result import AsyncResult
 from fastapi import APIRouter, Depends, Query
-from google.cloud import storage
 from starlette.responses import JSONResponse
 
 import queues.cpu
 import queues.gpu
-from database import Job
-
-client_storage = storage.Client()
+from database import Job, JobStatus, connection, write_transaction
 
 router = APIRouter()
 
@@ -20,24 +17,41 @@ class CancelJobConfig:
 
 
 @router.get("/cancel_job")
+@connection()
 def cancel_job(
         config: CancelJobConfig = Depends(),
 ):
     job_id = config.job_id
 
-    job = Job.select().where(
-        Job.id == job_id
-    ).first()
+    # Note: Job coalesced from several submissions keeps running for the others, cancelling only detaches the caller
+    with write_transaction():
+        job = Job.select().where(
+            Job.id == job_id
+        ).first()
+
+        job.attachments -= 1
+
+        if job.attachments <= 0:
+            job.status = "CANCELLED"
+
+        job.save()
+
+    if job.status == "CANCELLED":
+        # Note: Independent steps of the job may run in parallel, so every unfinished one is revoked
+        for step, step_state in job.get_step_states().items():
+            if step_state["status"] not in (JobStatus.SCHEDULED, JobStatus.RUNNING):
+                continue
 
-    job.status = "CANCELLED"
-    job.save()
+            # Note: Batch task also runs steps of other jobs, result of a cancelled one is ignored instead
+            if "batch_size" in step_state:
+                continue
 
-    if job.current_step.startswith("gpu"):
-        queue = queues.gpu.queue
-    else:
-        queue = queues.cpu.queue
+            if step.startswith("gpu"):
+                queue = queues.gpu.queue
+            else:
+                queue = queues.cpu.queue
 
-    AsyncResult(id=job.celery_job_ids[-1], app=queue).revoke(terminate=True)
+            AsyncResult(id=step_state["task_id"], app=queue).revoke(terminate=True)
 
     return JSONResponse(
         content={
@@ -3,11 +3,8 @@ from dataclasses import dataclass
 from fastapi import APIRouter, Depends, Query
 from starlette.responses import JSONResponse
 
-from google.cloud import storage
-
-from database import Job
-
-client_storage = storage.Client()
+import estimates
+from database import Job, connection
 
 router = APIRouter()
 
@@ -18,6 +15,7 @@ class CheckStatusConfig:
 
 
 @router.get("/check_status")
+@connection()
 def check_status(
         config: CheckStatusConfig = Depends(),
 ):
@@ -32,5 +30,8 @@ def check_status(
             "status": job.status,
             "progress": [job.progress, job.total],
             "logs": job.logs,
+            # Note: Estimated time until the job finishes once its steps get workers, `None` for failed jobs
+            "eta_seconds": estimates.estimate_remaining_seconds(job),
+            "queue_position": estimates.get_queue_position(job),
         }
     )
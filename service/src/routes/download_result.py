@@ -3,11 +3,7 @@ from dataclasses import dataclass
 from fastapi import APIRouter, Depends, Query
 from starlette.responses import JSONResponse
 
-from google.cloud import storage
-
-from settings import settings
-
-client_storage = storage.Client()
+from storage import get_backend, get_result_key
 
 router = APIRouter()
 
@@ -23,14 +19,10 @@ def get_download_url(
 ):
     job_id = config.job_id
 
-    data_bucket = client_storage.bucket(settings.SD_DATA_STORAGE_BUCKET_NAME)
-
-    output_blob = data_bucket.blob(f"{job_id}/data.zip")
-
-    output_blob.make_public()
+    download_url = get_backend().get_public_url(get_result_key(job_id))
 
     return JSONResponse(
         content={
-            "download_url": output_blob.public_url
+            "download_url": download_url
         }
     )
@@ -0,0 +1,36 @@
+import uuid
+
+from fastapi import APIRouter, Depends
+
+import estimates
+from database import connection
+from queues.stages import get_step_dependencies
+from routes.schedule_job import RunConfig, _parse_variants, _get_inputs, _get_steps, _get_input_size
+
+router = APIRouter()
+
+
+# Note: Dry run of `/schedule_job`, quotes runtime of each variant from durations of earlier stages without creating jobs.
+#   Time of waiting for workers isn't included, queue position of the new job is reported instead
+@router.post("/estimate_job")
+@connection()
+def estimate_job(
+        config: RunConfig = Depends(),
+):
+    variants = _parse_variants(config.variants)
+    job_ids = [str(uuid.uuid4()) for _ in range(max(len(variants), 1))]
+
+    inputs = _get_inputs(config, job_ids, variants)
+
+    results = []
+    for input in inputs:
+        steps = _get_steps(input)
+        features = estimates.get_cost_features(input.model_dump(), _get_input_size(config))
+
+        results.append(estimates.estimate_steps(steps, get_step_dependencies(steps), features))
+
+    return {
+        "seconds": results[0]["seconds"],
+        "estimates": results,
+        "queue_position": estimates.get_new_job_queue_position(_get_steps(inputs[0])[0], config.priority),
+    }
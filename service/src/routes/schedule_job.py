@@ -1,7 +1,7 @@
 import shutil
 import pathlib
 import tempfile
-from typing import List
+from typing import Dict, List, Optional
 
 from dataclasses import dataclass
 
@@ -9,19 +9,27 @@ import os
 import math
 import json
 import uuid
+import hashlib
+import logging
+import datetime
 
-from fastapi import APIRouter, Form, File, UploadFile, Depends, Request
-
-from google.cloud import storage
+import pydantic
+from fastapi import APIRouter, Form, File, UploadFile, Depends, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
 
 import queues.cpu
-from database import Job
+from database import Job, JobStatus, JobPriority, connection, write_transaction, lock_keys
+from events import JobEventKind, publish_job_event
 from queues.base import save_data
-
-client_storage = storage.Client()
+from queues.stages import INPUT_LAYER, get_layer_paths, get_step_dependencies
+from settings import settings
+from storage import get_backend, link_layer, hash_file, collect_paths
 
 router = APIRouter()
 
+logger = logging.getLogger("sd_cloud.server")
+
 
 @dataclass
 class RunConfig:
@@ -64,33 +72,21 @@ class RunConfig:
 
     texture_final_resolution: List[int] = Form(default=[2560, 8192, 2560, 8192], min_length=4, max_length=4)
 
+    priority: JobPriority = Form(default=JobPriority.NORMAL)
+    # Note: Defaults to address of the client
+    submitter: Optional[str] = Form(default=None)
 
-@router.post("/schedule_job")
-def schedule_job(
-        config: RunConfig = Depends(),
-):
-    job_id = str(uuid.uuid4())
-    config.enable_semantics = False
-
-    input_meshes = [(f'{i:0>3}_{file.filename}', file) for i, file in enumerate(config.input_meshes)]
-    style_images = [(f'{i:0>3}_{file.filename}', file) for i, file in enumerate(config.style_images)]
+    # Note: JSON list of field overrides, a separate job is created for each of them.
+    #   Variants that agree on fields of shared stages run those stages once
+    variants: str = Form(default="[]")
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        job_input_dir = os.path.join(tmpdir, 'job', 'input')
-        os.makedirs(job_input_dir, exist_ok=True)
-        for filename, input_mesh in input_meshes:
-            with open(os.path.join(job_input_dir, filename), 'wb') as f:
-                shutil.copyfileobj(input_mesh.file, f)
 
-        style_images_dir = os.path.join(job_input_dir, 'style_images')
-        os.makedirs(style_images_dir, exist_ok=True)
-        for filename, style_file in style_images:
-            with open(os.path.join(style_images_dir, filename), 'wb') as f:
-                shutil.copyfileobj(style_file.file, f)
+# Note: Uploaded files are shared by all variants, semantics are disabled for all jobs
+VARIANT_FIELDS = set(queues.cpu.PreStage0Input.model_fields) - {"job_id", "input_meshes", "style_images_paths", "enable_semantics"}
 
-        save_data(tmpdir, job_id)
 
-    steps = list(filter(
+def _get_steps(input: queues.cpu.PreStage0Input) -> List[str]:
+    return list(filter(
         lambda x: x is not None,
         [
             'cpu.prestage_0',
@@ -98,12 +94,12 @@ def schedule_job(
             'cpu.stage_1',
             'gpu.stage_2',
 
-            *['cpu.stage_3' if not config.disable_3d else None],
-            *['gpu.stage_4' if config.enable_semantics else None],
+            *['cpu.stage_3' if not input.disable_3d else None],
+            *['gpu.stage_4' if input.enable_semantics else None],
 
-            *['gpu.stage_7' if not config.disable_displacement else None],
-            *['gpu.stage_8' if config.enable_uv_texture_upscale and not config.disable_3d else None],
-            *['cpu.stage_9' if not config.disable_3d else None],
+            *['gpu.stage_7' if not input.disable_displacement else None],
+            *['gpu.stage_8' if input.enable_uv_texture_upscale and not input.disable_3d else None],
+            *['cpu.stage_9' if not input.disable_3d else None],
 
             # 'gpu.poststage_0',
 
@@ -111,52 +107,265 @@ def schedule_job(
         ]
     ))
 
-    job: Job = Job.create(
-        id=job_id,
-        total=len(steps),
-        steps=json.dumps(steps),
-        payload=json.dumps(queues.cpu.PreStage0Input(
-            job_id=job_id,
-
-            pos_prompt=config.pos_prompt,
-            neg_prompt=config.neg_prompt,
-            prompt_strength=config.prompt_strength,
-            random_seed=int(config.random_seed),
-            disable_displacement=config.disable_displacement,
-            texture_processing_resolution=config.texture_processing_resolution,
-            input_meshes=[filename for filename, _ in input_meshes],
-            style_images_paths=[filename for filename, _ in style_images],
-            style_images_weights=config.style_images_weights,
-            shadeless_strength=config.shadeless_strength,
-            loras=config.loras,
-            loras_weights=config.loras_weights,
-
-            stages_steps=config.stages_steps,
-            disable_3d=config.disable_3d,
-
-            apply_displacement_to_mesh=config.apply_displacement_to_mesh,
-            direct_config_override=config.direct_config_override,
-
-            stages_denoise=config.stages_denoise,
-            depth_algorithm=config.depth_algorithm,
-            displacement_quality=config.displacement_quality,
-
-            stages_upscale=config.stages_upscale,
-
-            displacement_rgb_derivation_weight=config.displacement_rgb_derivation_weight,
-            enable_uv_texture_upscale=config.enable_uv_texture_upscale,
-            enable_semantics=config.enable_semantics,
-            displacement_strength=config.displacement_strength,
-
-            n_cameras=config.n_cameras,
-            camera_pitches=config.camera_pitches,
-            camera_yaws=config.camera_yaws,
-
-            total_remesh_mode=config.total_remesh_mode,
-            stages_enable=config.stages_enable,
-
-            texture_final_resolution=config.texture_final_resolution,
-        ).model_dump()),
+
+# Note: Relative cost of a job in runs of texture generation, optional stages are weighted by parameters
+#   that make them slower
+def _get_job_cost(input: queues.cpu.PreStage0Input, steps: List[str]) -> float:
+    cost = 1.0
+
+    if 'cpu.stage_3' in steps:
+        cost += 0.5
+    if 'gpu.stage_7' in steps:
+        cost += 0.25 * input.displacement_quality
+    if 'gpu.stage_8' in steps:
+        cost += 0.5 * max(input.stages_upscale) * max(sum(input.enable_uv_texture_upscale), 1)
+    if 'cpu.stage_9' in steps:
+        cost += 0.5
+
+    return cost
+
+
+def _parse_variants(raw_variants: str) -> List[dict]:
+    try:
+        variants = json.loads(raw_variants)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError([{"loc": ("body", "variants"), "msg": str(e), "type": "value_error.json"}])
+
+    if not isinstance(variants, list) or not all(isinstance(variant, dict) for variant in variants):
+        raise RequestValidationError([{"loc": ("body", "variants"), "msg": "must be a list of objects", "type": "type_error"}])
+
+    errors = [
+        {"loc": ("body", "variants", i, field), "msg": "field can't be varied", "type": "value_error"}
+        for i, variant in enumerate(variants)
+        for field in variant
+        if field not in VARIANT_FIELDS
+    ]
+    if len(errors) > 0:
+        raise RequestValidationError(errors)
+
+    return variants
+
+
+def _hash_input(tmpdir: str) -> Dict[str, str]:
+    files, _ = collect_paths(tmpdir, get_layer_paths(INPUT_LAYER, {}))
+
+    return {path: hash_file(os.path.join(tmpdir, path)) for path in files}
+
+
+def _get_submission_fingerprint(input_digests: Dict[str, str], input: queues.cpu.PreStage0Input) -> str:
+    key = {
+        "input": input_digests,
+        "payload": input.model_dump(exclude={"job_id"}),
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _find_coalesced_job(fingerprint: str) -> Optional[Job]:
+    if settings.COALESCE_WINDOW_SECONDS <= 0:
+        return None
+
+    return Job.select().where(
+        Job.fingerprint == fingerprint,
+        Job.status.in_([JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.RUNNING]),
+        Job.created_at >= datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.COALESCE_WINDOW_SECONDS),
+    ).order_by(Job.created_at.desc()).first()
+
+
+# Note: Backlog is bounded, so queue latency is too. Clients are asked to retry later, the further over the limit
+#   the backlog is, the later
+def _check_backlog(new_jobs: int) -> Optional[JSONResponse]:
+    if settings.ADMISSION_MAX_BACKLOG_JOBS <= 0:
+        return None
+
+    backlog = Job.select().where(
+        Job.status.in_([JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.RUNNING])
+    ).count()
+
+    if backlog + new_jobs <= settings.ADMISSION_MAX_BACKLOG_JOBS:
+        return None
+
+    retry_after = math.ceil(settings.ADMISSION_RETRY_AFTER_SECONDS * (backlog + new_jobs) / settings.ADMISSION_MAX_BACKLOG_JOBS)
+
+    logger.info(f"Rejected submission of {new_jobs} jobs, backlog is {backlog} jobs")
+
+    return JSONResponse(
+        content={"message": f"Service is busy with {backlog} unfinished jobs, retry later"},
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(retry_after)},
     )
 
-    return {"job_id": job.id}
+
+def _name_uploads(files: List[UploadFile]) -> List[tuple]:
+    return [(f'{i:0>3}_{file.filename}', file) for i, file in enumerate(files)]
+
+
+# Note: Size of uploaded meshes is a cost parameter of stages, see `estimates.get_cost_features`
+def _get_input_size(config: RunConfig) -> int:
+    return sum(file.size or 0 for file in config.input_meshes)
+
+
+# Note: Payload of each variant, the first of them is the base of the others
+def _get_inputs(config: RunConfig, job_ids: List[str], variants: List[dict]) -> List[queues.cpu.PreStage0Input]:
+    config.enable_semantics = False
+
+    input_meshes = _name_uploads(config.input_meshes)
+    style_images = _name_uploads(config.style_images)
+
+    payload = queues.cpu.PreStage0Input(
+        job_id=job_ids[0],
+
+        pos_prompt=config.pos_prompt,
+        neg_prompt=config.neg_prompt,
+        prompt_strength=config.prompt_strength,
+        random_seed=int(config.random_seed),
+        disable_displacement=config.disable_displacement,
+        texture_processing_resolution=config.texture_processing_resolution,
+        input_meshes=[filename for filename, _ in input_meshes],
+        style_images_paths=[filename for filename, _ in style_images],
+        style_images_weights=config.style_images_weights,
+        shadeless_strength=config.shadeless_strength,
+        loras=config.loras,
+        loras_weights=config.loras_weights,
+
+        stages_steps=config.stages_steps,
+        disable_3d=config.disable_3d,
+
+        apply_displacement_to_mesh=config.apply_displacement_to_mesh,
+        direct_config_override=config.direct_config_override,
+
+        stages_denoise=config.stages_denoise,
+        depth_algorithm=config.depth_algorithm,
+        displacement_quality=config.displacement_quality,
+
+        stages_upscale=config.stages_upscale,
+
+        displacement_rgb_derivation_weight=config.displacement_rgb_derivation_weight,
+        enable_uv_texture_upscale=config.enable_uv_texture_upscale,
+        enable_semantics=config.enable_semantics,
+        displacement_strength=config.displacement_strength,
+
+        n_cameras=config.n_cameras,
+        camera_pitches=config.camera_pitches,
+        camera_yaws=config.camera_yaws,
+
+        total_remesh_mode=config.total_remesh_mode,
+        stages_enable=config.stages_enable,
+
+        texture_final_resolution=config.texture_final_resolution,
+    ).model_dump()
+
+    inputs = []
+    for job_id, variant in zip(job_ids, variants or [{}]):
+        try:
+            inputs.append(queues.cpu.PreStage0Input.model_validate({**payload, **variant, "job_id": job_id}))
+        except pydantic.ValidationError as e:
+            raise RequestValidationError(e.errors())
+
+    return inputs
+
+
+@router.post("/schedule_job")
+@connection()
+def schedule_job(
+        request: Request,
+        config: RunConfig = Depends(),
+):
+    variants = _parse_variants(config.variants)
+    job_ids = [str(uuid.uuid4()) for _ in range(max(len(variants), 1))]
+
+    if (response := _check_backlog(len(job_ids))) is not None:
+        return response
+
+    inputs = _get_inputs(config, job_ids, variants)
+
+    input_meshes = _name_uploads(config.input_meshes)
+    style_images = _name_uploads(config.style_images)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        job_input_dir = os.path.join(tmpdir, 'job', 'input')
+        os.makedirs(job_input_dir, exist_ok=True)
+        for filename, input_mesh in input_meshes:
+            with open(os.path.join(job_input_dir, filename), 'wb') as f:
+                shutil.copyfileobj(input_mesh.file, f)
+
+        style_images_dir = os.path.join(job_input_dir, 'style_images')
+        os.makedirs(style_images_dir, exist_ok=True)
+        for filename, style_file in style_images:
+            with open(os.path.join(style_images_dir, filename), 'wb') as f:
+                shutil.copyfileobj(style_file.file, f)
+
+        input_digests = _hash_input(tmpdir)
+
+        # Note: Identical variants share a job
+        fingerprints = [_get_submission_fingerprint(input_digests, input) for input in inputs]
+
+        unique_inputs = {}
+        for fingerprint, input in zip(fingerprints, inputs):
+            unique_inputs.setdefault(fingerprint, input)
+
+        first_input = next(iter(unique_inputs.values()))
+
+        # Note: Submissions identical to an unfinished job, e.g. retries of the CLI, attach to that job instead.
+        #   Inputs are only stored for jobs that look new, uploaded once and linked by other variants. Lookup and
+        #   creation of jobs share a write transaction locking their fingerprints, so concurrent identical submissions
+        #   can't both miss each other. Job whose coalesced job finished meanwhile has its input stored in next round.
+        #   Scheduler is notified once jobs are committed
+        coalesced = {}
+        new_inputs = []
+        stored = {}
+        remaining = dict(unique_inputs)
+        while len(remaining) > 0:
+            for fingerprint, input in remaining.items():
+                if fingerprint in stored or _find_coalesced_job(fingerprint) is not None:
+                    continue
+
+                if len(stored) == 0:
+                    save_data(tmpdir, input.job_id, {INPUT_LAYER: get_layer_paths(INPUT_LAYER, {})})
+                else:
+                    link_layer(get_backend(), next(iter(stored.values())), input.job_id, INPUT_LAYER)
+
+                stored[fingerprint] = input.job_id
+
+            with write_transaction():
+                lock_keys(list(remaining))
+
+                for fingerprint, input in list(remaining.items()):
+                    if (job := _find_coalesced_job(fingerprint)) is not None:
+                        logger.info(f"Submission of {input.job_id} is coalesced with {job.id}")
+
+                        Job.update(attachments=Job.attachments + 1).where(Job.id == job.id).execute()
+                        coalesced[fingerprint] = job.id
+                    elif fingerprint in stored:
+                        steps = _get_steps(input)
+
+                        Job.create(
+                            id=input.job_id,
+                            group_id=first_input.job_id if len(variants) > 0 else None,
+                            fingerprint=fingerprint,
+                            total=len(steps),
+                            steps=json.dumps(steps),
+                            dependencies=json.dumps(get_step_dependencies(steps)),
+                            payload=json.dumps(input.model_dump()),
+                            priority=config.priority,
+                            submitter=config.submitter or (request.client.host if request.client is not None else None),
+                            cost=_get_job_cost(input, steps),
+                            input_size=_get_input_size(config),
+                        )
+                        coalesced[fingerprint] = input.job_id
+                        new_inputs.append(input)
+                    else:
+                        continue
+
+                    del remaining[fingerprint]
+
+    for input in new_inputs:
+        publish_job_event(input.job_id, JobEventKind.SUBMITTED)
+
+    job_ids = [coalesced[fingerprint] for fingerprint in fingerprints]
+
+    return {
+        "job_id": job_ids[0],
+        "job_ids": job_ids,
+        "coalesced": [job_id != input.job_id for job_id, input in zip(job_ids, inputs)],
+    }
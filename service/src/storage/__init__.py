@@ -0,0 +1,5 @@
+from .backend import StorageBackend, GCSStorageBackend, LocalStorageBackend, get_backend
+from .compression import select_codec, compress_stream, decompress_stream, get_zip_compression
+from .cas import FileEntry, hash_file, put_file, get_file, read_file
+from .cache import IndexEntry, CacheStats, read_index, write_index, job_lock, in_use, read_stats, update_stats, enforce_budget
+from .artifacts import LayerManifest, collect_paths, get_layer_manifest_key, get_result_key, save_layer, link_layer, load_layer_manifests, load_layers, write_archive, save_result_archive, load_legacy_archives
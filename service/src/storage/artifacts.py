@@ -0,0 +1,183 @@
+from typing import BinaryIO, Dict, List, Optional, Tuple, TypedDict
+
+import os
+import json
+import logging
+import zipfile
+import concurrent.futures
+
+from settings import settings
+from storage.backend import StorageBackend
+from storage.cas import FileEntry, put_file, get_file
+from storage.cache import IndexEntry, CacheStats, lookup_index, make_index_entry
+from storage.compression import get_zip_compression
+
+logger = logging.getLogger("sd_cloud.storage.artifacts")
+
+
+# Note: Manifest of a layer maps file paths relative to the job `tmp_dir` to content-addressed blobs.
+#   Every layer has its own manifest object, so stages never rewrite manifests of other stages
+def get_layer_manifest_key(job_id: str, layer: str) -> str:
+    return f"{job_id}/layers/{layer}.json"
+
+
+def get_result_key(job_id: str) -> str:
+    return f"{job_id}/data.zip"
+
+
+class LayerManifest(TypedDict):
+    files: Dict[str, FileEntry]
+
+    # Note: Empty directories are kept as well, since stage scripts may expect them to exist
+    dirs: List[str]
+
+
+def collect_paths(tmp_dir: str, paths: List[str]) -> Tuple[List[str], List[str]]:
+    files, dirs = [], []
+    for path in paths:
+        local_path = os.path.join(tmp_dir, path)
+
+        if os.path.isfile(local_path):
+            files.append(path)
+
+        for root, _, filenames in os.walk(local_path):
+            dirs.append(os.path.relpath(root, tmp_dir))
+
+            for filename in filenames:
+                files.append(os.path.relpath(os.path.join(root, filename), tmp_dir))
+
+    return sorted(files), sorted(dirs)
+
+
+def save_layer(
+        backend: StorageBackend, tmp_dir: str, job_id: str, layer: str, paths: List[str],
+        index: Dict[str, IndexEntry],
+) -> LayerManifest:
+    files, dirs = collect_paths(tmp_dir, paths)
+
+    def save_file(path: str) -> FileEntry:
+        # Note: Files that are unchanged since they were indexed are already stored, no need to hash or upload them again
+        if (index_entry := lookup_index(index, tmp_dir, path)) is not None:
+            return FileEntry(**{key: value for key, value in index_entry.items() if key != "mtime_ns"})
+
+        entry = put_file(backend, os.path.join(tmp_dir, path))
+        index[path] = make_index_entry(os.path.join(tmp_dir, path), entry)
+
+        return entry
+
+    with concurrent.futures.ThreadPoolExecutor(settings.STORAGE_TRANSFER_CONCURRENCY) as executor:
+        manifest = LayerManifest(
+            files=dict(zip(files, executor.map(save_file, files))),
+            dirs=dirs,
+        )
+
+    backend.write_bytes(get_layer_manifest_key(job_id, layer), json.dumps(manifest).encode())
+
+    size = sum(entry["size"] for entry in manifest["files"].values())
+    stored_size = sum(entry.get("stored_size", entry["size"]) for entry in manifest["files"].values())
+    logger.info(f"Saved layer {layer} of {job_id}: {len(files)} files, {size} bytes, stored as {stored_size} bytes")
+
+    return manifest
+
+
+# Note: Layer is shared with another job by copying its manifest, blobs themselves are never copied
+def link_layer(backend: StorageBackend, src_job_id: str, dst_job_id: str, layer: str) -> None:
+    backend.write_bytes(get_layer_manifest_key(dst_job_id, layer), backend.read_bytes(get_layer_manifest_key(src_job_id, layer)))
+
+
+# Note: When `layers` are given, only their manifests are read, layers that weren't produced by the job are skipped
+def load_layer_manifests(backend: StorageBackend, job_id: str, layers: Optional[List[str]] = None) -> Dict[str, LayerManifest]:
+    if layers is None:
+        layers = [
+            os.path.basename(key).removesuffix('.json')
+            for key in backend.list(f"{job_id}/layers/")
+            if key.endswith('.json')
+        ]
+
+    manifests = {}
+    for layer in layers:
+        data = backend.read_bytes(get_layer_manifest_key(job_id, layer))
+
+        if data is not None:
+            manifests[layer] = json.loads(data)
+
+    return manifests
+
+
+# Note: Only files missing locally, or whose local copy doesn't match the manifest, are downloaded
+def load_layers(
+        backend: StorageBackend, tmp_dir: str, manifests: Dict[str, LayerManifest],
+        index: Dict[str, IndexEntry],
+) -> CacheStats:
+    stats = CacheStats(hits=0, misses=0, hit_bytes=0, miss_bytes=0, evictions=0, evicted_bytes=0)
+
+    missing = {}
+    for manifest in manifests.values():
+        for path in manifest["dirs"]:
+            os.makedirs(os.path.join(tmp_dir, path), exist_ok=True)
+
+        for path, entry in manifest["files"].items():
+            index_entry = lookup_index(index, tmp_dir, path)
+
+            if index_entry is not None and index_entry["digest"] == entry["digest"]:
+                stats["hits"] += 1
+                stats["hit_bytes"] += entry["size"]
+            else:
+                stats["misses"] += 1
+                stats["miss_bytes"] += entry["size"]
+                missing[path] = entry
+
+    def load_file(path: str) -> None:
+        get_file(backend, missing[path], os.path.join(tmp_dir, path))
+        index[path] = make_index_entry(os.path.join(tmp_dir, path), missing[path])
+
+    with concurrent.futures.ThreadPoolExecutor(settings.STORAGE_TRANSFER_CONCURRENCY) as executor:
+        list(executor.map(load_file, missing))
+
+    return stats
+
+
+def write_archive(fileobj: BinaryIO, root_dir: str, base_dir: str) -> None:
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=settings.ARTIFACT_ZIP_COMPRESSION_LEVEL) as zf:
+        for root, dirnames, filenames in os.walk(os.path.join(root_dir, base_dir)):
+            for name in sorted(dirnames):
+                path = os.path.join(root, name)
+                zf.write(path, os.path.relpath(path, root_dir))
+
+            for name in sorted(filenames):
+                path = os.path.join(root, name)
+                zf.write(path, os.path.relpath(path, root_dir), compress_type=get_zip_compression(path))
+
+
+# Note: Whole job directory is published as a single archive, which is served by `/get_download_url`.
+#   In streaming mode archive is compressed straight into the upload, without temporary copy on disk
+def save_result_archive(backend: StorageBackend, tmp_dir: str, job_id: str, streaming: bool) -> None:
+    if streaming:
+        with backend.open_write(get_result_key(job_id)) as f:
+            write_archive(f, tmp_dir, 'job')
+    else:
+        zip_filename = os.path.join(tmp_dir, 'data.zip')
+        with open(zip_filename, 'wb') as f:
+            write_archive(f, tmp_dir, 'job')
+
+        backend.upload_file(get_result_key(job_id), zip_filename)
+        os.remove(zip_filename)
+
+
+# Note: Jobs scheduled before content-addressed storage was introduced store zip archives, either per layer or a single one.
+#   In streaming mode archives are extracted while being downloaded, without temporary copy on disk
+def load_legacy_archives(backend: StorageBackend, tmp_dir: str, job_id: str, streaming: bool) -> None:
+    keys = [key for key in backend.list(f"{job_id}/layers/") if key.endswith('.zip')] or [get_result_key(job_id)]
+
+    for key in keys:
+        if streaming:
+            with backend.open_read(key) as f, zipfile.ZipFile(f) as zf:
+                zf.extractall(tmp_dir)
+        else:
+            zip_filename = os.path.join(tmp_dir, os.path.basename(key))
+            backend.download_file(key, zip_filename)
+
+            with zipfile.ZipFile(zip_filename) as zf:
+                zf.extractall(tmp_dir)
+
+            os.remove(zip_filename)
@@ -0,0 +1,197 @@
+from typing import BinaryIO, ContextManager, Iterator, List, Optional
+
+import os
+import abc
+import shutil
+import functools
+import contextlib
+
+import requests.adapters
+import google.api_core.exceptions
+from google.cloud import storage
+
+from settings import settings, StorageBackendType
+from storage.transfer import is_chunked, upload_chunked, download_chunked
+
+
+class StorageBackend(abc.ABC):
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    # Note: Returns `None` when object doesn't exist
+    @abc.abstractmethod
+    def get_size(self, key: str) -> Optional[int]:
+        ...
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def upload_file(self, key: str, path: str) -> None:
+        ...
+
+    # Note: `size` is an optional hint, which allows to choose transfer strategy without extra metadata request
+    @abc.abstractmethod
+    def download_file(self, key: str, path: str, size: Optional[int] = None) -> None:
+        ...
+
+    @abc.abstractmethod
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def write_bytes(self, key: str, data: bytes) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_public_url(self, key: str) -> str:
+        ...
+
+    # Note: Readers are seekable, so archives can be extracted straight from storage
+    @abc.abstractmethod
+    def open_read(self, key: str) -> ContextManager[BinaryIO]:
+        ...
+
+    # Note: Writers are not seekable, object becomes visible only after writer is closed
+    @abc.abstractmethod
+    def open_write(self, key: str) -> ContextManager[BinaryIO]:
+        ...
+
+
+class GCSStorageBackend(StorageBackend):
+    def __init__(self, bucket_name: str):
+        self.client = storage.Client()
+
+        # Note: Client is shared between transfer threads, so connection pool must fit all of them
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=settings.STORAGE_TRANSFER_CONCURRENCY,
+            pool_maxsize=settings.STORAGE_TRANSFER_CONCURRENCY * 2,
+        )
+        self.client._http.mount('https://', adapter)
+
+        self.bucket = self.client.bucket(bucket_name)
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+    def get_size(self, key: str) -> Optional[int]:
+        blob = self.bucket.get_blob(key)
+        return blob.size if blob is not None else None
+
+    def list(self, prefix: str) -> List[str]:
+        return [blob.name for blob in self.client.list_blobs(self.bucket, prefix=prefix)]
+
+    def upload_file(self, key: str, path: str) -> None:
+        if is_chunked(os.path.getsize(path)):
+            upload_chunked(self.bucket, key, path)
+        else:
+            self.bucket.blob(key).upload_from_filename(path)
+
+    def download_file(self, key: str, path: str, size: Optional[int] = None) -> None:
+        if size is not None and is_chunked(size):
+            download_chunked(self.bucket, key, path, size)
+        else:
+            self.bucket.blob(key).download_to_filename(path)
+
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        try:
+            return self.bucket.blob(key).download_as_bytes()
+        except google.api_core.exceptions.NotFound:
+            return None
+
+    def write_bytes(self, key: str, data: bytes) -> None:
+        self.bucket.blob(key).upload_from_string(data)
+
+    def get_public_url(self, key: str) -> str:
+        blob = self.bucket.blob(key)
+        blob.make_public()
+
+        return blob.public_url
+
+    def open_read(self, key: str) -> ContextManager[BinaryIO]:
+        return self.bucket.blob(key).open('rb', chunk_size=settings.STORAGE_STREAM_CHUNK_SIZE_MB * 1024 * 1024)
+
+    def open_write(self, key: str) -> ContextManager[BinaryIO]:
+        # Note: Uses resumable upload, each chunk is sent as soon as it is filled
+        return self.bucket.blob(key).open('wb', chunk_size=settings.STORAGE_STREAM_CHUNK_SIZE_MB * 1024 * 1024, ignore_flush=True)
+
+
+class LocalStorageBackend(StorageBackend):
+    def __init__(self, root_dir: str):
+        self.root_dir = os.path.abspath(root_dir)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_dir, *key.split('/'))
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def get_size(self, key: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        for root, _, files in os.walk(self._path(prefix.rpartition('/')[0])):
+            for filename in files:
+                key = os.path.relpath(os.path.join(root, filename), self.root_dir).replace(os.sep, '/')
+                if key.startswith(prefix) and not key.endswith('.part'):
+                    keys.append(key)
+
+        return sorted(keys)
+
+    def upload_file(self, key: str, path: str) -> None:
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # Note: Copy under temporary name first, so that concurrent readers never observe partial objects
+        shutil.copyfile(path, target + '.part')
+        os.replace(target + '.part', target)
+
+    def download_file(self, key: str, path: str, size: Optional[int] = None) -> None:
+        shutil.copyfile(self._path(key), path)
+
+    def read_bytes(self, key: str) -> Optional[bytes]:
+        if not self.exists(key):
+            return None
+
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, key: str, data: bytes) -> None:
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        with open(target + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(target + '.part', target)
+
+    def get_public_url(self, key: str) -> str:
+        return f"file://{self._path(key)}"
+
+    def open_read(self, key: str) -> ContextManager[BinaryIO]:
+        return open(self._path(key), 'rb')
+
+    @contextlib.contextmanager
+    def open_write(self, key: str) -> Iterator[BinaryIO]:
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        with open(target + '.part', 'wb') as f:
+            yield f
+        os.replace(target + '.part', target)
+
+
+# Note: Backend is shared within a process, so that its client and connection pool are reused by every transfer
+@functools.cache
+def get_backend() -> StorageBackend:
+    if settings.STORAGE_BACKEND == StorageBackendType.GCS:
+        return GCSStorageBackend(settings.SD_DATA_STORAGE_BUCKET_NAME)
+    elif settings.STORAGE_BACKEND == StorageBackendType.LOCAL:
+        return LocalStorageBackend(settings.STORAGE_LOCAL_DIR)
+    else:
+        raise Exception("Invalid storage backend")
@@ -0,0 +1,208 @@
+from typing import Dict, Iterator, NotRequired, Optional, Set, TypedDict
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+import contextlib
+
+logger = logging.getLogger("sd_cloud.storage.cache")
+
+INDEX_FILENAME = '.index.json'
+LOCK_FILENAME = '.lock'
+IN_USE_FILENAME = '.in_use'
+STATS_FILENAME = '.stats.json'
+
+
+class IndexEntry(TypedDict):
+    digest: str
+    size: int
+    mtime_ns: int
+
+    codec: NotRequired[str]
+    stored_size: NotRequired[int]
+
+
+class CacheStats(TypedDict):
+    hits: int
+    misses: int
+    hit_bytes: int
+    miss_bytes: int
+    evictions: int
+    evicted_bytes: int
+
+
+# Note: Index records which blob every local file was created from, so that local copy can be validated
+#   against layer manifests, instead of trusting whatever happens to be in the job directory
+def read_index(tmp_dir: str) -> Dict[str, IndexEntry]:
+    try:
+        with open(os.path.join(tmp_dir, INDEX_FILENAME), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+# Note: Index modification time is also used as job directory last access time for LRU eviction
+def write_index(tmp_dir: str, index: Dict[str, IndexEntry]) -> None:
+    path = os.path.join(tmp_dir, INDEX_FILENAME)
+
+    with open(path + '.part', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.part', path)
+
+
+def make_index_entry(path: str, entry: dict) -> IndexEntry:
+    stat = os.stat(path)
+    return IndexEntry(**entry, mtime_ns=stat.st_mtime_ns)
+
+
+def lookup_index(index: Dict[str, IndexEntry], tmp_dir: str, path: str) -> Optional[IndexEntry]:
+    entry = index.get(path)
+    if entry is None:
+        return None
+
+    try:
+        stat = os.stat(os.path.join(tmp_dir, path))
+    except FileNotFoundError:
+        return None
+
+    # Note: File changed since it was indexed, e.g. was rewritten by a stage, so it can't be trusted
+    if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+        return None
+
+    return entry
+
+
+@contextlib.contextmanager
+def locked(path: str, blocking: bool = True) -> Iterator[bool]:
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Note: Job directory is locked while it's being loaded or saved, both by other processes
+#   on the same node and by cache eviction
+def job_lock(tmp_dir: str) -> contextlib.AbstractContextManager[bool]:
+    return locked(os.path.join(tmp_dir, LOCK_FILENAME))
+
+
+# Note: Job directory is marked in use by each task working on it, for the whole task including its container run.
+#   Marks are shared locks, so tasks don't wait for each other, while eviction skips directory marked by any of them.
+#   Directory evicted while the mark was awaited is created again, so the mark is never held on a removed file
+@contextlib.contextmanager
+def in_use(tmp_dir: str) -> Iterator[None]:
+    path = os.path.join(tmp_dir, IN_USE_FILENAME)
+
+    while True:
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_SH)
+
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+
+        f.close()
+
+    try:
+        yield
+    finally:
+        f.close()
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+def get_last_used(tmp_dir: str) -> float:
+    for filename in (INDEX_FILENAME, LOCK_FILENAME):
+        try:
+            return os.stat(os.path.join(tmp_dir, filename)).st_mtime
+        except FileNotFoundError:
+            pass
+
+    return os.stat(tmp_dir).st_mtime
+
+
+def update_stats(cache_dir: str, **deltas: int) -> CacheStats:
+    path = os.path.join(cache_dir, STATS_FILENAME)
+
+    with locked(path + '.lock'):
+        stats = read_stats(cache_dir)
+        for key, value in deltas.items():
+            stats[key] += value
+
+        with open(path + '.part', 'w') as f:
+            json.dump(stats, f)
+        os.replace(path + '.part', path)
+
+    return stats
+
+
+def read_stats(cache_dir: str) -> CacheStats:
+    stats = CacheStats(hits=0, misses=0, hit_bytes=0, miss_bytes=0, evictions=0, evicted_bytes=0)
+
+    try:
+        with open(os.path.join(cache_dir, STATS_FILENAME), 'r') as f:
+            stats.update(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    return stats
+
+
+# Note: Least recently used job directories are removed until cache fits into the budget.
+#   Directories that a task on the node is using, or that are being loaded or saved, are never evicted
+def enforce_budget(cache_dir: str, budget_bytes: int, keep: Set[str]) -> None:
+    job_dirs = [
+        os.path.join(cache_dir, name)
+        for name in os.listdir(cache_dir)
+        if not name.startswith('.') and os.path.isdir(os.path.join(cache_dir, name))
+    ]
+
+    sizes = {job_dir: get_dir_size(job_dir) for job_dir in job_dirs}
+    total = sum(sizes.values())
+
+    if total <= budget_bytes:
+        return
+
+    for job_dir in sorted(job_dirs, key=get_last_used):
+        if total <= budget_bytes:
+            break
+
+        if job_dir in keep:
+            continue
+
+        with (
+            locked(os.path.join(job_dir, IN_USE_FILENAME), blocking=False) as unused,
+            locked(os.path.join(job_dir, LOCK_FILENAME), blocking=False) as acquired,
+        ):
+            if not (unused and acquired):
+                continue
+
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+        total -= sizes[job_dir]
+
+        logger.info(f"Evicted {job_dir} ({sizes[job_dir]} bytes)")
+        update_stats(cache_dir, evictions=1, evicted_bytes=sizes[job_dir])
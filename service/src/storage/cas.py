@@ -0,0 +1,89 @@
+from typing import NotRequired, TypedDict
+
+import io
+import os
+import hashlib
+
+from settings import ArtifactCodec
+from storage.backend import StorageBackend
+from storage.compression import select_codec, compress_stream, decompress_stream
+
+
+class FileEntry(TypedDict):
+    digest: str
+    size: int
+
+    # Note: Entries written before compression policy was introduced have neither, they are stored as is
+    codec: NotRequired[ArtifactCodec]
+    stored_size: NotRequired[int]
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+# Note: Digest is always taken from uncompressed content, codec is part of the key,
+#   so that changing compression policy never makes stored blobs ambiguous
+def get_blob_key(digest: str, codec: ArtifactCodec = ArtifactCodec.STORE) -> str:
+    key = f"cas/sha256/{digest[:2]}/{digest}"
+
+    if codec != ArtifactCodec.STORE:
+        key += f".{codec.value}"
+
+    return key
+
+
+def put_file(backend: StorageBackend, path: str) -> FileEntry:
+    digest = hash_file(path)
+    codec = select_codec(path)
+    key = get_blob_key(digest, codec)
+
+    # Note: Blobs are immutable and shared between jobs, identical content is uploaded only once
+    stored_size = backend.get_size(key)
+
+    if stored_size is None:
+        if codec == ArtifactCodec.STORE:
+            backend.upload_file(key, path)
+            stored_size = os.path.getsize(path)
+        else:
+            # Note: Compressed straight into the upload stream, without temporary copy on disk
+            with open(path, 'rb') as src, backend.open_write(key) as dst:
+                stored_size = compress_stream(src, dst, codec)
+
+    return FileEntry(digest=digest, size=os.path.getsize(path), codec=codec, stored_size=stored_size)
+
+
+def get_file(backend: StorageBackend, entry: FileEntry, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    codec = ArtifactCodec(entry.get("codec", ArtifactCodec.STORE))
+    key = get_blob_key(entry["digest"], codec)
+
+    # Note: Download under temporary name first, so that interrupted downloads never look complete
+    if codec == ArtifactCodec.STORE:
+        backend.download_file(key, path + '.part', entry["size"])
+    else:
+        with backend.open_read(key) as src, open(path + '.part', 'wb') as dst:
+            decompress_stream(src, dst, codec)
+
+    os.replace(path + '.part', path)
+
+
+def read_file(backend: StorageBackend, entry: FileEntry) -> bytes:
+    codec = ArtifactCodec(entry.get("codec", ArtifactCodec.STORE))
+    key = get_blob_key(entry["digest"], codec)
+
+    if codec == ArtifactCodec.STORE:
+        return backend.read_bytes(key)
+
+    with backend.open_read(key) as src:
+        dst = io.BytesIO()
+        decompress_stream(src, dst, codec)
+
+        return dst.getvalue()
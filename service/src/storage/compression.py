@@ -0,0 +1,80 @@
+from typing import BinaryIO
+
+import os
+import zlib
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from settings import settings, ArtifactCodec
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+# Note: Already compressed media barely shrinks, so it's stored as is to save worker CPU on the hot path
+def is_store_only(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in settings.ARTIFACT_STORE_ONLY_EXTENSIONS
+
+
+def select_codec(path: str) -> ArtifactCodec:
+    if is_store_only(path):
+        return ArtifactCodec.STORE
+
+    # Note: zstd is optional, zlib is used when it isn't installed
+    if settings.ARTIFACT_CODEC == ArtifactCodec.ZSTD and zstandard is None:
+        return ArtifactCodec.ZLIB
+
+    return settings.ARTIFACT_CODEC
+
+
+class _CountingWriter:
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        return self.fileobj.write(data)
+
+
+# Note: Returns amount of compressed bytes written
+def compress_stream(src: BinaryIO, dst: BinaryIO, codec: ArtifactCodec) -> int:
+    counter = _CountingWriter(dst)
+
+    if codec == ArtifactCodec.ZSTD:
+        compressor = zstandard.ZstdCompressor(level=settings.ARTIFACT_COMPRESSION_LEVEL, threads=-1)
+        compressor.copy_stream(src, counter, read_size=COPY_BUFFER_SIZE, write_size=COPY_BUFFER_SIZE)
+    elif codec == ArtifactCodec.ZLIB:
+        compressor = zlib.compressobj(settings.ARTIFACT_COMPRESSION_LEVEL)
+        while chunk := src.read(COPY_BUFFER_SIZE):
+            counter.write(compressor.compress(chunk))
+        counter.write(compressor.flush())
+    else:
+        while chunk := src.read(COPY_BUFFER_SIZE):
+            counter.write(chunk)
+
+    return counter.written
+
+
+def decompress_stream(src: BinaryIO, dst: BinaryIO, codec: ArtifactCodec) -> None:
+    if codec == ArtifactCodec.ZSTD:
+        if zstandard is None:
+            raise Exception("zstandard is required to read zstd compressed artifacts")
+
+        zstandard.ZstdDecompressor().copy_stream(src, dst, read_size=COPY_BUFFER_SIZE, write_size=COPY_BUFFER_SIZE)
+    elif codec == ArtifactCodec.ZLIB:
+        decompressor = zlib.decompressobj()
+        while chunk := src.read(COPY_BUFFER_SIZE):
+            dst.write(decompressor.decompress(chunk))
+        dst.write(decompressor.flush())
+    else:
+        while chunk := src.read(COPY_BUFFER_SIZE):
+            dst.write(chunk)
+
+
+# Note: Archives stay plain zip files, readable by older loaders and the CLI, only compression of members differs
+def get_zip_compression(path: str) -> int:
+    return zipfile.ZIP_STORED if is_store_only(path) else zipfile.ZIP_DEFLATED
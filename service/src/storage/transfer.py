@@ -0,0 +1,91 @@
+from typing import List, Tuple
+
+import os
+import math
+import uuid
+import functools
+import concurrent.futures
+
+from google.cloud import storage
+
+from settings import settings
+
+
+# Note: GCS allows composing at most 32 objects in a single request
+MAX_COMPOSE_PARTS = 32
+
+
+@functools.cache
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=settings.STORAGE_TRANSFER_CONCURRENCY,
+        thread_name_prefix='sd-transfer',
+    )
+
+
+def is_chunked(size: int) -> bool:
+    return size >= settings.STORAGE_CHUNKED_TRANSFER_THRESHOLD_MB * 1024 * 1024
+
+
+def split_ranges(size: int, max_parts: int) -> List[Tuple[int, int]]:
+    chunk_size = max(settings.STORAGE_TRANSFER_CHUNK_SIZE_MB * 1024 * 1024, math.ceil(size / max_parts))
+
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def _upload_part(bucket: storage.Bucket, key: str, path: str, start: int, end: int) -> storage.Blob:
+    blob = bucket.blob(key)
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        blob.upload_from_file(f, size=end - start)
+
+    return blob
+
+
+# Note: Parts are uploaded concurrently as temporary objects and then composed into target object server-side.
+#   Parts of each upload have their own prefix, so concurrent uploads of the same blob don't delete each other's parts.
+#   Every part that was uploaded is deleted, also when another part failed
+def upload_chunked(bucket: storage.Bucket, key: str, path: str) -> None:
+    ranges = split_ranges(os.path.getsize(path), MAX_COMPOSE_PARTS)
+    upload_id = uuid.uuid4().hex
+
+    futures = [
+        get_executor().submit(_upload_part, bucket, f"{key}.parts/{upload_id}/{i:0>2}", path, start, end)
+        for i, (start, end) in enumerate(ranges)
+    ]
+    concurrent.futures.wait(futures)
+
+    parts = [future.result() for future in futures if future.exception() is None]
+
+    try:
+        if len(parts) < len(futures):
+            raise next(future.exception() for future in futures if future.exception() is not None)
+
+        bucket.blob(key).compose(parts)
+    finally:
+        for part in parts:
+            part.delete()
+
+
+def _download_range(blob: storage.Blob, path: str, start: int, end: int) -> None:
+    with open(path, 'r+b') as f:
+        f.seek(start)
+
+        # Note: Checksums are not available for partial reads, `end` is inclusive
+        blob.download_to_file(f, start=start, end=end - 1, checksum=None)
+
+
+# Note: File is preallocated and ranges are read concurrently straight into their positions
+def download_chunked(bucket: storage.Bucket, key: str, path: str, size: int) -> None:
+    blob = bucket.blob(key)
+
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    futures = [
+        get_executor().submit(_download_range, blob, path, start, end)
+        for start, end in split_ranges(size, math.inf)
+    ]
+    for future in futures:
+        future.result()
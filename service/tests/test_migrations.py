@@ -0,0 +1,84 @@
+# Upgrades databases created before migrations were versioned. Run from `service` directory:
+#   PYTHONPATH=src pipenv run python -m unittest discover tests
+
+import os
+import json
+import tempfile
+import unittest
+
+from database import db, Job, JobStatus, StageRun
+from database.migrator import MIGRATIONS, SchemaVersion, run_migrations
+
+
+# Note: Schema and a job in flight as they were created by the first release of the service
+BASELINE_SCHEMA = [
+    'CREATE TABLE "job" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "created_at" DATETIME NOT NULL, '
+    '"status" VARCHAR(255) NOT NULL, "celery_job_ids" TEXT NOT NULL, "progress" INTEGER NOT NULL, '
+    '"total" INTEGER NOT NULL, "current_step" TEXT, "steps" TEXT NOT NULL, "payload" TEXT NOT NULL, "logs" TEXT)',
+    'CREATE INDEX "job_created_at" ON "job" ("created_at")',
+    'CREATE INDEX "job_status" ON "job" ("status")',
+]
+
+BASELINE_JOB = (
+    'old', '2024-01-01 00:00:00.000000', JobStatus.RUNNING.value, json.dumps(["t0", "t1"]), 1, 3, None,
+    json.dumps(["cpu.prestage_0", "cpu.stage_0", "cpu.stage_1"]), '{}', None,
+)
+
+
+class BaselineUpgradeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+        db.init(os.path.join(self.dir.name, 'database.db'))
+        db.connect()
+
+        for sql in BASELINE_SCHEMA:
+            db.execute_sql(sql)
+        db.execute_sql(f'INSERT INTO "job" VALUES ({", ".join("?" * len(BASELINE_JOB))})', BASELINE_JOB)
+
+    def tearDown(self):
+        db.close()
+        self.dir.cleanup()
+
+    def test_upgrade(self):
+        run_migrations()
+
+        self.assertEqual(SchemaVersion.select().count(), len(MIGRATIONS))
+
+        columns = [column.name for column in db.get_columns(Job._meta.table_name)]
+        self.assertCountEqual(columns, [field.column_name for field in Job._meta.sorted_fields])
+
+        indexes = {index.name: index.columns for index in db.get_indexes(Job._meta.table_name)}
+        for field in (Job.group_id, Job.fingerprint, Job.submitter):
+            self.assertEqual(indexes[f"job_{field.column_name}"], [field.column_name])
+
+        self.assertEqual(db.execute_sql('PRAGMA integrity_check').fetchall(), [('ok',)])
+
+        job = Job.get_by_id('old')
+        self.assertEqual(job.attachments, 1)
+        self.assertEqual(job.get_step_states(), {
+            "cpu.prestage_0": {"status": JobStatus.SUCCEEDED},
+            "cpu.stage_0": {"status": JobStatus.RUNNING, "task_id": "t1", "queue": "cpu"},
+        })
+
+    def test_upgrade_is_applied_once(self):
+        run_migrations()
+        run_migrations()
+
+        self.assertEqual(SchemaVersion.select().count(), len(MIGRATIONS))
+        self.assertEqual(StageRun.select().where(StageRun.job_id == 'old').count(), 2)
+
+    def test_indexed_columns_are_queried(self):
+        run_migrations()
+
+        Job.create(id='new', total=1, steps='[]', payload='{}', group_id='group', fingerprint='fingerprint', submitter='submitter')
+
+        self.assertEqual(Job.get(Job.group_id == 'group').id, 'new')
+        self.assertEqual(Job.get(Job.fingerprint == 'fingerprint').id, 'new')
+        self.assertEqual(Job.get(Job.submitter == 'submitter').id, 'new')
+
+        self.assertEqual(db.execute_sql('PRAGMA integrity_check').fetchall(), [('ok',)])
+
+
+if __name__ == '__main__':
+    unittest.main()